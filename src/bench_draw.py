@@ -0,0 +1,78 @@
+#
+# Drawing benchmark: instructions per second rendered headless (see qrender),
+# as PNG and as SVG, drawing many sessions one after the other, in a pool of
+# threads and in a pool of processes. Each session is a model-like drawing:
+# shapes, text, and dense sine curves. No display is needed.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_draw.py
+#   $ ./pyvenv/bin/python3 ./src/bench_draw.py --sessions 64 --instructions 500 --workers 8
+#
+import os
+import time
+import random
+import argparse
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from typing import Any, Dict, List
+
+from qrender import render, render_sessions
+
+
+def session(seed: int, size: int) -> List[Dict[str, Any]]:
+    rng = random.Random(seed)
+    colors = ['black', 'red', 'blue', 'dark green', 'light blue', 'gray50']
+
+    def point():
+        return [rng.randint(0, 800), rng.randint(0, 600)]
+
+    kinds = [
+        lambda: {'set_color': rng.choice(colors)},
+        lambda: {'draw_line': {'points': [point(), point()]}},
+        lambda: {'draw_circle': {'center': point(), 'radius': rng.randint(5, 100)}},
+        lambda: {'draw_triangle': {'points': [point(), point(), point()]}},
+        lambda: {'draw_polygon': {'points': [point() for _ in range(6)]}},
+        lambda: {'draw_text': {'position': point(), 'text': 'Some text'}},
+        # A curve of 720 points
+        lambda: {'draw_sinus': {'start': point(), 'range': [0, 720, 1, rng.randint(10, 200)]}},
+    ]
+    return [rng.choice(kinds)() for _ in range(size)]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure headless drawing throughput')
+    parser.add_argument('--sessions', type=int, default=32, help='Number of drawing sessions (default: 32)')
+    parser.add_argument('--instructions', type=int, default=200, help='Instructions per session (default: 200)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='Threads or processes in the pools (default: the number of CPUs)')
+    parser.add_argument('--formats', default='png,svg', help='Comma separated output formats (default: png,svg)')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    sessions = {f"session{i}": session(i, args.instructions) for i in range(args.sessions)}
+    total = args.sessions * args.instructions
+    print(f"{args.sessions} sessions of {args.instructions} instructions, {args.workers} workers")
+    print(f"{'format':<8} {'mode':<10} {'seconds':>9} {'instructions/s':>15}")
+    with tempfile.TemporaryDirectory() as directory:
+        for file_format in args.formats.split(','):
+            def serial():
+                for name, instructions in sessions.items():
+                    render(instructions, os.path.join(directory, f"{name}.{file_format}"))
+
+            def threads():
+                with ThreadPoolExecutor(args.workers) as pool:
+                    render_sessions(sessions, directory, file_format, executor=pool)
+
+            def processes():
+                render_sessions(sessions, directory, file_format, workers=args.workers)
+
+            for mode, func in [('serial', serial), ('threads', threads), ('processes', processes)]:
+                start_time = time.perf_counter()
+                func()
+                elapsed = time.perf_counter() - start_time
+                print(f"{file_format:<8} {mode:<10} {elapsed:>9.2f} {total / elapsed:>15.0f}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,69 @@
+#
+# Geometry benchmark: the points of dense sine curves computed with NumPy
+# (see qgeom) against a Python list comprehension calling math.sin() per
+# point (as Painter used to), the time to simplify them to the resolution
+# of the canvas, and the time to draw them headless, as PNG and SVG, with
+# and without simplifying them first. Tk, like SVG, pays per point, so
+# Painter simplifies long lines for those; Pillow draws them faster than
+# they are simplified.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_geom.py
+#   $ ./pyvenv/bin/python3 ./src/bench_geom.py --points 1000,100000 --repeat 10
+#
+import math
+import time
+import argparse
+import statistics
+from typing import Any, Callable, List, Tuple
+
+from qgeom import simplify, sinus_points
+from qrender import ImageRenderer, SvgRenderer
+
+
+def list_sinus_points(start: List[int], degrees: List[float]) -> List[Tuple]:
+    # The former points, for reference
+    first, stop, step, yscale = degrees
+    xoff, yoff = start
+    count = int((stop - first) / step)
+    return [(first + i * step + xoff, math.sin(math.radians(first + i * step)) * yscale + yoff) for i in range(count)]
+
+
+def median_time(func: Callable[[], Any], repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare computing and drawing dense curves with and without NumPy')
+    parser.add_argument('--points', default='1000,10000,100000', help='Comma separated points per curve (default: 1000,10000,100000)')
+    parser.add_argument('--repeat', type=int, default=5, help='Times to repeat each measurement (default: 5)')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    print(f"{'points':>8} {'list ms':>8} {'numpy ms':>9} {'simplify ms':>12} {'kept':>6} "
+          f"{'png ms':>7} {'simplified':>11} {'svg ms':>7} {'simplified':>11}")
+    for count in (int(points) for points in args.points.split(',')):
+        # Twice around, 600 pixels wide
+        degrees = [0, 720, 720 / count, 200]
+        list_time = median_time(lambda: list_sinus_points([100, 300], degrees), args.repeat)
+        numpy_time = median_time(lambda: sinus_points([100, 300], degrees), args.repeat)
+        points = sinus_points([100, 300], degrees)
+        simplify_time = median_time(lambda: simplify(points), args.repeat)
+        simplified = simplify(points)
+        drawn = []
+        for renderer in (ImageRenderer(800, 600), SvgRenderer(800, 600)):
+            drawn.append(median_time(lambda: renderer.line(points, 'black', 1), args.repeat))
+            drawn.append(median_time(lambda: renderer.line(simplify(points), 'black', 1), args.repeat))
+        print(f"{count:>8} {list_time * 1000:>8.2f} {numpy_time * 1000:>9.2f} {simplify_time * 1000:>12.2f} {len(simplified):>6} "
+              + " ".join(f"{seconds * 1000:>{width}.2f}" for seconds, width in zip(drawn, (7, 11, 7, 11))))
+
+
+if __name__ == '__main__':
+    main(parse_args())
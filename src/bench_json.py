@@ -0,0 +1,91 @@
+#
+# JSON extraction benchmark: the single pass extractor in qutils against
+# retrying json.raw_decode from every '{' (as extract_json_objects used to),
+# on multi-megabyte adversarial model outputs: prose full of braces, many
+# objects in prose, deeply nested broken objects, and a huge single quoted
+# string streamed in small chunks.
+#
+# The retrying extractor is quadratic, so it is only run up to --retry-limit
+# bytes; see how the two grow with the size of the input, and how the single
+# pass one does on the whole text and streamed in chunks.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_json.py
+#   $ ./pyvenv/bin/python3 ./src/bench_json.py --sizes 1000000,8000000 --chunk 4
+#
+import json
+import time
+import argparse
+from typing import Any, Callable, Dict, Iterable, List
+
+from qutils import extract_json_objects, extract_json_stream
+
+
+def extract_by_retry(text: str, decoder=json.JSONDecoder()) -> Iterable[Dict[str, Any]]:
+    # The former extractor, for reference
+    text = text.replace("'", '"')
+    pos = 0
+    while True:
+        match = text.find('{', pos)
+        if match == -1:
+            break
+        try:
+            result, index = decoder.raw_decode(text[match:])
+            yield result
+            pos = match + index
+        except (ValueError, RecursionError):
+            pos = match + 1
+
+
+def repeated(piece: str, size: int) -> str:
+    return piece * (size // len(piece) + 1)
+
+
+def inputs(size: int) -> Dict[str, Callable[[], str]]:
+    return {
+        'braces in prose': lambda: repeated("Use {braces} for sets, as in {1, 2}, or dicts like {x: y}. ", size),
+        'objects in prose': lambda: repeated("Thought: I'll look. Action: {'action': 'search', 'action_input': {'query': 'it is'}} ", size),
+        'JSON in prose': lambda: repeated('Thought: I will look. Action: {"action": "search", "action_input": {"query": "it is"}} ', size),
+        'unclosed object': lambda: "{'action': " + repeated("{'set_color': 'red'}, {'draw_line': [1, 2, 3, 4]} ", size),
+        'deep and broken': lambda: repeated("{'a': ", size // 2) + "1" + repeated("} oops ", size // 2),
+        'long string': lambda: "{'text': '" + repeated("a \"long\" line\\n ", size) + "'}",
+    }
+
+
+def timed(func: Callable[[], List[Any]]) -> Any:
+    start_time = time.perf_counter()
+    found = func()
+    return time.perf_counter() - start_time, len(found)
+
+
+def chunked(text: str, size: int) -> Iterable[str]:
+    return (text[i:i + size] for i in range(0, len(text), size))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the JSON extractors on adversarial model outputs')
+    parser.add_argument('--sizes', default='100000,400000,2000000', help='Comma separated input sizes in bytes (default: 100000,400000,2000000)')
+    parser.add_argument('--retry-limit', type=int, default=400_000, help='Size up to which to run the retrying extractor (default: 400000)')
+    parser.add_argument('--chunk', type=int, default=16, help='Characters per chunk when streaming (default: 16)')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    sizes = [int(size) for size in args.sizes.split(',')]
+    print(f"{'input':<18} {'kB':>6} {'retry ms':>10} {'1-pass ms':>10} {'streamed ms':>12} {'objects':>9}")
+    for name in inputs(0):
+        for size in sizes:
+            text = inputs(size)[name]()
+            retry = '-'
+            if size <= args.retry_limit:
+                retry_time, retry_found = timed(lambda: list(extract_by_retry(text)))
+                retry = f"{retry_time * 1000:.1f}"
+            single_time, found = timed(lambda: list(extract_json_objects(text)))
+            streamed_time, streamed_found = timed(lambda: list(extract_json_stream(chunked(text, args.chunk))))
+            assert streamed_found == found
+            print(f"{name:<18} {size // 1000:>6} {retry:>10} {single_time * 1000:>10.1f} {streamed_time * 1000:>12.1f} {found:>9}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,79 @@
+#
+# Parsing benchmark: compares the ways qhttp can pull the paragraph text out
+# of a page (BeautifulSoup with html.parser, the streaming extractor, and
+# lxml if it is installed) on the saved pages in fixtures/html.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_parse.py
+#   $ ./pyvenv/bin/python3 ./src/bench_parse.py --runs 50 --split
+#
+import os
+import glob
+import time
+import argparse
+import statistics
+from typing import Callable, List
+
+from qhttp import extract_paragraphs, parsers, split_text
+
+src_directory = os.path.dirname(os.path.abspath(__file__))
+fixtures_directory = os.path.join(src_directory, "fixtures", "html")
+
+
+def available_parsers() -> List[str]:
+    names = []
+    for name in parsers:
+        try:
+            extract_paragraphs("<p>probe</p>", parser=name)
+            names.append(name)
+        except ImportError:
+            print(f"Skipping {name}: not installed")
+    return names
+
+
+def median_time(func: Callable[[], object], runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare the HTML paragraph extractors on saved pages')
+    parser.add_argument('--runs', type=int, default=20, help='Number of runs to take the median of (default: 20)')
+    parser.add_argument('--split', action='store_true', help='Include splitting the text into chunks')
+    parser.add_argument('files', nargs='*', help='HTML files (default: the fixtures)')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    files = args.files or sorted(glob.glob(os.path.join(fixtures_directory, "*.html")))
+    names = available_parsers()
+
+    print(f"{'page':<24} {'KB':>6} " + ' '.join(f"{name + ' ms':>10}" for name in names) + f" {'speedup':>8} {'chars':>8}")
+    for path in files:
+        with open(path, encoding='utf-8') as f:
+            html = f.read()
+
+        times = {}
+        lengths = {}
+        for name in names:
+            if args.split:
+                work = lambda: split_text(extract_paragraphs(html, parser=name))
+            else:
+                work = lambda: extract_paragraphs(html, parser=name)
+            times[name] = median_time(work, args.runs)
+            lengths[name] = len(extract_paragraphs(html, parser=name))
+
+        fastest = min(times, key=times.get)
+        speedup = times['bs4'] / times[fastest] if 'bs4' in times else 1.0
+        print(f"{os.path.basename(path):<24} {len(html) / 1024:>6.1f} "
+              + ' '.join(f"{times[name] * 1000:>10.2f}" for name in names)
+              + f" {speedup:>7.1f}x {'/'.join(str(lengths[name]) for name in names):>8}")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,514 @@
+#
+# End-to-end RAG benchmark: runs the qsearch pipeline (fetch, store,
+# retrieve, pack, generate) and the qimdb pipeline (index, filtered search)
+# and reports the p50/p95 latency of every stage, the throughput and the
+# peak RSS, compared with a baseline recorded earlier on the same machine.
+#
+# It runs offline and repeatably:
+#
+#  - the search result pages are the saved pages in fixtures/html, served
+#    by a local HTTP server (with the paragraphs marked per question, so
+#    that every question stores pages of its own),
+#  - Ollama is a FakeOllama (see fakeollama.py) streaming a canned answer
+#    with a fixed delay per token, and embedding deterministically,
+#  - the sentence transformer is replaced by a deterministic embedding of
+#    the same number of dimensions,
+#  - retrieval runs against synthetic corpora of 1k, 100k or 1M chunks,
+#    built once in the bench directory and reused by later runs.
+#
+# The embedding and HTTP caches are turned off, so the pipelines do all
+# of their work every time.
+#
+# Timings only compare on the same machine, so the baseline is kept in the
+# bench directory (qcache/bench/bench_rag_baseline.json), out of the tree.
+# It records the time of a fixed calibration workload too: when that has
+# changed, the machine (or its load) has, and the comparison is suspect.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_rag.py --record           # record a baseline
+#   $ ./pyvenv/bin/python3 ./src/bench_rag.py                    # compare with it
+#   $ ./pyvenv/bin/python3 ./src/bench_rag.py --corpus 1k,100k   # bigger corpora
+#
+import os
+import re
+import sys
+import csv
+import glob
+import json
+import time
+import random
+import argparse
+import resource
+import tempfile
+import threading
+from argparse import Namespace
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List
+
+from fakeollama import FakeOllama, fake_embedding
+from qbm25 import tokenize
+
+src_directory = os.path.dirname(os.path.abspath(__file__))
+fixtures_directory = os.path.join(src_directory, "fixtures", "html")
+baseline_name = "bench_rag_baseline.json"
+
+corpus_sizes = {'1k': 1_000, '10k': 10_000, '100k': 100_000, '1M': 1_000_000}
+
+# Words per synthetic chunk, about the 500 characters of a qsearch split
+chunk_words = 80
+
+# Settings that have to match for a comparison with the baseline to mean anything
+compared_settings = ['questions', 'dimensions', 'token_delay', 'response_words', 'imdb_rows', 'hybrid']
+
+# How much the calibration time may differ from the baseline's before the comparison is suspect
+calibration_tolerance = 0.15
+
+
+def percentile(values: List[float], q: float) -> float:
+    """
+    The q-th percentile of the values, interpolated between the closest ranks.
+    """
+    ordered = sorted(values)
+    position = (len(ordered) - 1) * q / 100
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def peak_rss_mb() -> float:
+    """
+    The peak resident set size of this process so far, in MB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB elsewhere
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+class Timings:
+    """
+    The latencies of the stages of a pipeline, one sample per run of the stage.
+    """
+
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    @contextmanager
+    def timed(self, stage: str) -> Iterator[None]:
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start_time)
+
+    def add(self, stage: str, seconds: float) -> None:
+        self.samples.setdefault(stage, []).append(seconds)
+
+    def summary(self) -> Dict[str, Dict[str, float]]:
+        return {
+            stage: {'p50': percentile(values, 50), 'p95': percentile(values, 95), 'n': len(values)}
+            for stage, values in self.samples.items()
+        }
+
+
+def hash_embedding_function(dimensions: int):
+    """
+    A Chroma embedding function standing in for the sentence transformer:
+    deterministic, free of a model download, and as wide as the real thing.
+    """
+    from chromadb.api.types import EmbeddingFunction
+
+    class HashEmbeddingFunction(EmbeddingFunction):
+        def __init__(self, dimensions: int = 384):
+            self.dimensions = dimensions
+
+        def __call__(self, input):
+            return [fake_embedding(text, self.dimensions) for text in input]
+
+        @staticmethod
+        def name() -> str:
+            return "qai-bench-hash"
+
+        def get_config(self) -> Dict[str, Any]:
+            return {'dimensions': self.dimensions}
+
+        @staticmethod
+        def build_from_config(config: Dict[str, Any]) -> 'HashEmbeddingFunction':
+            return HashEmbeddingFunction(config['dimensions'])
+
+    return HashEmbeddingFunction(dimensions)
+
+
+def load_fixtures() -> Dict[str, str]:
+    pages = {}
+    for path in sorted(glob.glob(os.path.join(fixtures_directory, "*.html"))):
+        with open(path, encoding='utf-8') as f:
+            pages[os.path.basename(path)] = f.read()
+    return pages
+
+
+def fixture_vocabulary(pages: Dict[str, str]) -> List[str]:
+    """
+    The words of the fixture pages, so that the synthetic corpus and the
+    questions read (to BM25 at least) like the pages.
+    """
+    from qhttp import extract_paragraphs
+
+    words = set()
+    for html in pages.values():
+        words.update(tokenize(extract_paragraphs(html)))
+    return sorted(words)
+
+
+class FixtureServer:
+    """
+    Serves the fixture pages at /<question>/<page>.html, with every
+    paragraph marked with the question number.
+    """
+
+    paragraph_start = re.compile(r'<p\b[^>]*>', re.IGNORECASE)
+
+    def __init__(self, pages: Dict[str, str]):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                _, question, name = self.path.split('/', 2)
+                if name not in server.pages:
+                    self.send_error(404)
+                    return
+                html = server.paragraph_start.sub(lambda m: f"{m.group(0)}[{question}] ", server.pages[name])
+                body = html.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.pages = pages
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.httpd.daemon_threads = True
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+
+    def urls(self, question: int) -> List[str]:
+        host, port = self.httpd.server_address[:2]
+        return [f"http://{host}:{port}/{question}/{name}" for name in self.pages]
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def synthetic_text(rng: random.Random, vocabulary: List[str], words: int) -> str:
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
+
+
+def open_corpus(directory: str, name: str, dimensions: int, vocabulary: List[str]):
+    """
+    Open the synthetic corpus of the given size, building (or completing) it first if needed.
+    """
+    from qvdb import VectorDB
+
+    size = corpus_sizes[name]
+    qvdb = VectorDB(db_directory=os.path.join(directory, f"corpus-{name}-{dimensions}d"),
+                    collection_name="bench-corpus",
+                    is_persistent=True,
+                    embed_model=f"bench-hash-{dimensions}",
+                    embedding_function=hash_embedding_function(dimensions))
+    stored = qvdb.collection.count()
+    if stored < size:
+        print(f"Building the {name} corpus in: {qvdb.db_directory} ({stored} of {size} chunks stored)")
+        batch_size = min(5000, qvdb.client.get_max_batch_size())
+        start_time = time.perf_counter()
+        for start in range(stored, size, batch_size):
+            numbers = range(start, min(start + batch_size, size))
+            # Every chunk is generated from a seed of its own, so a corpus can be completed later
+            documents = [synthetic_text(random.Random(number), vocabulary, chunk_words) for number in numbers]
+            qvdb.collection.add(documents=documents,
+                                metadatas=[{'source': f"corpus://{number // 10}"} for number in numbers],
+                                ids=[f"corpus-{number}" for number in numbers],
+                                embeddings=qvdb.embed(documents))
+        print(f"Built the {name} corpus in {time.perf_counter() - start_time:.1f}s")
+    return qvdb
+
+
+def bench_qsearch(args, qvdb, fixtures: FixtureServer, questions: List[str]) -> Dict[str, Any]:
+    """
+    Answer the questions the way qsearch does with --persist: fetch the
+    result pages, store them in the corpus, retrieve, pack and generate.
+    """
+    import qsearch
+    from qpack import TokenCounter
+
+    counter = TokenCounter(args.model)
+    urls = []
+
+    def answer(number: int, question: str, timings: Timings) -> None:
+        question_start = time.perf_counter()
+        with timings.timed('fetch'):
+            pages = list(qsearch.fetch_and_split_urls(fixtures.urls(number)))
+        with timings.timed('store'):
+            with qvdb.batch_writer(args.batch_size) as writer:
+                for url, text_splits in pages:
+                    urls.append(url)
+                    qsearch.store_documents(writer, text_splits, url)
+        with timings.timed('retrieve'):
+            results = qsearch.query_qvdb(qvdb, question, num_results=args.num_candidates, hybrid=args.hybrid)
+        with timings.timed('pack'):
+            documents = qsearch.pick_results_from_qvdb(results, budget=args.context_tokens, counter=counter)
+
+        generate_start = time.perf_counter()
+        output = qsearch.call_ollama(model=args.model,
+                                     system=qsearch.system,
+                                     prompt=qsearch.template.format(question=question, documents=documents),
+                                     stream=True,
+                                     temperature=0.0)
+        first_token = None
+        for _ in output:
+            if first_token is None:
+                first_token = time.perf_counter() - generate_start
+        timings.add('first_token', first_token)
+        timings.add('generate', time.perf_counter() - generate_start)
+        timings.add('total', time.perf_counter() - question_start)
+
+    # The first question pays for the lazy imports and connections; leave it out
+    for number in range(args.warmup):
+        answer(len(questions) + number, questions[number % len(questions)], Timings())
+
+    timings = Timings()
+    start_time = time.perf_counter()
+    for number, question in enumerate(questions):
+        answer(number, question, timings)
+    elapsed = time.perf_counter() - start_time
+
+    # Leave the corpus as it was for the next run
+    stored = qvdb.collection.get(where={'source': {'$in': urls}}, include=[])
+    if stored['ids']:
+        qvdb.delete(stored['ids'])
+
+    return {
+        'stages': timings.summary(),
+        'throughput': {'questions/s': len(questions) / elapsed},
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def write_movies(path: str, rows: int, vocabulary: List[str]) -> None:
+    """
+    Write a synthetic CSV file of movies in the format of the IMDB dataset qimdb reads.
+    """
+    import qimdb
+
+    genres = sorted(qimdb.genres())
+    rng = random.Random(rows)
+    fields = ['Poster_Link', 'Series_Title', 'Released_Year', 'Certificate', 'Runtime', 'Genre', 'IMDB_Rating',
+              'Overview', 'Meta_score', 'Director', 'Star1', 'Star2', 'Star3', 'Star4', 'No_of_Votes', 'Gross']
+    people = [f"{synthetic_text(rng, vocabulary, 1).title()} {synthetic_text(rng, vocabulary, 1).title()}" for _ in range(200)]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=fields)
+        writer.writeheader()
+        for number in range(rows):
+            writer.writerow({
+                'Poster_Link': f"https://example.com/poster/{number}.jpg",
+                'Series_Title': f"{synthetic_text(rng, vocabulary, 3).title()} {number}",
+                'Released_Year': str(rng.randint(1920, 2024)),
+                'Certificate': 'PG',
+                'Runtime': f"{rng.randint(80, 200)} min",
+                'Genre': ', '.join(rng.sample(genres, rng.randint(1, 3))),
+                'IMDB_Rating': f"{rng.uniform(7.5, 9.3):.1f}",
+                'Overview': synthetic_text(rng, vocabulary, 30),
+                'Meta_score': str(rng.randint(50, 100)),
+                'Director': rng.choice(people),
+                'Star1': rng.choice(people),
+                'Star2': rng.choice(people),
+                'Star3': rng.choice(people),
+                'Star4': rng.choice(people),
+                'No_of_Votes': str(rng.randint(25000, 2000000)),
+                'Gross': '',
+            })
+
+
+def bench_qimdb(args, directory: str, vocabulary: List[str], queries: List[str]) -> Dict[str, Any]:
+    """
+    Index a synthetic movie CSV file the way qimdb does, index it again
+    unchanged, and run filtered similarity searches on it.
+    """
+    import qimdb
+    from qutils import VectorStore
+
+    csv_file = os.path.join(directory, "movies.csv")
+    persist_directory = os.path.join(directory, "qimdb")
+    write_movies(csv_file, args.imdb_rows, vocabulary)
+
+    timings = Timings()
+    v = VectorStore(persist_directory=persist_directory)
+    with timings.timed('index'):
+        qimdb.update_index(v, csv_file, persist_directory, batch_size=256)
+    with timings.timed('reindex'):
+        qimdb.update_index(v, csv_file, persist_directory, batch_size=256)
+
+    genres = sorted(qimdb.genres())
+    rng = random.Random(len(queries))
+    start_time = time.perf_counter()
+    for query in queries:
+        first_year = rng.randint(1920, 2000)
+        search_args = Namespace(title=None, genre=rng.choice(genres), rating=str(rng.choice([7.5, 8.0, 8.5])),
+                                stars=None, director=None, release_year=f"{first_year}-{first_year + 20}",
+                                story=query, num_of_results=3)
+        with timings.timed('search'):
+            qimdb.similarity_search(v, search_args)
+    elapsed = time.perf_counter() - start_time
+
+    return {
+        'stages': timings.summary(),
+        'throughput': {
+            'rows/s': args.imdb_rows / timings.samples['index'][0],
+            'searches/s': len(queries) / elapsed,
+        },
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def calibrate(runs: int = 5) -> float:
+    """
+    The median seconds of a fixed workload of tokenizing, sorting and JSON,
+    as the pipelines do, to tell whether timings were taken on a machine as fast.
+    """
+    rng = random.Random(0)
+    words = [''.join(rng.choice('abcdefghij') for _ in range(6)) for _ in range(2000)]
+    text = ' '.join(words)
+
+    def workload():
+        for _ in range(20):
+            tokens = tokenize(text)
+            json.loads(json.dumps(sorted(tokens)))
+
+    samples = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        workload()
+        samples.append(time.perf_counter() - start_time)
+    return percentile(samples, 50)
+
+
+def report(results: Dict[str, Any], baseline: Dict[str, Any], tolerance: float) -> List[str]:
+    """
+    Print the results next to the baseline, returning the stages that regressed.
+    """
+    regressions = []
+    for section, result in results.items():
+        base = baseline.get(section, {})
+        print(f"\n{section}  (peak RSS: {result['peak_rss_mb']:.0f} MB, "
+              + ', '.join(f"{value:.1f} {unit}" for unit, value in result['throughput'].items()) + ")")
+        print(f"  {'stage':<12} {'n':>4} {'p50 ms':>10} {'p95 ms':>10} {'base p50':>10} {'base p95':>10}  status")
+        for stage, stats in result['stages'].items():
+            base_stats = base.get('stages', {}).get(stage)
+            if base_stats is None:
+                status, base_columns = "no baseline", f"{'-':>10} {'-':>10}"
+            else:
+                base_columns = f"{base_stats['p50'] * 1000:>10.2f} {base_stats['p95'] * 1000:>10.2f}"
+                # A stage regresses when both its typical and its tail latency got worse
+                slower = all(stats[p] > base_stats[p] * (1 + tolerance) for p in ('p50', 'p95'))
+                status = "SLOWER" if slower else "ok"
+                if slower:
+                    regressions.append(f"{section}/{stage}")
+            print(f"  {stage:<12} {stats['n']:>4} {stats['p50'] * 1000:>10.2f} {stats['p95'] * 1000:>10.2f} {base_columns}  {status}")
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark the qsearch and qimdb pipelines end to end, offline')
+    parser.add_argument('--corpus', default='1k', help=f"Comma separated corpus sizes, of: {', '.join(corpus_sizes)} (default: 1k)")
+    parser.add_argument('--questions', type=int, default=20, help='Number of questions per corpus (default: 20)')
+    parser.add_argument('--warmup', type=int, default=1, help='Number of unmeasured questions to start with (default: 1)')
+    parser.add_argument('--dimensions', type=int, default=384, help='Number of dimensions of the embeddings (default: 384)')
+    parser.add_argument('--token-delay', type=float, default=0.002, help='Seconds per token generated by the fake Ollama (default: 0.002)')
+    parser.add_argument('--response-words', type=int, default=100, help='Number of words of the generated answers (default: 100)')
+    parser.add_argument('--imdb-rows', type=int, default=1000, help='Number of movies in the qimdb benchmark, 0 to skip it (default: 1000)')
+    parser.add_argument('--hybrid', action='store_true', help='Retrieve with hybrid (dense and BM25) search')
+    parser.add_argument('--num-candidates', type=int, default=10, help='Number of chunks to retrieve (default: 10)')
+    parser.add_argument('--context-tokens', type=int, default=2048, help='Max number of tokens of documents in the prompt (default: 2048)')
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of documents to embed and store per batch (default: 64)')
+    parser.add_argument('--model', default='llama3', help='Model name passed to the fake Ollama (default: llama3)')
+    parser.add_argument('--directory', default='./qcache/bench', help='Directory of the synthetic corpora (default: ./qcache/bench)')
+    parser.add_argument('--tolerance', type=float, default=0.25, help='Allowed slowdown relative to the baseline (default: 0.25)')
+    parser.add_argument('--record', action='store_true', help=f'Record the results as the new baseline, in {baseline_name} in the directory')
+    args = parser.parse_args()
+
+    args.corpora = [name.strip() for name in args.corpus.split(',') if name.strip()]
+    unknown = [name for name in args.corpora if name not in corpus_sizes]
+    if unknown:
+        parser.error(f"Unknown corpus size: {', '.join(unknown)}")
+    return args
+
+
+def main(args) -> int:
+    # Measure the pipelines, not the caches
+    os.environ['QAI_EMBED_CACHE'] = 'off'
+    os.environ['QAI_HTTP_CACHE'] = 'off'
+
+    import qollama
+
+    settings = {name: getattr(args, name) for name in compared_settings}
+    baseline_file = os.path.join(args.directory, baseline_name)
+    baseline: Dict[str, Any] = {}
+    calibration = calibrate()
+    if os.path.exists(baseline_file):
+        with open(baseline_file) as f:
+            baseline = json.load(f)
+        if baseline.get('settings') != settings and not args.record:
+            print(f"Warning: The baseline was recorded with other settings: {baseline.get('settings')}")
+        ratio = calibration / baseline.get('calibration', calibration)
+        if abs(ratio - 1) > calibration_tolerance and not args.record:
+            print(f"Warning: The calibration took {ratio:.2f} times as long as when the baseline was recorded; "
+                  f"the machine or its load differs, so the timings don't compare")
+    elif not args.record:
+        print(f"No baseline in {baseline_file} yet; record one with --record")
+
+    pages = load_fixtures()
+    vocabulary = fixture_vocabulary(pages)
+    rng = random.Random(0)
+    questions = [synthetic_text(rng, vocabulary, 8) + '?' for _ in range(args.questions)]
+
+    response = ' '.join(vocabulary[i % len(vocabulary)] for i in range(args.response_words))
+    fake = FakeOllama(token_delay=args.token_delay, response=response, dimensions=args.dimensions).start()
+    qollama.configure_scheduler(host=fake.host)
+    fixtures = FixtureServer(pages)
+
+    results = {}
+    try:
+        for name in args.corpora:
+            qvdb = open_corpus(args.directory, name, args.dimensions, vocabulary)
+            results[f"qsearch/{name}"] = bench_qsearch(args, qvdb, fixtures, questions)
+        if args.imdb_rows:
+            with tempfile.TemporaryDirectory() as directory:
+                results[f"qimdb/{args.imdb_rows}"] = bench_qimdb(args, directory, vocabulary, questions)
+    finally:
+        fixtures.stop()
+        fake.stop()
+
+    regressions = report(results, baseline, args.tolerance)
+
+    if args.record:
+        baseline['settings'] = settings
+        baseline['calibration'] = calibration
+        baseline.update(results)
+        os.makedirs(args.directory, exist_ok=True)
+        with open(baseline_file, 'w') as f:
+            json.dump(baseline, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"\nRecorded baseline in: {baseline_file}")
+    elif regressions:
+        print(f"\nError: Slower than the baseline: {', '.join(regressions)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
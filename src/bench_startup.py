@@ -0,0 +1,91 @@
+#
+# Startup benchmark: measures how long it takes to import each of the
+# entry points in a fresh Python process, and fails if any of them is
+# slower than the budget recorded in startup_budget.json.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_startup.py            # check against the budget
+#   $ ./pyvenv/bin/python3 ./src/bench_startup.py --record   # record a new budget
+#
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+from typing import Dict, List
+
+src_directory = os.path.dirname(os.path.abspath(__file__))
+budget_file = os.path.join(src_directory, "startup_budget.json")
+
+# Modules that can be imported without side effects (qai.py and qai_pdf.py
+# run their programs at import time).
+entry_points = ['qclient', 'qembed', 'qutils', 'qvdb', 'qsearch', 'qimdb', 'qserver', 'qagent', 'qdad', 'qdraw']
+
+measure_import = """
+import time
+start_time = time.perf_counter()
+import {module}
+print(time.perf_counter() - start_time)
+"""
+
+
+def import_time(module: str, runs: int) -> float:
+    """
+    Return the median time, in seconds, of importing the module in a fresh process.
+    """
+    times = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", measure_import.format(module=module)],
+            cwd=src_directory, capture_output=True, text=True, check=True
+        ).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+    return statistics.median(times)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Measure the import time of the entry points')
+    parser.add_argument('--runs', type=int, default=5, help='Number of imports to take the median of (default: 5)')
+    parser.add_argument('--record', action='store_true', help=f'Record a new budget in {os.path.basename(budget_file)}')
+    parser.add_argument('--headroom', type=float, default=2.0, help='Budget as a multiple of the measured time when recording (default: 2.0)')
+    parser.add_argument('modules', nargs='*', default=entry_points, help='Modules to measure (default: all entry points)')
+    return parser.parse_args()
+
+
+def main(args) -> int:
+    budget: Dict[str, float] = {}
+    if os.path.exists(budget_file):
+        with open(budget_file) as f:
+            budget = json.load(f)
+
+    failed: List[str] = []
+    for module in args.modules:
+        seconds = import_time(module, args.runs)
+        if args.record:
+            # Never record a budget so tight that it is just measuring noise.
+            budget[module] = round(max(seconds * args.headroom, 0.05), 3)
+        limit = budget.get(module)
+        if limit is None:
+            status = "no budget"
+        elif seconds > limit:
+            status = "OVER BUDGET"
+            failed.append(module)
+        else:
+            status = "ok"
+        print(f"{module:10} {seconds * 1000:8.1f} ms  (budget: {limit * 1000 if limit else 0:8.1f} ms)  {status}")
+
+    if args.record:
+        with open(budget_file, 'w') as f:
+            json.dump(budget, f, indent=4, sort_keys=True)
+            f.write("\n")
+        print(f"Recorded budget in: {budget_file}")
+    elif failed:
+        print(f"Error: Import time over budget for: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,139 @@
+#
+# Vector search benchmark: exact search with NumPy (qflat) against Chroma's
+# HNSW index, for in-memory collections of growing size, to find where
+# building the approximate index starts to pay off (see default_ann_threshold
+# in qvdb.py). It pays off only when a collection is queried often enough:
+# raise --queries to find that point for a size.
+#
+# For every size it measures building the collection (for Chroma that
+# includes creating the client and the collection), the latency of a single
+# query, the time per query of a batch of queries, and the recall@k of
+# Chroma's results. The crossover is the smallest size where Chroma's build
+# plus queries take less time than exact search does.
+#
+# With --quantization it also measures quantized flat indexes (see qquant):
+# their memory for the embeddings and their recall@k against exact search.
+#
+# Usage:
+#
+#   $ ./pyvenv/bin/python3 ./src/bench_vdb.py
+#   $ ./pyvenv/bin/python3 ./src/bench_vdb.py --sizes 1000,100000 --dimensions 768 --queries 100
+#   $ ./pyvenv/bin/python3 ./src/bench_vdb.py --quantization int8,pq --rerank 4 --no-chroma
+#
+import time
+import argparse
+import statistics
+from typing import Any, Callable, Dict, List, Optional
+
+from qflat import FlatCollection, FlatIndex
+from qquant import QuantizedIndex, recall_at_k
+
+
+def median_time(func: Callable[[], Any], runs: int) -> float:
+    times = []
+    for _ in range(runs):
+        start_time = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def bench_flat(ids: List[str], vectors: Any, queries: Any, k: int, runs: int, index: Optional[FlatIndex] = None) -> Dict[str, Any]:
+    start_time = time.perf_counter()
+    collection = FlatCollection("bench-flat", index)
+    collection.add(ids=ids, embeddings=vectors, documents=ids, metadatas=None)
+    build = time.perf_counter() - start_time
+    nbytes = collection.index.nbytes() if isinstance(collection.index, QuantizedIndex) else vectors.nbytes
+
+    single = median_time(lambda: collection.query(query_embeddings=queries[:1], n_results=k), runs)
+    batch = median_time(lambda: collection.query(query_embeddings=queries, n_results=k), runs) / len(queries)
+    results = collection.query(query_embeddings=queries, n_results=k)['ids']
+    return {'build': build, 'single': single, 'batch': batch, 'results': results, 'nbytes': nbytes}
+
+
+def bench_chroma(ids: List[str], vectors: Any, queries: Any, k: int, runs: int) -> Dict[str, Any]:
+    import chromadb
+    from chromadb.config import Settings
+
+    start_time = time.perf_counter()
+    client = chromadb.Client(Settings(anonymized_telemetry=False, is_persistent=False, allow_reset=True))
+    collection = client.get_or_create_collection(name="bench-chroma", metadata={"hnsw:space": "cosine"}, embedding_function=None)
+    batch_size = client.get_max_batch_size()
+    for start in range(0, len(ids), batch_size):
+        collection.add(ids=ids[start:start + batch_size],
+                       embeddings=vectors[start:start + batch_size],
+                       documents=ids[start:start + batch_size])
+    build = time.perf_counter() - start_time
+
+    query_list = queries.tolist()
+    single = median_time(lambda: collection.query(query_embeddings=query_list[:1], n_results=k), runs)
+    batch = median_time(lambda: collection.query(query_embeddings=query_list, n_results=k), runs) / len(queries)
+    results = collection.query(query_embeddings=query_list, n_results=k)['ids']
+    client.delete_collection("bench-chroma")
+    return {'build': build, 'single': single, 'batch': batch, 'results': results, 'nbytes': None}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Compare exact NumPy search with Chroma for in-memory collections')
+    parser.add_argument('--sizes', default='100,1000,5000,20000,50000,100000,150000', help='Comma separated collection sizes (default: 100,1000,5000,20000,50000,100000,150000)')
+    parser.add_argument('--dimensions', type=int, default=384, help='Number of dimensions of the embeddings (default: 384)')
+    parser.add_argument('--queries', type=int, default=10, help='Number of queries per collection, as by one question (default: 10)')
+    parser.add_argument('-k', type=int, default=6, help='Number of results per query (default: 6)')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs to take the median query time of (default: 5)')
+    parser.add_argument('--quantization', default='', help='Comma separated quantizations to measure too: int8, pq (default: none)')
+    parser.add_argument('--rerank', type=int, default=4, help='Candidates per result reranked at full precision by quantized indexes (default: 4)')
+    parser.add_argument('--seed', type=int, default=0, help='Seed of the synthetic embeddings (default: 0)')
+    parser.add_argument('--no-chroma', action='store_true', help='Leave out Chroma, which is slow to build for large sizes')
+    return parser.parse_args()
+
+
+def main(args) -> None:
+    import numpy as np
+
+    sizes = [int(size) for size in args.sizes.split(',')]
+    quantizations = [name for name in args.quantization.split(',') if name]
+    # Embeddings spanning fewer directions than they have dimensions, with
+    # noise, as real ones do; on plain noise quantization finds no structure
+    basis = np.random.default_rng([args.seed, 0]).standard_normal((args.dimensions // 8, args.dimensions))
+
+    def embeddings(count: int, stream: int) -> Any:
+        # A generator of their own per collection size, so the embeddings of
+        # a size are the same whatever other sizes and options are measured
+        rng = np.random.default_rng([args.seed, stream])
+        return (rng.standard_normal((count, len(basis))) @ basis
+                + 0.5 * rng.standard_normal((count, args.dimensions))).astype(np.float32)
+
+    queries = embeddings(args.queries, 1)
+
+    print(f"{'size':>8} {'backend':>8} {'build ms':>10} {'query ms':>10} {'batch ms/q':>11} "
+          f"{'total ms':>10} {'MiB':>8} {'recall@' + str(args.k):>9}")
+    crossover = None
+    for size in sizes:
+        ids = [str(i) for i in range(size)]
+        vectors = embeddings(size, 2 + size)
+        results = {'flat': bench_flat(ids, vectors, queries, args.k, args.runs)}
+        for quantization in quantizations:
+            results[quantization] = bench_flat(ids, vectors, queries, args.k, args.runs,
+                                               QuantizedIndex(quantization, rerank=args.rerank))
+        if not args.no_chroma:
+            results['chroma'] = bench_chroma(ids, vectors, queries, args.k, args.runs)
+        for name, result in results.items():
+            result['recall'] = recall_at_k(results['flat']['results'], result['results'])
+            # Building the collection and asking the queries one at a time
+            result['total'] = result['build'] + args.queries * result['single']
+            memory = f"{result['nbytes'] / 2**20:.2f}" if result['nbytes'] is not None else '-'
+            print(f"{size:>8} {name:>8} {result['build'] * 1000:>10.1f} {result['single'] * 1000:>10.3f} "
+                  f"{result['batch'] * 1000:>11.3f} {result['total'] * 1000:>10.1f} {memory:>8} {result['recall']:>9.3f}")
+        if 'chroma' in results and crossover is None and results['chroma']['total'] < results['flat']['total']:
+            crossover = size
+
+    if args.no_chroma:
+        return
+    if crossover:
+        print(f"\nChroma is faster from {crossover} documents on, for {args.queries} queries per collection")
+    else:
+        print(f"\nExact search is faster for all sizes up to {sizes[-1]}, for {args.queries} queries per collection")
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -0,0 +1,221 @@
+#
+# A fake Ollama server, for testing and benchmarking without a GPU.
+#
+# It speaks enough of the Ollama API (/api/generate, /api/chat, /api/embed
+# and /api/embeddings) for the ollama client and qollama: embeddings are
+# deterministic (derived from a hash of the text) and responses are canned,
+# streamed a word at a time with a configurable delay. Requests can be made
+# to fail, and the server keeps count of what it was asked to do.
+#
+# Example:
+#
+#   $ ./pyvenv/bin/python3 ./src/fakeollama.py --port 11435 --token-delay 0.02 &
+#   $ OLLAMA_HOST=127.0.0.1:11435 ./pyvenv/bin/python3 ./src/qsearch.py --no-search -q "Why is the sky blue?"
+#
+import json
+import math
+import time
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import (
+    Any,
+    Dict,
+    List,
+)
+
+
+def fake_embedding(text: str, dimensions: int = 16) -> List[float]:
+    """
+    A deterministic, normalized embedding of the text.
+    """
+    digest = b''
+    counter = 0
+    while len(digest) < dimensions:
+        digest += hashlib.sha256(f"{counter}:{text}".encode('utf-8')).digest()
+        counter += 1
+    vector = [byte / 255.0 - 0.5 for byte in digest[:dimensions]]
+    norm = math.sqrt(sum(x * x for x in vector)) or 1.0
+    return [x / norm for x in vector]
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        fake = self.server.fake
+        length = int(self.headers.get('Content-Length', 0))
+        request = json.loads(self.rfile.read(length) or b'{}')
+        model = request.get('model', '')
+
+        fake.enter(self.path, model, request)
+        try:
+            if fake.should_fail():
+                self.reply(fake.fail_status, {'error': 'fake failure'})
+                return
+            time.sleep(fake.delay)
+            if self.path == '/api/embed':
+                inputs = request.get('input', '')
+                inputs = [inputs] if isinstance(inputs, str) else inputs
+                self.reply(200, {'model': model, 'embeddings': [fake_embedding(text, fake.dimensions) for text in inputs]})
+            elif self.path == '/api/embeddings':
+                self.reply(200, {'embedding': fake_embedding(request.get('prompt', ''), fake.dimensions)})
+            elif self.path in ('/api/generate', '/api/chat'):
+                self.generate(request)
+            else:
+                self.reply(404, {'error': f'unknown path: {self.path}'})
+        finally:
+            fake.leave(model)
+
+    def generate(self, request: Dict[str, Any]):
+        fake = self.server.fake
+        chat = self.path == '/api/chat'
+        prompt = request.get('prompt') or ''
+        if chat:
+            prompt = ' '.join(message.get('content', '') for message in request.get('messages', []))
+        # An empty prompt just loads the model
+        tokens = [f"{word} " for word in fake.response.split()] if prompt or chat else []
+        context = list(request.get('context') or []) + list(range(len(prompt) // 4 + len(tokens)))
+
+        def chunk(token: str, done: bool) -> Dict[str, Any]:
+            part = {'model': request.get('model', ''), 'created_at': '2024-01-01T00:00:00Z', 'done': done}
+            if chat:
+                part['message'] = {'role': 'assistant', 'content': token}
+            else:
+                part['response'] = token
+            if done:
+                part.update(done_reason='stop', eval_count=len(tokens), eval_duration=int(fake.token_delay * len(tokens) * 1e9) or 1)
+                if not chat:
+                    part['context'] = context
+            return part
+
+        if request.get('stream', True):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for token in tokens:
+                time.sleep(fake.token_delay)
+                self.write_chunk(json.dumps(chunk(token, False)).encode('utf-8') + b'\n')
+            self.write_chunk(json.dumps(chunk('', True)).encode('utf-8') + b'\n')
+            self.write_chunk(b'')
+        else:
+            time.sleep(fake.token_delay * len(tokens))
+            self.reply(200, chunk(''.join(tokens), True))
+
+    def write_chunk(self, data: bytes):
+        self.wfile.write(f"{len(data):x}\r\n".encode('ascii') + data + b"\r\n")
+        self.wfile.flush()
+
+    def reply(self, status: int, body: Dict[str, Any]):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakeOllama:
+    """
+    A fake Ollama server running in a background thread.
+
+    Attributes:
+        delay: Seconds before answering a request.
+        token_delay: Seconds per generated token.
+        response: The text every generation responds with.
+        fail_first: Number of requests to fail (with fail_status) before succeeding.
+        requests: The (path, model, request) of every request received.
+        max_concurrent: The max number of concurrent requests seen per model.
+    """
+
+    def __init__(self,
+                 host: str = '127.0.0.1',
+                 port: int = 0,
+                 delay: float = 0.0,
+                 token_delay: float = 0.0,
+                 response: str = "This is a fake response.",
+                 fail_first: int = 0,
+                 fail_status: int = 503,
+                 dimensions: int = 16
+                 ):
+        self.delay = delay
+        self.token_delay = token_delay
+        self.response = response
+        self.fail_first = fail_first
+        self.fail_status = fail_status
+        self.dimensions = dimensions
+        self.requests = []
+        self.concurrent: Dict[str, int] = {}
+        self.max_concurrent: Dict[str, int] = {}
+        self.lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.fake = self
+        self.thread = None
+
+    @property
+    def host(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> 'FakeOllama':
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def enter(self, path: str, model: str, request: Dict[str, Any]) -> None:
+        with self.lock:
+            self.requests.append((path, model, request))
+            self.concurrent[model] = self.concurrent.get(model, 0) + 1
+            self.max_concurrent[model] = max(self.max_concurrent.get(model, 0), self.concurrent[model])
+
+    def leave(self, model: str) -> None:
+        with self.lock:
+            self.concurrent[model] -= 1
+
+    def should_fail(self) -> bool:
+        with self.lock:
+            if self.fail_first > 0:
+                self.fail_first -= 1
+                return True
+            return False
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a fake Ollama server')
+    parser.add_argument('--host', default='127.0.0.1', help='Interface to listen on (default: 127.0.0.1)')
+    parser.add_argument('--port', type=int, default=11435, help='Port to listen on (default: 11435)')
+    parser.add_argument('--delay', type=float, default=0.0, help='Seconds before answering a request (default: 0.0)')
+    parser.add_argument('--token-delay', type=float, default=0.0, help='Seconds per generated token (default: 0.0)')
+    parser.add_argument('--response', default="This is a fake response.", help='The text every generation responds with')
+    return parser.parse_args()
+
+
+def main(args):
+    fake = FakeOllama(args.host, args.port, delay=args.delay, token_delay=args.token_delay, response=args.response)
+    print(f"fake Ollama listening at: {fake.host}")
+    try:
+        fake.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        fake.httpd.server_close()
+
+
+if __name__ == '__main__':
+    main(parse_args())
@@ -2,10 +2,13 @@
 #  https://huggingface.co/blog/open-source-llms-as-agents
 #  https://iamajithkumar.medium.com/working-with-faiss-for-similarity-search-59b197690f6c
 import os
-import ollama
+import json
+import qollama
 import textwrap
-from googlesearch import search
+import threading
+from typing import Any, Callable, Dict, List, Optional
 from qutils import extract_json_objects, VectorStore, print_verbose
+from qtools import ToolExecutor, ToolRegistry, default_max_steps, default_time_budget, tool_calls
 
 
 
@@ -21,12 +24,12 @@ example_json = """
 template = """
 Here is a question: {question}
 You have access to these tools:
-    - convert_time: converts a time given in hours:minutes:seconds into seconds.
-    - search: searches the web for the answer to the question
+{tools}
 
 You should first reflect with ‘Thought: {your_thoughts}’, then you either:
     - if you don't know the answer: call a tool with the proper JSON formatting, any reply from the tool can be found in the 'Observation' section.
-    - if you know the answer: print your final answer starting with the prefix: ‘Final Answer:’ 
+      To call several tools at once, write one JSON object per call.
+    - if you know the answer: print your final answer starting with the prefix: ‘Final Answer:’
 
 Here is an example of the JSON formatting for calling a tool:
 
@@ -36,52 +39,120 @@ Action:
 {observation}
 """
 
-def main():
-    # Get the value of the environment variable 'USE_MODEL'
-    # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
-    model = os.getenv('USE_MODEL', 'mistral')
 
-    question = input("Enter a question: ")
-    
-    chat_history = []  # Initialize your chat history
+def convert_time(action_input: Dict[str, Any]) -> str:
+    # hours:minutes:seconds, minutes:seconds or seconds
+    seconds = 0.0
+    for part in str(action_input['time']).strip().split(':'):
+        seconds = seconds * 60 + float(part)
+    return f"{seconds:g} seconds"
+
+
+class WebSearch:
+    """
+    The search tool: searches the web, and returns the passages of the pages
+    found that are the most similar to the query. The pages are kept in one
+    vector store for all the searches, so a page found again is neither
+    fetched nor embedded again.
+    """
+
+    def __init__(self, num_results: int = 3):
+        self.num_results = num_results
+        self.store: Optional[VectorStore] = None
+        self.lock = threading.Lock()
+
+    def vector_store(self) -> VectorStore:
+        with self.lock:
+            if self.store is None:
+                self.store = VectorStore()
+                self.store.open()
+            return self.store
+
+    def __call__(self, action_input: Dict[str, Any]) -> str:
+        query = action_input['query']
+        print_verbose(f"<info> Performing Google search for: {query}")
+        store = self.vector_store()
+        urls = store.search_and_store(query)
+        if not urls:
+            return "Nothing was found"
+        similarity_result = store.similarity_search(query=query, num_results=self.num_results,
+                                                    where={'source': {'$in': urls}})
+        return "\n".join([result.page_content.strip() for result in similarity_result])
+
+
+def tool_registry() -> ToolRegistry:
+    registry = ToolRegistry()
+    registry.register('convert_time', "converts a time given in hours:minutes:seconds into seconds.", convert_time)
+    registry.register('search', "searches the web for the answer to the question", WebSearch())
+    return registry
+
+
+def answer(question: str,
+           executor: ToolExecutor,
+           generate: Callable[[str], str]) -> Optional[str]:
+    """
+    Let the model answer the question, calling tools, within the budget of the executor.
+
+    Args:
+        question: The question.
+        executor: Carries out the tool calls.
+        generate: Returns the model's response to a prompt.
+
+    Returns:
+        The final answer, or None if there is none within the budget.
+    """
+    executor.start()
     observation = ""
-    while True:
-        prompt = template.format(question=question, your_thoughts="{your_thoughts}", example_json=example_json, observation=observation)
-        output = ollama.generate(model=model, prompt=prompt, stream=False)
-        response = output['response'].strip()
+    while executor.step():
+        prompt = template.format(question=question, tools=executor.registry.describe(), your_thoughts="{your_thoughts}",
+                                 example_json=example_json, observation=observation)
+        response = generate(prompt).strip()
 
         # Check if the response contains 'Final Answer:'
         if 'Final Answer:' in response:
-            # Split the response at 'Final Answer:' and print the second part
-            final_answer = response.split('Final Answer:', 1)[1]
-            print("Answer:")
-            print("\n".join([textwrap.fill(line, width=62, break_long_words=False) for line in final_answer.split('\n')]))
-            break  # Exit the loop
+            # Split the response at 'Final Answer:' and return the second part
+            return response.split('Final Answer:', 1)[1]
 
-        search_result = ""
         # Check if the response contains 'Action:'
         if 'Action:' in response:
-            # Convert it to proper JSON format
-            json_text = response.replace("'", '"')
-
-            # Extract JSON objects
-            for data in extract_json_objects(json_text):
-                print_verbose("<info> Extracted JSON object: ", data)
-
-                # If the JSON object contains an 'action_input' key, and 'query' is in 'action_input',
-                # perform a Google search and store the content in the VectorStore, then perform a
-                # similarity search.
-                if 'action_input' in data and 'query' in data['action_input']:
-                    query = data['action_input']['query']
-                    print_verbose(f"<info> Performing Google search for: {query}")
-                    v = VectorStore()
-                    v.search_and_store(query)
-                    similarity_result = v.similarity_search(query=query, num_results=3)
-                    search_result = "\n".join([result.page_content.strip() for result in similarity_result])
-
-        if search_result:
-            observation = f"Observation: {search_result}"
+            calls = tool_calls(extract_json_objects(response))
+            for call in calls:
+                print_verbose("<info> Tool call: ", call)
+            # Independent calls are carried out concurrently
+            results = executor.run(calls)
+            if len(calls) == 1:
+                observation = f"Observation: {results[0]}"
+            elif calls:
+                observation = "\n".join(f"Observation of {name} {json.dumps(action_input)}: {result}"
+                                        for (name, action_input), result in zip(calls, results))
             print_verbose(f"{observation}")
+    return None
+
+
+def main():
+    # Get the value of the environment variable 'USE_MODEL'
+    # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
+    model = os.getenv('USE_MODEL', 'mistral')
+
+    # A model going round in circles is stopped after AGENT_MAX_STEPS turns or AGENT_TIME_BUDGET seconds
+    executor = ToolExecutor(tool_registry(),
+                            max_steps=int(os.getenv('AGENT_MAX_STEPS', default_max_steps)),
+                            time_budget=float(os.getenv('AGENT_TIME_BUDGET', default_time_budget)))
+
+    question = input("Enter a question: ")
+
+    def generate(prompt: str) -> str:
+        return qollama.generate(model=model, prompt=prompt, stream=False)['response']
+
+    try:
+        final_answer = answer(question, executor, generate)
+    finally:
+        executor.close()
+    if final_answer is None:
+        print(f"No answer within {executor.steps} steps and {executor.time_budget:g} seconds")
+        return
+    print("Answer:")
+    print("\n".join([textwrap.fill(line, width=62, break_long_words=False) for line in final_answer.split('\n')]))
 
 
 if __name__ == "__main__":
@@ -1,23 +1,63 @@
 import streamlit as st
 import os
-import PyPDF2
 from langchain_community.vectorstores import Chroma
-from langchain_community.embeddings import OllamaEmbeddings
-from io import BytesIO
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.chat_models import ChatOllama
-
-# Function to split PDF text into chunks
-def split_pdf_text(pdf_file):
-    pdf_reader = PyPDF2.PdfReader(pdf_file)
-    num_pages = len(pdf_reader.pages)
-    text_chunks = []
-    for page_number in range(num_pages):
-        page = pdf_reader.pages[page_number]
-        text_chunks.append(page.extract_text())
-    return text_chunks
+from langchain_core.runnables import RunnableLambda
+from qpack import TokenCounter, pack_chunks
+from qembed import CachedEmbeddings, get_embedding_cache
+from qollama import ScheduledEmbeddings
+from qflat import FlatStore
+from qvdb import default_ann_threshold
+from qingest import content_hash, extract_pages, split_pages
+
+# Function to pack the retrieved documents into the context token budget.
+# It runs in a worker thread of the chain, so the packing is passed on
+# through the chain output rather than set in the session state here.
+def pack_context(documents, budget, counter):
+    chunks = [{'text': doc.page_content, 'source': (doc.metadata.get('source'), doc.metadata.get('page')), 'distance': rank}
+              for rank, doc in enumerate(documents)]
+    return pack_chunks(chunks, budget=budget, counter=counter)
+
+# Function to write the packed chunks as the context of the prompt
+def format_context(packed):
+    return "\n\n".join(f"[{chunk['source'][0]}, page {chunk['source'][1]}]\n{chunk['text']}" for chunk in packed['chunks'])
+
+# Build the vector store for a set of PDFs. Streamlit reruns this script on
+# every interaction, so the store is cached across reruns (and sessions),
+# keyed by the content hashes of the PDFs: asking another question then only
+# costs embedding the question.
+@st.cache_resource(show_spinner="Indexing your PDFs...")
+def load_vectorstore(content_hashes, _pdfs):
+    texts = []
+    metadatas = []
+    for name, pdf_contents in _pdfs:
+        # Extract the pages in parallel, then split them into overlapping chunks
+        pages = extract_pages(pdf_contents)
+        pdf_texts, pdf_metadatas = split_pages(pages, source=name)
+        texts.extend(pdf_texts)
+        metadatas.extend(pdf_metadatas)
+
+    embedding = ScheduledEmbeddings(model="nomic-embed-text")
+    embed_cache = get_embedding_cache()
+    if embed_cache:
+        embedding = CachedEmbeddings(embedding, model="ollama-embed:nomic-embed-text", cache=embed_cache)
+
+    # The chunks of a session's PDFs are searched faster exhaustively than by
+    # building an HNSW index for them (see qflat and bench_vdb.py)
+    if default_ann_threshold is None or len(texts) <= default_ann_threshold:
+        return FlatStore.from_texts(texts=texts, embedding=embedding, metadatas=metadatas)
+
+    # Every set of PDFs gets a collection of its own
+    collection_name = "pdfs-" + content_hash("".join(content_hashes).encode())[:32]
+    return Chroma.from_texts(
+        texts=texts,
+        metadatas=metadatas,
+        embedding=embedding,
+        collection_name=collection_name
+    )
 
 st.set_page_config(page_title="Ask your PDFs")
 st.header("Ask your PDFs 💬")
@@ -26,8 +66,8 @@ st.header("Ask your PDFs 💬")
 if 'uploaded_files' not in st.session_state:
     st.session_state['uploaded_files'] = []
 
-if 'splits' not in st.session_state:
-    st.session_state['splits'] = []
+if 'pdfs' not in st.session_state:
+    st.session_state['pdfs'] = []
 
 # If no files have been uploaded yet, show the file uploader
 if not st.session_state['uploaded_files']:
@@ -39,43 +79,41 @@ if not st.session_state['uploaded_files']:
         st.session_state['files_uploaded'] = True
 
         for uploaded_file in uploaded_files:
-            # Read the file contents
-            pdf_contents = uploaded_file.read()
-            
-            # Convert bytes to file-like object
-            pdf_file = BytesIO(pdf_contents)
-
             if uploaded_file.type == "application/pdf":
-                # Split PDF text into chunks
-                text_chunks = split_pdf_text(pdf_file)
-
-            # Add the chunks to the session state
-            st.session_state['splits'].extend(text_chunks)
+                # Keep the file contents, they are indexed once below
+                st.session_state['pdfs'].append((uploaded_file.name, uploaded_file.read()))
 
 # Load the embeddings
-if st.session_state['splits']:
-    # Pass the text chunks directly to Chroma
-    vectorstore = Chroma.from_texts(
-        texts=st.session_state['splits'],
-        embedding=OllamaEmbeddings(model="nomic-embed-text")
-    )
-    retriever = vectorstore.as_retriever()
+if st.session_state['pdfs']:
+    pdfs = st.session_state['pdfs']
+    vectorstore = load_vectorstore(tuple(content_hash(contents) for _, contents in pdfs), pdfs)
 
     # Get the value of the environment variable 'USE_MODEL'
     # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
     model = os.getenv('USE_MODEL', 'mistral')
     model_local = ChatOllama(model=model)
 
+    # Retrieve a few more chunks than fit, then pack the best of them
+    # into the token budget of the context (QAI_CONTEXT_TOKENS).
+    context_tokens = int(os.getenv('QAI_CONTEXT_TOKENS', 2048))
+    counter = TokenCounter(model)
+    retriever = vectorstore.as_retriever(search_kwargs={"k": 8})
+    packer = RunnableLambda(lambda documents: pack_context(documents, context_tokens, counter))
+
     after_rag_template = """Answer the question based only on the following context:
         {context}
         Question: {question}
         """
     after_rag_prompt = ChatPromptTemplate.from_template(after_rag_template)
+    # The output carries the packing along with the answer
     after_rag_chain = (
-        {"context": retriever, "question": RunnablePassthrough()}
-        | after_rag_prompt
-        | model_local
-        | StrOutputParser()
+        {"packing": retriever | packer, "question": RunnablePassthrough()}
+        | RunnablePassthrough.assign(answer=(
+            RunnableLambda(lambda inputs: {"context": format_context(inputs["packing"]), "question": inputs["question"]})
+            | after_rag_prompt
+            | model_local
+            | StrOutputParser()
+        ))
     )
 
 
@@ -86,6 +124,12 @@ if 'files_uploaded' in st.session_state and st.session_state['files_uploaded']:
 
     # If user_input is not empty
     if user_input:
-        stream = after_rag_chain.invoke(user_input)
-        st.write(stream)
+        result = after_rag_chain.invoke(user_input)
+        st.write(result['answer'])
+        # Set in the script thread, where Streamlit has the session state
+        st.session_state['packing'] = result['packing']
+        packed = result['packing']
+        if packed:
+            st.caption(f"Context: {packed['packed_tokens']} tokens packed, "
+                       f"{packed['dropped_tokens']} tokens dropped")
 
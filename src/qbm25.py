@@ -0,0 +1,166 @@
+#
+# A small in-process BM25 index, used by VectorDB for hybrid retrieval.
+#
+# Dense (embedding) retrieval is good at meaning but often misses exact
+# names, titles and error codes, which a lexical match finds instantly.
+# The index is kept in memory next to the Chroma collection: every term
+# maps to compact arrays of (document number, term frequency) postings.
+#
+import re
+import math
+from array import array
+from typing import (
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# Words, keeping things like "ERR-42", "v1.2.3" or "0x8007" in one piece.
+token_pattern = re.compile(r"\w+(?:[-.]\w+)*")
+
+# Removed documents leave their postings behind; past this fraction of the
+# documents numbered, the index is compacted
+max_removed_fraction = 0.5
+
+
+def tokenize(text: str) -> List[str]:
+    return token_pattern.findall(text.lower())
+
+
+class BM25Index:
+    """
+    An inverted BM25 index over a set of documents identified by string ids.
+
+    Attributes:
+        k1: Term frequency saturation.
+        b: Document length normalization.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings: Dict[str, Tuple[array, array]] = {}
+        self.ids: List[Optional[str]] = []
+        self.lengths = array('I')
+        self.numbers: Dict[str, int] = {}
+        self.total_length = 0
+
+    def __len__(self) -> int:
+        return len(self.numbers)
+
+    def add(self, ids: Sequence[str], documents: Sequence[str]) -> None:
+        """
+        Add documents to the index, replacing any documents with the same ids.
+        """
+        for doc_id, document in zip(ids, documents):
+            self.remove([doc_id])
+            number = len(self.ids)
+            self.ids.append(doc_id)
+            self.numbers[doc_id] = number
+            terms = tokenize(document)
+            self.lengths.append(len(terms))
+            self.total_length += len(terms)
+
+            frequencies: Dict[str, int] = {}
+            for term in terms:
+                frequencies[term] = frequencies.get(term, 0) + 1
+            for term, frequency in frequencies.items():
+                if term not in self.postings:
+                    self.postings[term] = (array('I'), array('I'))
+                numbers, tfs = self.postings[term]
+                numbers.append(number)
+                tfs.append(frequency)
+
+    def remove(self, ids: Iterable[str]) -> None:
+        """
+        Remove documents from the index. Their postings are left in place
+        and skipped when searching, until removed documents make up more
+        than max_removed_fraction of the index, which is then compacted.
+        """
+        for doc_id in ids:
+            number = self.numbers.pop(doc_id, None)
+            if number is not None:
+                self.ids[number] = None
+                self.total_length -= self.lengths[number]
+        if len(self.ids) - len(self.numbers) > max_removed_fraction * len(self.ids):
+            self.compact()
+
+    def compact(self) -> None:
+        """
+        Number the documents left from 0 again, dropping the postings of the removed ones.
+        """
+        renumbered = [-1] * len(self.ids)
+        ids: List[Optional[str]] = []
+        lengths = array('I')
+        for number, doc_id in enumerate(self.ids):
+            if doc_id is not None:
+                renumbered[number] = len(ids)
+                ids.append(doc_id)
+                lengths.append(self.lengths[number])
+
+        postings: Dict[str, Tuple[array, array]] = {}
+        for term, (numbers, tfs) in self.postings.items():
+            live_numbers, live_tfs = array('I'), array('I')
+            for number, tf in zip(numbers, tfs):
+                if renumbered[number] >= 0:
+                    live_numbers.append(renumbered[number])
+                    live_tfs.append(tf)
+            if live_numbers:
+                postings[term] = (live_numbers, live_tfs)
+
+        self.ids = ids
+        self.lengths = lengths
+        self.postings = postings
+        self.numbers = {doc_id: number for number, doc_id in enumerate(ids)}
+
+    def search(self, query: str, num_results: int = 10) -> List[Tuple[str, float]]:
+        """
+        Return the ids and BM25 scores of the best matching documents, best first.
+        """
+        if not self.numbers:
+            return []
+        num_docs = len(self.numbers)
+        average_length = self.total_length / num_docs or 1.0
+
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            if term not in self.postings:
+                continue
+            numbers, tfs = self.postings[term]
+            live = [(number, tf) for number, tf in zip(numbers, tfs) if self.ids[number] is not None]
+            if not live:
+                continue
+            idf = math.log(1 + (num_docs - len(live) + 0.5) / (len(live) + 0.5))
+            for number, tf in live:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[number] / average_length)
+                scores[number] = scores.get(number, 0.0) + idf * tf * (self.k1 + 1) / (tf + norm)
+
+        best = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:num_results]
+        return [(self.ids[number], score) for number, score in best]
+
+
+def reciprocal_rank_fusion(rankings: Sequence[Sequence[str]],
+                           weights: Optional[Sequence[float]] = None,
+                           k: int = 60
+                           ) -> List[Tuple[str, float]]:
+    """
+    Fuse ranked lists of ids: every id scores weight / (k + rank) in each
+    list it occurs in.
+
+    Args:
+        rankings: Lists of ids, best first.
+        weights: Weight of each list. Defaults to 1.0 for all.
+        k: Damping of the influence of the top ranks.
+
+    Returns:
+        List[Tuple[str, float]]: The ids and fused scores, best first.
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores: Dict[str, float] = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, doc_id in enumerate(ranking, start=1):
+            scores[doc_id] = scores.get(doc_id, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
@@ -0,0 +1,313 @@
+#
+# Caches for qsearch: a semantic cache of answers and caches of the
+# intermediate stages (search results and fetched pages).
+#
+# The same, or nearly the same, question tends to be asked over and over.
+# Rather than searching, scraping, embedding and generating again, the
+# question is embedded and looked up among the questions answered before;
+# above a similarity threshold the stored answer is returned. Questions that
+# miss can still reuse the search results and page contents of earlier runs.
+#
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+# VectorDB pulls in Chroma, so it is imported when the answer cache is created.
+if TYPE_CHECKING:
+    from concurrent.futures import Executor
+
+
+default_cache_directory = "./qcache"
+
+# Seconds before an entry expires
+default_answer_ttl = 24 * 3600
+default_search_ttl = 24 * 3600
+default_page_ttl = 6 * 3600
+
+default_max_answers = 1000
+default_max_stage_entries = 5000
+
+# Min cosine similarity between two questions for them to share an answer
+default_threshold = 0.95
+
+
+class StageCache:
+    """
+    A size bounded, least recently used, on-disk cache of JSON values with
+    a time to live per stage (e.g. 'search' or 'page').
+
+    Attributes:
+        path: Path of the SQLite database file.
+        ttls: Seconds an entry of each stage stays valid.
+        max_entries: Max number of entries to keep before evicting the least recently used.
+    """
+
+    def __init__(self, path: str, ttls: Dict[str, float], max_entries: int = default_max_stage_entries):
+        self.path = path
+        self.ttls = ttls
+        self.max_entries = max_entries
+        self.counters = {stage: {'hits': 0, 'misses': 0, 'expired': 0} for stage in ttls}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " stage TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " created REAL NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (stage, key))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (last_used)")
+        self.conn.commit()
+
+    def get(self, stage: str, key: str) -> Optional[Any]:
+        """
+        Return the value stored under the key, or None if it is missing or expired.
+        """
+        now = time.time()
+        counters = self.counters[stage]
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value, created FROM entries WHERE stage = ? AND key = ?", (stage, key)
+            ).fetchone()
+            if row and now - row[1] > self.ttls[stage]:
+                self.conn.execute("DELETE FROM entries WHERE stage = ? AND key = ?", (stage, key))
+                self.conn.commit()
+                counters['expired'] += 1
+                row = None
+            if row is None:
+                counters['misses'] += 1
+                return None
+            self.conn.execute(
+                "UPDATE entries SET last_used = ? WHERE stage = ? AND key = ?", (now, stage, key)
+            )
+            self.conn.commit()
+            counters['hits'] += 1
+        return json.loads(row[0])
+
+    def put(self, stage: str, key: str, value: Any) -> None:
+        """
+        Store the value under the key, evicting the least recently used
+        entries if the cache grows beyond max_entries.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO entries (stage, key, value, created, last_used) VALUES (?, ?, ?, ?, ?)",
+                (stage, key, json.dumps(value), now, now)
+            )
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM entries").fetchone()
+            if entries > self.max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM entries WHERE rowid IN"
+                    " (SELECT rowid FROM entries ORDER BY last_used, rowid LIMIT ?)",
+                    (entries - self.max_entries,)
+                )
+                self.evictions += cursor.rowcount
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Return the counters and hit rate of each stage.
+        """
+        with self.lock:
+            stats = {}
+            for stage, counters in self.counters.items():
+                (entries,) = self.conn.execute(
+                    "SELECT COUNT(*) FROM entries WHERE stage = ?", (stage,)
+                ).fetchone()
+                lookups = counters['hits'] + counters['misses']
+                stats[stage] = dict(counters,
+                                    entries=entries,
+                                    hit_rate=counters['hits'] / lookups if lookups else 0.0)
+            return stats
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+class AnswerCache:
+    """
+    A semantic cache of answers, kept in a collection of its own. A question
+    is answered from the cache when it is similar enough to a question asked
+    before (for the same model) and that answer hasn't expired.
+
+    Attributes:
+        threshold: Min cosine similarity for a cached question to match.
+        ttl: Seconds an answer stays valid.
+        max_entries: Max number of answers to keep before evicting the least recently used.
+
+    The questions are embedded by the sentence transformer embed_model of
+    VectorDB, or by the given embedding_function (e.g. for tests).
+    """
+
+    def __init__(self,
+                 directory: str = default_cache_directory,
+                 threshold: float = default_threshold,
+                 ttl: float = default_answer_ttl,
+                 max_entries: int = default_max_answers,
+                 embed_executor: Optional['Executor'] = None,
+                 embed_model: Optional[str] = None,
+                 embedding_function: Optional[Callable[[List[str]], List[List[float]]]] = None
+                 ):
+        from qvdb import VectorDB
+
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.expired = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        self.qvdb = VectorDB(db_directory=os.path.join(directory, "answers"),
+                             collection_name="qsearch-answers",
+                             is_persistent=True,
+                             embed_model=embed_model,
+                             embedding_function=embedding_function,
+                             embed_executor=embed_executor)
+
+    def lookup(self, question: str, model: str, threshold: Optional[float] = None) -> Optional[Dict[str, Any]]:
+        """
+        Find the answer to a similar question.
+
+        Args:
+            question: The question.
+            model: The model the answer must come from.
+            threshold: Min similarity, overriding the threshold of the cache.
+
+        Returns:
+            Optional[Dict[str, Any]]: The 'answer', its 'sources', the cached
+            'question' and its 'similarity', or None on a miss.
+        """
+        collection = self.qvdb.collection
+        embeddings = self.qvdb.embed([question])
+        with self.lock:
+            results = collection.query(query_embeddings=embeddings,
+                                       n_results=1,
+                                       where={'model': model})
+            if not results['ids'][0]:
+                self.misses += 1
+                return None
+            entry_id = results['ids'][0][0]
+            metadata = results['metadatas'][0][0]
+            similarity = 1.0 - results['distances'][0][0]
+            now = time.time()
+            if now - metadata['created'] > self.ttl:
+                self.qvdb.delete([entry_id])
+                self.expired += 1
+                self.misses += 1
+                return None
+            if similarity < (self.threshold if threshold is None else threshold):
+                self.misses += 1
+                return None
+            collection.update(ids=[entry_id], metadatas=[dict(metadata, last_used=now)])
+            self.hits += 1
+        return {
+            'answer': metadata['answer'],
+            'sources': json.loads(metadata['sources']),
+            'question': results['documents'][0][0],
+            'similarity': similarity,
+        }
+
+    def store(self, question: str, model: str, answer: str, sources: List[str]) -> None:
+        """
+        Store the answer to a question, evicting the least recently used
+        answers if the cache grows beyond max_entries.
+        """
+        collection = self.qvdb.collection
+        now = time.time()
+        metadata = {
+            'model': model,
+            'answer': answer,
+            'sources': json.dumps(sources),
+            'created': now,
+            'last_used': now,
+        }
+        entry_id = f"{model}:{hashlib.sha256(question.encode('utf-8')).hexdigest()}"
+        embeddings = self.qvdb.embed([question])
+        with self.lock:
+            collection.upsert(ids=[entry_id],
+                              documents=[question],
+                              metadatas=[metadata],
+                              embeddings=embeddings)
+            entries = collection.count()
+            if entries > self.max_entries:
+                stored = collection.get(include=['metadatas'])
+                by_age = sorted(zip(stored['ids'], stored['metadatas']), key=lambda entry: entry[1]['last_used'])
+                evicted = [entry_id for entry_id, _ in by_age[:entries - self.max_entries]]
+                self.qvdb.delete(evicted)
+                self.evictions += len(evicted)
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': self.qvdb.collection.count(),
+                'hits': self.hits,
+                'misses': self.misses,
+                'expired': self.expired,
+                'evictions': self.evictions,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def cache_directory() -> Optional[str]:
+    """
+    The directory of the qsearch caches, from the QAI_QSEARCH_CACHE environment
+    variable, or None if caching is turned off (QAI_QSEARCH_CACHE=off).
+    """
+    directory = os.getenv('QAI_QSEARCH_CACHE', default_cache_directory)
+    if directory.lower() in ('', 'off', 'none'):
+        return None
+    return directory
+
+
+def get_stage_cache() -> Optional[StageCache]:
+    """
+    Return the process wide cache of search results and pages, or None if caching is turned off.
+    """
+    directory = cache_directory()
+    if directory is None:
+        return None
+    with _shared_caches_lock:
+        if 'stages' not in _shared_caches:
+            _shared_caches['stages'] = StageCache(os.path.join(directory, "stages.db"),
+                                                  ttls={'search': default_search_ttl, 'page': default_page_ttl})
+        return _shared_caches['stages']
+
+
+def get_answer_cache(embed_executor: Optional['Executor'] = None) -> Optional[AnswerCache]:
+    """
+    Return the process wide answer cache, or None if caching is turned off.
+    """
+    directory = cache_directory()
+    if directory is None:
+        return None
+    with _shared_caches_lock:
+        if 'answers' not in _shared_caches:
+            _shared_caches['answers'] = AnswerCache(directory, embed_executor=embed_executor)
+        return _shared_caches['answers']
@@ -0,0 +1,42 @@
+#
+# Client side of qserver: forwards the command line arguments of qsearch.py
+# and qimdb.py to a running qserver. Kept separate (and light) so that the
+# clients don't have to import the server.
+#
+import os
+import json
+from typing import Any, Dict
+
+default_host = "127.0.0.1"
+default_port = 8788
+default_server_url = os.getenv('QAI_SERVER', f"http://{default_host}:{default_port}")
+
+
+def forward_to_server(server_url: str, command: str, args: Dict[str, Any]) -> str:
+    """
+    Send the command line arguments of a qsearch/qimdb command to a qserver.
+
+    Args:
+        server_url (str): URL of the qserver.
+        command (str): The command to run, 'qsearch' or 'qimdb'.
+        args (Dict[str, Any]): The parsed command line arguments.
+
+    Returns:
+        str: The output of the command.
+    """
+    import urllib.error
+    import urllib.request
+
+    request = urllib.request.Request(
+        f"{server_url.rstrip('/')}/{command}",
+        data=json.dumps(args).encode('utf-8'),
+        headers={'Content-Type': 'application/json'}
+    )
+    try:
+        with urllib.request.urlopen(request) as response:
+            return json.loads(response.read())['output']
+    except urllib.error.HTTPError as e:
+        print(f"Error: {json.loads(e.read()).get('error', e.reason)}")
+    except urllib.error.URLError as e:
+        print(f"Error: Could not reach qserver at {server_url}: {e.reason}")
+    exit(1)
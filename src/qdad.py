@@ -2,8 +2,9 @@
 # A Dungeon and Dragons game.
 #
 import os
-import ollama
+import qollama
 import textwrap
+from qmemory import ConversationMemory
 
 
 template = """
@@ -28,13 +29,24 @@ def main():
     # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
     model = os.getenv('USE_MODEL', 'mistral')
 
-    chat_history = []  # Initialize your chat history
+    # Keep the recent turns (within HISTORY_TOKENS) and a summary of the older ones.
+    # With USE_CONTEXT set, the turns are carried over as Ollama context instead of text.
+    memory = ConversationMemory(model=model,
+                                budget=int(os.getenv('HISTORY_TOKENS', 1500)),
+                                reuse_context=bool(os.getenv('USE_CONTEXT')),
+                                assistant="Dungeon Master")
+    uinput = ""
     user_input = ""  # Initialize user input
     while True:
-        prompt = template.format(chat_history=chat_history, user_input=user_input)
-        output = ollama.generate(model=model, prompt=prompt, stream=False)
+        context = memory.next_context()
+        if context:
+            # The instructions and the story so far are in the context already
+            prompt = user_input
+        else:
+            prompt = template.format(chat_history=memory.history(), user_input=user_input)
+        output = qollama.generate(model=model, prompt=prompt, context=context, stream=False)
         response = output['response'].strip()
-        chat_history.append(response)  # Update chat history
+        memory.record(uinput, response, output.get('context'))  # Update chat history
         print("")
         # To make the text easier to read, we wrap it to a maximum width of 62 characters.
         # Split the response into lines, wrap each line, then join them back together
@@ -1,8 +1,11 @@
 import os
-import ollama
+import qollama
 import textwrap
-from googlesearch import search
-from qutils import extract_json_objects, Painter, print_verbose
+import threading
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+from qutils import extract_json_objects, instruction_handler, JsonStreamExtractor, Painter, print_verbose
+from qmemory import ConversationMemory
+from qrender import renderer_for
 
 
 
@@ -17,6 +20,9 @@ example_json = """
         {'set_color': 'blue'},
         {'draw_polygon': {'points': [[110, 40], [40, 90], [140, 120], [200,200]]}},
         {'draw_sinus': {'start': [20,200], 'range': [0, 360, 5, 100]}},
+        {'draw_function': {'function': '40 * cos(radians(2 * x))', 'start': [20,300], 'range': [0, 360, 2]}},
+        {'draw_bezier': {'points': [[200, 100], [260, 20], [320, 180], [380, 100]]}},
+        {'draw_arc': {'center': [300, 250], 'radius': 40, 'angles': [0, 180]}},
         {'clear_all': null}
     ]
 }
@@ -32,6 +38,9 @@ You have access to a drawing tool that can perform the following operations:
   - draw_curve : This operation draws a curve between a set of points, where the points are represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
   - draw_polygon : This operation draws lines between a set of points, ending at the starting point, where the points are represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
   - draw_sinus : This operation draws a sinus curve starting at the point: (X,Y) ,ranging from a Start degree to a Stop degree taking steps of Step degrees ,and where the Y position is scaled by Yscale  
+  - draw_function : This operation plots a function of x, written as an expression such as: 40 * cos(radians(2 * x)) using +, -, *, /, **, pi, e and the functions sin, cos, tan, exp, log, sqrt, abs and radians, starting at the point: (X,Y) ,with x ranging from Start to Stop in steps of Step
+  - draw_bezier : This operation draws a Bezier curve from the first to the last of a list of control points, represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
+  - draw_arc : This operation draws an arc of the circle with center: (X,Y) ,and a radius of: R ,from a Start angle to a Stop angle in degrees, counterclockwise from 3 o'clock
   - draw_text : This operation will draw a text the Text is centered vertically and horizontally around position (X, Y) , newlines are represented as '\n'
   - set_color : This operation sets the color for the upcoming draw operations where color names must be valid Tkinter color names.
   - clear_all : This operation remove all drawn objects from the drawing canvas.
@@ -67,33 +76,97 @@ User request: {question}<|end|>
 <|assistant|>
 """
 
-def main():
-    # Get the value of the environment variable 'USE_MODEL'
-    # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
-    model = os.getenv('USE_MODEL', 'mistral')
-
-    p = Painter("AI Drawing Tool")
-    
-    chat_history = []  # Initialize your chat history
-    observation = ""
+def draw_stream(painter: Painter, chunks: Iterable[Any]) -> Tuple[str, Optional[List[int]]]:
+    """
+    Draw the instructions in a streamed response, each as soon as it is complete.
+    As with a complete response, only the instructions of a draw action after
+    the 'Action:' line are drawn, not objects in the text before it.
+
+    Args:
+        painter: Where to submit the instructions.
+        chunks: The chunks of a streamed Ollama response.
+
+    Returns:
+        The response, and its context to carry over to the next request.
+    """
+    parts = []
+    context = None
+    extractor = JsonStreamExtractor(nested=True)
+    # Instructions of an action whose name hasn't been read yet
+    pending: List[Dict[str, Any]] = []
+    # The instructions follow the 'Action:' line; look for it across tokens
+    tail = ''
+    for chunk in chunks:
+        token = chunk['response']
+        parts.append(token)
+        if chunk.get('done'):
+            context = chunk.get('context')
+        if tail is not None:
+            text = tail + token
+            start = text.find('Action:')
+            if start == -1:
+                tail = text[-len('Action:'):]
+                continue
+            tail = None
+            token = text[start + len('Action:'):]
+        submit_instructions(painter, extractor.feed(token), pending)
+    submit_instructions(painter, extractor.close(), pending)
+    return ''.join(parts).strip(), context
+
+
+def submit_instructions(painter: Painter, objects: List[Tuple[tuple, Dict[str, Any], Dict[str, Any]]],
+                        pending: List[Dict[str, Any]]) -> None:
+    for path, data, action in objects:
+        print_verbose("<info> Extracted JSON object: ", data)
+        if not path:
+            # The action is complete: its instructions are drawn if it turns out to be a draw action
+            if 'draw' in str(action.get('action', '')):
+                for instruction in pending:
+                    painter.submit(instruction)
+            pending.clear()
+        elif len(path) == 2 and path[0] == 'instructions' and instruction_handler(data):
+            if 'action' not in action:
+                pending.append(data)
+            elif 'draw' in str(action['action']):
+                painter.submit(data)
+
+
+def converse(p: Painter, model: str, memory: ConversationMemory, stream: bool, output: Optional[str] = None) -> None:
     while True:
-        question = input("Enter a question: ")
-        chat_history.append(question)
-
-        prompt = template.format(question=question, example_json=example_json, chat_history=chat_history)
-        output = ollama.generate(model=model, prompt=prompt, stream=False)
-        response = output['response'].strip()
-        chat_history.append(response)
+        if output:
+            # Headless, the drawing so far is written after every answer
+            p.save(output)
+        try:
+            question = input("Enter a question: ")
+        except EOFError:
+            p.close()
+            return
+
+        context = memory.next_context()
+        if context:
+            # The instructions and the earlier requests are in the context already
+            prompt = f"<|user|>\nUser request: {question}<|end|>\n<|assistant|>\n"
+        else:
+            prompt = template.format(question=question, example_json=example_json, chat_history=memory.history())
+
+        if stream:
+            # Draw while the model is still generating
+            chunks = qollama.generate(model=model, prompt=prompt, context=context, stream=True)
+            response, response_context = draw_stream(p, chunks)
+            memory.record(question, response, response_context)
+            print_verbose(f"<info> response = {response}")
+            continue
+
+        result = qollama.generate(model=model, prompt=prompt, context=context, stream=False)
+        response = result['response'].strip()
+        memory.record(question, response, result.get('context'))
         print_verbose(f"<info> response = {response}")
 
         # Check if the response contains 'Action:'
         if 'Action:' in response:
-            # Convert it to proper JSON format
-            json_text = response.replace("'", '"')
-
             # Extract JSON objects
             data = None
-            for data in extract_json_objects(json_text):
+            for data in extract_json_objects(response):
                 print_verbose("<info> Extracted JSON object: ", data)
 
             # If the JSON object contains an 'action_input' key, and 'query' is in 'action_input',
@@ -102,7 +175,35 @@ def main():
             if data and 'action' in data and 'draw' in data['action']:
                 instructions = data['instructions']
                 for instruction in instructions:
-                    p.handle_instruction(instruction)
+                    p.submit(instruction)
+
+
+def main():
+    # Get the value of the environment variable 'USE_MODEL'
+    # If 'USE_MODEL' is not set or is empty, use 'default_value' instead
+    model = os.getenv('USE_MODEL', 'mistral')
+
+    # With DRAW_OUTPUT=<file>.png (or .svg) the drawing is written to that file
+    # instead of shown in a window, e.g. on a machine without a display
+    output = os.getenv('DRAW_OUTPUT')
+    p = Painter("AI Drawing Tool", renderer=renderer_for(output) if output else None)
+    
+    # Keep the recent turns (within HISTORY_TOKENS) and a summary of the older ones.
+    # With USE_CONTEXT set, the turns are carried over as Ollama context instead of text.
+    memory = ConversationMemory(model=model,
+                                budget=int(os.getenv('HISTORY_TOKENS', 1500)),
+                                reuse_context=bool(os.getenv('USE_CONTEXT')))
+
+    # The response is drawn as it streams in, unless STREAM_DRAWING=off
+    stream = os.getenv('STREAM_DRAWING', 'on').lower() not in ('off', '0', 'no')
+
+    if output:
+        converse(p, model, memory, stream, output)
+        return
+
+    # Tk must run in the main thread, so the questions are asked in another one
+    threading.Thread(target=converse, args=(p, model, memory, stream), daemon=True).start()
+    p.start()
 
 
 if __name__ == "__main__":
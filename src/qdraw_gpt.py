@@ -30,6 +30,9 @@ example_json = """
         {'set_color': 'blue'},
         {'draw_polygon': {'points': [[110, 40], [40, 90], [140, 120], [200,200]]}},
         {'draw_sinus': {'start': [20,200], 'range': [0, 360, 5, 100]}},
+        {'draw_function': {'function': '40 * cos(radians(2 * x))', 'start': [20,300], 'range': [0, 360, 2]}},
+        {'draw_bezier': {'points': [[200, 100], [260, 20], [320, 180], [380, 100]]}},
+        {'draw_arc': {'center': [300, 250], 'radius': 40, 'angles': [0, 180]}},
         {'clear_all': null}
     ]
 }
@@ -45,6 +48,9 @@ You have access to a drawing tool that can perform the following operations:
   - draw_curve : This operation draws a curve between a set of points, where the points are represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
   - draw_polygon : This operation draws lines between a set of points, ending at the starting point, where the points are represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
   - draw_sinus : This operation draws a sinus curve starting at the point: (X,Y) ,ranging from a Start degree to a Stop degree taking steps of Step degrees ,and where the Y position is scaled by Yscale  
+  - draw_function : This operation plots a function of x, written as an expression such as: 40 * cos(radians(2 * x)) using +, -, *, /, **, pi, e and the functions sin, cos, tan, exp, log, sqrt, abs and radians, starting at the point: (X,Y) ,with x ranging from Start to Stop in steps of Step
+  - draw_bezier : This operation draws a Bezier curve from the first to the last of a list of control points, represented as pairs of integers: [(X1,Y1), (X2,Y2), ... , (Xn,Yn)]
+  - draw_arc : This operation draws an arc of the circle with center: (X,Y) ,and a radius of: R ,from a Start angle to a Stop angle in degrees, counterclockwise from 3 o'clock
   - draw_text : This operation will draw a text the Text is centered vertically and horizontally around position (X, Y) , newlines are represented as '\n'
   - set_color : This operation sets the color for the upcoming draw operations where color names must be valid Tkinter color names.
   - clear_all : This operation remove all drawn objects from the drawing canvas.
@@ -124,11 +130,8 @@ def main():
 
         # Check if the response contains 'Action:'
         if 'Action:' in response:
-            # Convert it to proper JSON format
-            json_text = response.replace("'", '"')
-
             # Extract JSON objects
-            for data in extract_json_objects(json_text):
+            for data in extract_json_objects(response):
                 print_verbose("<info> Extracted JSON object: ", data)
 
             # If the JSON object contains an 'action_input' key, and 'query' is in 'action_input',
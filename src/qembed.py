@@ -0,0 +1,226 @@
+#
+# A persistent cache of embeddings, shared by VectorDB (qvdb) and VectorStore (qutils).
+#
+# Embeddings are stored in SQLite, keyed by the name of the embedding model and
+# a hash of the embedded text, so the same text is only embedded once per model
+# no matter which program or run that asks for it.
+#
+import os
+import time
+import sqlite3
+import hashlib
+import threading
+from array import array
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+)
+
+
+default_cache_path = "./qcache/embeddings.db"
+default_max_entries = 200_000
+
+
+class EmbeddingCache:
+    """
+    A size bounded, least recently used, on-disk cache of embeddings.
+
+    Attributes:
+        path: Path of the SQLite database file.
+        max_entries: Max number of embeddings to keep before evicting the least recently used.
+        hits: Number of embeddings found in the cache.
+        misses: Number of embeddings that had to be computed.
+        evictions: Number of embeddings evicted from the cache.
+    """
+
+    def __init__(self, path: str = default_cache_path, max_entries: int = default_max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.embed_seconds = 0.0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL,"
+            " hash TEXT NOT NULL,"
+            " vector BLOB NOT NULL,"
+            " last_used REAL NOT NULL,"
+            " PRIMARY KEY (model, hash))"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings (last_used)")
+        self.conn.commit()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+    def embed(self, model: str, texts: List[str], embed_func: Callable[[List[str]], List[List[float]]]) -> List[List[float]]:
+        """
+        Return the embeddings of the texts, calling embed_func only for the
+        texts that aren't already cached for the given model.
+
+        Args:
+            model: Name of the embedding model, part of the cache key.
+            texts: The texts to embed.
+            embed_func: Function computing the embeddings of a list of texts.
+
+        Returns:
+            The embeddings, in the same order as the texts.
+        """
+        keys = [self.key(text) for text in texts]
+        vectors = self.get(model, keys)
+
+        missing = {}
+        for index, (key, vector) in enumerate(zip(keys, vectors)):
+            if vector is None:
+                missing.setdefault(key, []).append(index)
+
+        if missing:
+            todo = [texts[indexes[0]] for indexes in missing.values()]
+            start_time = time.time()
+            computed = embed_func(todo)
+            elapsed = time.time() - start_time
+            with self.lock:
+                self.embed_seconds += elapsed
+            # Rounded to float32 as stored, so that a miss returns what a later hit does
+            computed = [self._decode(self._encode(vector)) for vector in computed]
+            self.put(model, list(missing.keys()), computed)
+            for indexes, vector in zip(missing.values(), computed):
+                for index in indexes:
+                    vectors[index] = vector
+
+        return vectors
+
+    def get(self, model: str, keys: List[str]) -> List[Optional[List[float]]]:
+        """
+        Look up the embeddings stored under the given keys, None for a miss.
+        """
+        found = {}
+        with self.lock:
+            # Stay well below SQLite's limit on the number of query parameters.
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.conn.execute(
+                    f"SELECT hash, vector FROM embeddings WHERE model = ? AND hash IN ({','.join('?' * len(chunk))})",
+                    [model, *chunk]
+                ).fetchall()
+                found.update(rows)
+            if found:
+                now = time.time()
+                self.conn.executemany(
+                    "UPDATE embeddings SET last_used = ? WHERE model = ? AND hash = ?",
+                    [(now, model, key) for key in found]
+                )
+                self.conn.commit()
+            self.hits += sum(1 for key in keys if key in found)
+            self.misses += sum(1 for key in keys if key not in found)
+
+        return [self._decode(found[key]) if key in found else None for key in keys]
+
+    def put(self, model: str, keys: List[str], vectors: List[List[float]]) -> None:
+        """
+        Store embeddings under the given keys, evicting the least recently used
+        entries if the cache grows beyond max_entries.
+        """
+        now = time.time()
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, hash, vector, last_used) VALUES (?, ?, ?, ?)",
+                [(model, key, self._encode(vector), now) for key, vector in zip(keys, vectors)]
+            )
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            if entries > self.max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM embeddings WHERE rowid IN"
+                    " (SELECT rowid FROM embeddings ORDER BY last_used, rowid LIMIT ?)",
+                    (entries - self.max_entries,)
+                )
+                self.evictions += cursor.rowcount
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Return the cache counters, including an estimate of the embedding time
+        saved by the hits (based on the average time of the misses).
+        """
+        with self.lock:
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()
+            lookups = self.hits + self.misses
+            return {
+                "entries": entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "embed_seconds": self.embed_seconds,
+                "saved_seconds": self.hits * self.embed_seconds / self.misses if self.misses else 0.0,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+    @staticmethod
+    def _encode(vector: List[float]) -> bytes:
+        return array('f', vector).tobytes()
+
+    @staticmethod
+    def _decode(blob: bytes) -> List[float]:
+        vector = array('f')
+        vector.frombytes(blob)
+        return vector.tolist()
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_embedding_cache() -> Optional[EmbeddingCache]:
+    """
+    Return the process wide embedding cache, or None if caching is turned off.
+
+    The cache location and size are taken from the QAI_EMBED_CACHE and
+    QAI_EMBED_CACHE_SIZE environment variables; set QAI_EMBED_CACHE=off
+    to disable the cache.
+    """
+    global _shared_cache
+    path = os.getenv('QAI_EMBED_CACHE', default_cache_path)
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            max_entries = int(os.getenv('QAI_EMBED_CACHE_SIZE', default_max_entries))
+            _shared_cache = EmbeddingCache(path, max_entries=max_entries)
+        return _shared_cache
+
+
+class CachedEmbeddings:
+    """
+    LangChain embeddings that look up embeddings in an EmbeddingCache
+    before calling the wrapped embeddings. It implements the interface of
+    langchain_core.embeddings.Embeddings without importing LangChain.
+    """
+
+    def __init__(self, embeddings: Any, model: str, cache: EmbeddingCache):
+        self.embeddings = embeddings
+        self.model = model
+        self.cache = cache
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.cache.embed(self.model, texts, self.embeddings.embed_documents)
+
+    def embed_query(self, text: str) -> List[float]:
+        # Queries are embedded differently by some models, so keep them apart.
+        embed = lambda queries: [self.embeddings.embed_query(query) for query in queries]
+        return self.cache.embed(f"{self.model}:query", [text], embed)[0]
@@ -0,0 +1,364 @@
+#
+# Exact (brute force) vector search with NumPy, for small in-memory collections.
+#
+# A qsearch question stores a few hundred chunks in a throwaway collection
+# and searches it once or twice. For that, Chroma's client startup, SQLite
+# bookkeeping and HNSW index building cost more than the search saves.
+# Here the embeddings are kept normalized in one contiguous float32 matrix,
+# so that a (batch of) cosine queries is a single matrix multiplication,
+# and the top k are picked with argpartition rather than a full sort.
+#
+# FlatCollection implements the part of the Chroma collection API that
+# VectorDB uses, so VectorDB can use either (and move from this one to
+# Chroma's approximate index once a collection grows; see qvdb). FlatStore
+# does the same for the LangChain vector store API used by qai_pdf.
+#
+# See bench_vdb.py for where brute force stops paying off.
+#
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+# NumPy is imported where it is used, so that importing this module (and qvdb) stays cheap.
+if TYPE_CHECKING:
+    import numpy
+    from langchain_core.documents import Document
+
+
+def normalized(vectors: Any) -> 'numpy.ndarray':
+    """
+    Return the vectors as a float32 matrix of unit length rows.
+    """
+    import numpy as np
+
+    matrix = np.array(vectors, dtype=np.float32, ndmin=2)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+class FlatIndex:
+    """
+    Normalized embeddings in a contiguous float32 matrix, searched exhaustively.
+
+    Attributes:
+        ids: The id of each row of the matrix.
+        rows: The row of each id.
+    """
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.matrix: Optional['numpy.ndarray'] = None
+        self.dimensions: Optional[int] = None
+        self.ids: List[str] = []
+        self.rows: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def vectors(self) -> 'numpy.ndarray':
+        """
+        The (normalized) embeddings, one row per id.
+        """
+        return self.matrix[:len(self.ids)]
+
+    def add(self, ids: Sequence[str], embeddings: Any) -> None:
+        """
+        Add the embeddings, replacing those of ids that are already in the index.
+        """
+        if not len(ids):
+            return
+        vectors = normalized(embeddings)
+        if self.dimensions is None:
+            self.dimensions = vectors.shape[1]
+        elif vectors.shape[1] != self.dimensions:
+            raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the index dimension {self.dimensions}")
+        self.store(self.assign(ids), vectors)
+
+    def assign(self, ids: Sequence[str]) -> List[int]:
+        """
+        Return the row of each id, appending rows for new ids.
+        """
+        rows = []
+        for doc_id in ids:
+            row = self.rows.get(doc_id)
+            if row is None:
+                row = len(self.ids)
+                self.rows[doc_id] = row
+                self.ids.append(doc_id)
+            rows.append(row)
+        return rows
+
+    def store(self, rows: List[int], vectors: 'numpy.ndarray') -> None:
+        self.matrix = grown(self.matrix, len(self.ids), vectors.shape[1:], self.capacity)
+        self.matrix[rows] = vectors
+
+    def move(self, source: int, target: int) -> None:
+        self.matrix[target] = self.matrix[source]
+
+    def remove(self, ids: Sequence[str]) -> None:
+        """
+        Remove the ids, moving the last rows into their place.
+        """
+        for doc_id in ids:
+            row = self.rows.pop(doc_id, None)
+            if row is None:
+                continue
+            last = len(self.ids) - 1
+            if row != last:
+                moved = self.ids[last]
+                self.move(last, row)
+                self.ids[row] = moved
+                self.rows[moved] = row
+            self.ids.pop()
+
+    def search(self,
+               queries: Any,
+               k: int,
+               candidates: Optional[Sequence[int]] = None
+               ) -> List[List[Tuple[str, float]]]:
+        """
+        Find the k most similar rows for each query.
+
+        Args:
+            queries: The query embeddings, one per row (or a single embedding).
+            k: Number of results per query.
+            candidates: The rows to search, e.g. those matching a filter. Defaults to all.
+
+        Returns:
+            For each query, the (id, cosine similarity) pairs of the results, most similar first.
+        """
+        import numpy as np
+
+        q = normalized(queries)
+        if not self.ids:
+            return [[] for _ in range(q.shape[0])]
+        matrix = self.vectors()
+        rows = None
+        if candidates is not None:
+            rows = np.asarray(candidates, dtype=np.intp)
+            matrix = matrix[rows]
+        n = matrix.shape[0]
+        k = min(k, n)
+        if k <= 0:
+            return [[] for _ in range(q.shape[0])]
+
+        top, top_similarities = top_k(q @ matrix.T, k)
+        if rows is not None:
+            top = rows[top]
+        return self.results(top, top_similarities)
+
+    def results(self, top: 'numpy.ndarray', similarities: 'numpy.ndarray') -> List[List[Tuple[str, float]]]:
+        return [
+            [(self.ids[row], float(similarity)) for row, similarity in zip(row_ids, row_similarities)]
+            for row_ids, row_similarities in zip(top.tolist(), similarities.tolist())
+        ]
+
+
+def grown(array: Optional['numpy.ndarray'], size: int, shape: Tuple[int, ...], capacity: int, dtype: Any = 'float32') -> 'numpy.ndarray':
+    """
+    Return the array, or a copy of it grown by doubling, with room for size rows of the given shape.
+    """
+    import numpy as np
+
+    if array is None:
+        return np.empty((max(size, capacity),) + tuple(shape), dtype=dtype)
+    if size <= array.shape[0]:
+        return array
+    # Grow by doubling, so that adding one batch at a time stays linear
+    bigger = np.empty((max(size, 2 * array.shape[0]),) + array.shape[1:], dtype=array.dtype)
+    bigger[:array.shape[0]] = array
+    return bigger
+
+
+def top_k(similarities: 'numpy.ndarray', k: int) -> Tuple['numpy.ndarray', 'numpy.ndarray']:
+    """
+    Return the columns of the k highest similarities of each row, highest
+    first, and those similarities.
+    """
+    import numpy as np
+
+    n = similarities.shape[1]
+    k = min(k, n)
+    if k < n:
+        top = np.argpartition(-similarities, k - 1, axis=1)[:, :k]
+    else:
+        top = np.broadcast_to(np.arange(n), similarities.shape)
+    top_similarities = np.take_along_axis(similarities, top, axis=1)
+    order = np.argsort(-top_similarities, axis=1, kind='stable')
+    return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_similarities, order, axis=1)
+
+
+def matches(metadata: Dict[str, Any], where: Optional[Dict[str, Any]]) -> bool:
+    """
+    Whether the metadata matches a Chroma `where` filter (equality, $eq,
+    $ne, $gt, $gte, $lt, $lte, $in, $nin, $and and $or).
+    """
+    if not where:
+        return True
+    for key, condition in where.items():
+        if key == '$and':
+            if not all(matches(metadata, sub) for sub in condition):
+                return False
+        elif key == '$or':
+            if not any(matches(metadata, sub) for sub in condition):
+                return False
+        elif isinstance(condition, dict):
+            for op, operand in condition.items():
+                if not _compare(metadata.get(key), op, operand, key in metadata):
+                    return False
+        elif metadata.get(key) != condition or key not in metadata:
+            return False
+    return True
+
+
+def _compare(value: Any, op: str, operand: Any, present: bool) -> bool:
+    if op == '$eq':
+        return present and value == operand
+    if op == '$ne':
+        return not present or value != operand
+    if op == '$in':
+        return present and value in operand
+    if op == '$nin':
+        return not present or value not in operand
+    if not present:
+        return False
+    if op == '$gt':
+        return value > operand
+    if op == '$gte':
+        return value >= operand
+    if op == '$lt':
+        return value < operand
+    if op == '$lte':
+        return value <= operand
+    raise ValueError(f"Unsupported operator in where filter: {op}")
+
+
+class FlatCollection:
+    """
+    An in-memory collection answering the subset of the Chroma collection
+    API that VectorDB uses, with exact cosine search over a FlatIndex (or
+    approximate search over a quantized one, see qquant).
+    """
+
+    def __init__(self, name: str, index: Optional[FlatIndex] = None):
+        self.name = name
+        self.index = index if index is not None else FlatIndex()
+        self.documents: Dict[str, str] = {}
+        self.metadatas: Dict[str, Dict[str, Any]] = {}
+
+    def count(self) -> int:
+        return len(self.index)
+
+    def add(self, ids: List[str], embeddings: Any, documents: List[str], metadatas: Optional[List[dict]] = None) -> None:
+        new = [i for i, doc_id in enumerate(ids) if doc_id not in self.documents]
+        if len(new) < len(ids):
+            # Like Chroma, add() leaves existing ids alone
+            ids = [ids[i] for i in new]
+            embeddings = [embeddings[i] for i in new]
+            documents = [documents[i] for i in new]
+            metadatas = [metadatas[i] for i in new] if metadatas else None
+        self.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def upsert(self, ids: List[str], embeddings: Any, documents: List[str], metadatas: Optional[List[dict]] = None) -> None:
+        self.index.add(ids, embeddings)
+        for i, doc_id in enumerate(ids):
+            self.documents[doc_id] = documents[i]
+            self.metadatas[doc_id] = dict(metadatas[i]) if metadatas else {}
+
+    def _select(self, ids: Optional[List[str]], where: Optional[Dict[str, Any]]) -> List[str]:
+        selected = self.index.ids if ids is None else [doc_id for doc_id in ids if doc_id in self.documents]
+        if where:
+            selected = [doc_id for doc_id in selected if matches(self.metadatas[doc_id], where)]
+        return list(selected)
+
+    def get(self,
+            ids: Optional[List[str]] = None,
+            where: Optional[Dict[str, Any]] = None,
+            include: Sequence[str] = ("documents", "metadatas")
+            ) -> Dict[str, Any]:
+        selected = self._select(ids, where)
+        result: Dict[str, Any] = {'ids': selected}
+        if "documents" in include:
+            result['documents'] = [self.documents[doc_id] for doc_id in selected]
+        if "metadatas" in include:
+            result['metadatas'] = [self.metadatas[doc_id] for doc_id in selected]
+        if "embeddings" in include:
+            result['embeddings'] = self.index.vectors()[[self.index.rows[doc_id] for doc_id in selected]]
+        return result
+
+    def query(self,
+              query_embeddings: Any,
+              n_results: int = 10,
+              where: Optional[Dict[str, Any]] = None,
+              include: Sequence[str] = ("documents", "metadatas", "distances")
+              ) -> Dict[str, List[List[Any]]]:
+        candidates = None
+        if where:
+            candidates = [self.index.rows[doc_id] for doc_id in self._select(None, where)]
+        found = self.index.search(query_embeddings, n_results, candidates=candidates)
+        return {
+            'ids': [[doc_id for doc_id, _ in hits] for hits in found],
+            'documents': [[self.documents[doc_id] for doc_id, _ in hits] for hits in found],
+            'metadatas': [[self.metadatas[doc_id] for doc_id, _ in hits] for hits in found],
+            # Cosine distances, as in a Chroma collection with "hnsw:space": "cosine"
+            'distances': [[1.0 - similarity for _, similarity in hits] for hits in found],
+        }
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict[str, Any]] = None) -> None:
+        selected = self._select(ids, where)
+        self.index.remove(selected)
+        for doc_id in selected:
+            del self.documents[doc_id]
+            del self.metadatas[doc_id]
+
+
+class FlatStore:
+    """
+    A brute force in-memory vector store of LangChain documents, for
+    small per-session collections (see qai_pdf). It implements the part
+    of the LangChain vector store API that a retriever needs.
+    """
+
+    def __init__(self, embedding: Any):
+        self.embedding = embedding
+        self.collection = FlatCollection("flat-store")
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Any, metadatas: Optional[List[dict]] = None) -> 'FlatStore':
+        store = cls(embedding)
+        store.add_texts(texts, metadatas)
+        return store
+
+    def add_texts(self, texts: List[str], metadatas: Optional[List[dict]] = None) -> List[str]:
+        start = self.collection.count()
+        ids = [str(start + i) for i in range(len(texts))]
+        if texts:
+            self.collection.upsert(ids=ids,
+                                   embeddings=self.embedding.embed_documents(list(texts)),
+                                   documents=list(texts),
+                                   metadatas=metadatas)
+        return ids
+
+    def similarity_search(self, query: str, k: int = 4, filter: Optional[Dict[str, Any]] = None) -> List['Document']:
+        from langchain_core.documents import Document
+
+        results = self.collection.query([self.embedding.embed_query(query)], n_results=k, where=filter)
+        return [Document(page_content=doc, metadata=metadata)
+                for doc, metadata in zip(results['documents'][0], results['metadatas'][0])]
+
+    def as_retriever(self, search_kwargs: Optional[Dict[str, Any]] = None) -> Callable:
+        """
+        A LangChain runnable returning the documents most similar to its input.
+        """
+        from langchain_core.runnables import RunnableLambda
+
+        k = (search_kwargs or {}).get('k', 4)
+        return RunnableLambda(lambda query: self.similarity_search(query, k=k))
@@ -0,0 +1,296 @@
+#
+# Geometry for the drawing instructions of qutils.Painter.
+#
+# The points of curves are computed with NumPy, all at once, as (n, 2)
+# arrays: sine curves, plots of functions given as expressions, Bézier
+# curves and arcs. Before a polyline reaches the renderer it is simplified
+# (Ramer-Douglas-Peucker) down to the points that matter at the resolution
+# of the canvas, so a curve of thousands of points is drawn as a few hundred.
+#
+#   >>> sinus_points([20, 200], [0, 360, 1, 100]).shape
+#   (360, 2)
+#   >>> len(simplify(sinus_points([20, 200], [0, 360, 1, 100])))
+#   29
+#
+# See also: bench_geom.py
+#
+import ast
+import math
+import operator
+import functools
+from typing import Any, Callable, Dict, List, Sequence
+
+import numpy as np
+
+# Points closer than this (in pixels) to a simplified polyline are dropped
+default_tolerance = 0.5
+
+# The most points an instruction may make, so that a model asking for a
+# curve from 0 to 10^9 degrees gets an error rather than the memory exhausted
+max_points = 100_000
+
+# Shorter polylines are drawn as they are, as simplifying them takes longer
+# than drawing their points
+min_simplified = 256
+
+# Function values are clipped to this far off the canvas
+max_coordinate = 1e6
+
+# The longest expression of a function to plot
+max_expression = 1000
+
+
+def as_points(points: Any) -> np.ndarray:
+    """
+    Return the points, e.g. [[X1, Y1], [X2, Y2]], as an (n, 2) array of floats.
+    Raises ValueError if they aren't points.
+    """
+    array = np.asarray(points, dtype=float)
+    if array.ndim != 2 or array.shape[1] != 2:
+        raise ValueError(f"Not a list of points: {points!r}")
+    return array
+
+
+def sample_count(length: float) -> int:
+    # A point every other pixel along a curve of the given length
+    count = int(math.ceil(length / 2)) + 1
+    if count > max_points:
+        raise ValueError(f"More than {max_points} points")
+    return max(count, 2)
+
+
+def stepped_range(start: float, stop: float, step: float) -> np.ndarray:
+    if step == 0:
+        raise ValueError("A step of 0")
+    if (stop - start) / step > max_points:
+        raise ValueError(f"More than {max_points} points")
+    return np.arange(start, stop, step, dtype=float)
+
+
+def sinus_points(start: Sequence[float], degrees: Sequence[float]) -> np.ndarray:
+    """
+    Return the points of a sine curve.
+
+    Args:
+        start: The offset (X, Y) of the curve.
+        degrees: [Start, Stop, Step, Yscale]: from Start to (not including) Stop
+            degrees in steps of Step degrees, with Y scaled by Yscale.
+
+    Returns:
+        The points, one per step.
+    """
+    first, stop, step, yscale = degrees
+    xoff, yoff = start
+    x = stepped_range(first, stop, step)
+    return np.column_stack((x + xoff, np.sin(np.radians(x)) * yscale + yoff))
+
+
+# What a function to plot may use, besides x
+functions: Dict[str, Callable] = {
+    'sin': np.sin, 'cos': np.cos, 'tan': np.tan,
+    'asin': np.arcsin, 'acos': np.arccos, 'atan': np.arctan,
+    'sinh': np.sinh, 'cosh': np.cosh, 'tanh': np.tanh,
+    'exp': np.exp, 'log': np.log, 'log10': np.log10, 'sqrt': np.sqrt,
+    'abs': np.abs, 'floor': np.floor, 'ceil': np.ceil, 'round': np.round,
+    'radians': np.radians, 'degrees': np.degrees,
+    'min': np.minimum, 'max': np.maximum,
+}
+constants: Dict[str, float] = {'pi': np.float64(math.pi), 'e': np.float64(math.e)}
+operators: Dict[type, Callable] = {
+    ast.Add: operator.add, ast.Sub: operator.sub, ast.Mult: operator.mul,
+    ast.Div: operator.truediv, ast.FloorDiv: operator.floordiv, ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.USub: operator.neg, ast.UAdd: operator.pos,
+}
+
+
+@functools.lru_cache(maxsize=128)
+def parse_function(expression: str) -> ast.expr:
+    """
+    Parse the expression of a function of x, e.g. '50 * sin(radians(x))'.
+    Only arithmetic, numbers, x, pi, e and the functions above are allowed;
+    anything else raises ValueError.
+    """
+    if len(expression) > max_expression:
+        raise ValueError(f"A function longer than {max_expression} characters")
+    try:
+        # Models tend to write x^2 for x**2
+        tree = ast.parse(expression.strip().replace('^', '**'), mode='eval').body
+    except SyntaxError as e:
+        raise ValueError(f"Not a function of x: {expression!r}") from e
+    called = set()
+    for node in ast.walk(tree):
+        if isinstance(node, (ast.BinOp, ast.UnaryOp)) and type(node.op) in operators:
+            continue
+        if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id in functions and not node.keywords:
+            called.add(id(node.func))
+            continue
+        if isinstance(node, ast.Name) and (node.id == 'x' or node.id in constants or id(node) in called):
+            continue
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            continue
+        if isinstance(node, (ast.operator, ast.unaryop, ast.Load)):
+            continue
+        raise ValueError(f"Not allowed in a function of x: {ast.dump(node)}")
+    return tree
+
+
+def evaluate(node: ast.expr, x: np.ndarray) -> Any:
+    if isinstance(node, ast.BinOp):
+        return operators[type(node.op)](evaluate(node.left, x), evaluate(node.right, x))
+    if isinstance(node, ast.UnaryOp):
+        return operators[type(node.op)](evaluate(node.operand, x))
+    if isinstance(node, ast.Call):
+        return functions[node.func.id](*(evaluate(arg, x) for arg in node.args))
+    if isinstance(node, ast.Name):
+        return x if node.id == 'x' else constants[node.id]
+    # As NumPy floats, which overflow to inf rather than raise, or grow without bound as ints do
+    return np.float64(node.value)
+
+
+def function_points(function: str, start: Sequence[float], x_range: Sequence[float]) -> List[np.ndarray]:
+    """
+    Return the points of the plot of a function of x.
+
+    Args:
+        function: The function, as an expression of x, e.g. '50 * sin(radians(x))'.
+        start: The offset (X, Y) of the plot.
+        x_range: [Start, Stop, Step]: x from Start to (not including) Stop in steps of Step.
+
+    Returns:
+        The pieces of the plot, split where the function isn't defined (as log(x) for x <= 0).
+    """
+    first, stop, step = x_range
+    xoff, yoff = start
+    x = stepped_range(first, stop, step)
+    with np.errstate(all='ignore'):
+        y = np.broadcast_to(np.asarray(evaluate(parse_function(function), x), dtype=float), x.shape)
+    points = np.column_stack((x + xoff, np.clip(y, -max_coordinate, max_coordinate) + yoff))
+    defined = np.isfinite(y)
+    # The indices where the function becomes defined or undefined
+    edges = np.flatnonzero(np.diff(np.concatenate(([False], defined, [False])).astype(np.int8)))
+    return [points[begin:end] for begin, end in zip(edges[::2], edges[1::2])]
+
+
+def bezier_points(control: Any) -> np.ndarray:
+    """
+    Return the points of the Bézier curve of the control points, of any
+    degree: a straight line for two, a quadratic curve for three, and so on.
+    """
+    control = as_points(control)
+    degree = len(control) - 1
+    if degree < 1:
+        raise ValueError("A Bézier curve needs two points or more")
+    # The curve is within the polygon of the control points
+    length = np.hypot(*np.diff(control, axis=0).T).sum()
+    t = np.linspace(0.0, 1.0, sample_count(length))[:, None]
+    i = np.arange(degree + 1)
+    binomials = np.array([math.comb(degree, k) for k in i], dtype=float)
+    bernstein = binomials * t ** i * (1 - t) ** (degree - i)
+    return bernstein @ control
+
+
+def arc_points(center: Sequence[float], radius: float, angles: Sequence[float]) -> np.ndarray:
+    """
+    Return the points of an arc of a circle.
+
+    Args:
+        center: The center (X, Y) of the circle.
+        radius: The radius of the circle.
+        angles: [Start, Stop]: from Start to Stop degrees, counterclockwise
+            from 3 o'clock (as Tk's arcs).
+
+    Returns:
+        The points, from Start to Stop.
+    """
+    x, y = center
+    first, stop = np.radians(angles)
+    a = np.linspace(first, stop, sample_count(abs(stop - first) * abs(radius)))
+    # The Y-axis points down
+    return np.column_stack((x + radius * np.cos(a), y - radius * np.sin(a)))
+
+
+def distances(x: np.ndarray, y: np.ndarray,
+              ax: np.ndarray, ay: np.ndarray, bx: np.ndarray, by: np.ndarray) -> np.ndarray:
+    # The distance of every point (x, y) to the segment from (ax, ay) to (bx, by),
+    # on the coordinates as separate arrays, as NumPy is the fastest on those
+    dx, dy = bx - ax, by - ay
+    x, y = x - ax, y - ay
+    squared = dx * dx + dy * dy
+    # A segment of length 0 is a point, and t is 0 for it
+    squared[squared == 0] = 1
+    t = (x * dx + y * dy) / squared
+    np.maximum(t, 0.0, out=t)
+    np.minimum(t, 1.0, out=t)
+    x -= t * dx
+    y -= t * dy
+    return np.sqrt(x * x + y * y)
+
+
+def segment_distances(points: np.ndarray, a: Sequence[float], b: Sequence[float]) -> np.ndarray:
+    """
+    Return the distance of every point to the line segment from a to b.
+    """
+    return distances(points[:, 0], points[:, 1], *np.broadcast_to(a, (len(points), 2)).T, *np.broadcast_to(b, (len(points), 2)).T)
+
+
+def simplify(points: np.ndarray, tolerance: float = default_tolerance) -> np.ndarray:
+    """
+    Simplify a polyline with the Ramer-Douglas-Peucker algorithm: keep the
+    ends, and recursively the point farthest from the segment between the
+    points kept on each side of it, while it is farther than the tolerance.
+
+    The recursion is done a level at a time, for all the segments at once,
+    so the work per level is a few NumPy operations on the points left.
+    Before that, the many points of dense curves are thinned out on a grid.
+
+    Args:
+        points: The polyline, an (n, 2) array.
+        tolerance: How far (in pixels) the simplified polyline may be from the points; 0 keeps them all.
+
+    Returns:
+        The points kept, in order.
+    """
+    count = len(points)
+    if count <= 2 or tolerance <= 0:
+        return points
+    x, y = np.ascontiguousarray(points[:, 0]), np.ascontiguousarray(points[:, 1])
+    # Of the points one after the other in the same cell of a grid, only the
+    # first and the last are needed: the others are within the diagonal of
+    # the cell from the segment between those two, which is taken off the tolerance
+    cell = tolerance / 4
+    column, row = np.floor(x / cell), np.floor(y / cell)
+    moved = (column[1:] != column[:-1]) | (row[1:] != row[:-1])
+    needed = np.ones(len(x), dtype=bool)
+    needed[1:-1] = moved[:-1] | moved[1:]
+    thinned = np.flatnonzero(needed)
+    x, y = x.take(thinned), y.take(thinned)
+    tolerance -= cell * math.sqrt(2)
+    count = len(thinned)
+
+    keep = np.zeros(count, dtype=bool)
+    keep[0] = keep[-1] = True
+    # The points that may still be kept, in order
+    pending = np.arange(1, count - 1)
+    while len(pending):
+        kept = np.flatnonzero(keep)
+        # The segment of every point: from kept[after - 1] to kept[after]
+        after = np.searchsorted(kept, pending)
+        first, last = kept.take(after - 1), kept.take(after)
+        far = distances(x.take(pending), y.take(pending), x.take(first), y.take(first), x.take(last), y.take(last))
+        # The points of a segment are together, as both are in order
+        new = np.ones(len(pending), dtype=bool)
+        new[1:] = after[1:] != after[:-1]
+        starts = np.flatnonzero(new)
+        farthest = np.maximum.reduceat(far, starts).repeat(np.diff(np.append(starts, len(pending))))
+        split = farthest > tolerance
+        # The first point at the farthest distance, in every segment to split
+        candidates = np.flatnonzero(split & (far == farthest))
+        segments = after.take(candidates)
+        first_of_segment = np.ones(len(candidates), dtype=bool)
+        first_of_segment[1:] = segments[1:] != segments[:-1]
+        chosen = candidates[first_of_segment]
+        keep[pending.take(chosen)] = True
+        split[chosen] = False
+        pending = pending[split]
+    return points[thinned[keep]]
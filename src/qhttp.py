@@ -0,0 +1,358 @@
+#
+# Fetching the text of web pages, with an on-disk HTTP cache.
+#
+# The same pages keep coming back in the search results, and downloading,
+# parsing and splitting them again is wasted work. Pages are cached with
+# their ETag / Last-Modified validators, next to the raw body and the
+# split text; the cached copy is revalidated with a conditional GET and a
+# "304 Not Modified" answer skips download, parsing and splitting.
+#
+# Only the text of the <p> elements is used, so rather than building a
+# BeautifulSoup tree with the pure Python html.parser backend, the
+# paragraphs are pulled out with lxml when it is installed, or else with a
+# streaming extractor. See bench_parse.py for how they compare.
+#
+import os
+import json
+import time
+import zlib
+import sqlite3
+import threading
+from html.parser import HTMLParser
+import qtrace
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+# requests, BeautifulSoup, lxml and langchain are imported where they are
+# used, keeping this module cheap to import.
+if TYPE_CHECKING:
+    import requests
+
+
+default_cache_path = "./qcache/http.db"
+default_max_entries = 2000
+
+# Start tags that implicitly close an open <p> element
+p_closing_tags = {
+    'address', 'article', 'aside', 'blockquote', 'details', 'div', 'dl', 'fieldset',
+    'figcaption', 'figure', 'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'header', 'hgroup', 'hr', 'main', 'menu', 'nav', 'ol', 'p', 'pre', 'section',
+    'table', 'ul',
+}
+
+# End tags of elements that can contain a <p>, which close it as well
+p_parent_end_tags = p_closing_tags | {
+    'body', 'caption', 'dd', 'dt', 'html', 'li', 'object', 'td', 'template', 'th', 'video',
+}
+
+
+class ParagraphExtractor(HTMLParser):
+    """
+    Collects the text of the <p> elements of a page as it is fed, without
+    building a document tree. An open <p> is closed by the tags that close
+    it in HTML, as well as by the end of its parent element.
+    """
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.paragraphs: List[str] = []
+        self.current: Optional[List[str]] = None
+
+    def handle_starttag(self, tag, attrs):
+        if tag in p_closing_tags:
+            self.close_paragraph()
+        if tag == 'p':
+            self.current = []
+
+    def handle_endtag(self, tag):
+        if tag in p_parent_end_tags:
+            self.close_paragraph()
+
+    def handle_data(self, data):
+        if self.current is not None:
+            self.current.append(data)
+
+    def close_paragraph(self):
+        if self.current is not None:
+            self.paragraphs.append(''.join(self.current))
+            self.current = None
+
+    def close(self):
+        super().close()
+        self.close_paragraph()
+
+
+def _stream_paragraphs(html: str) -> List[str]:
+    extractor = ParagraphExtractor()
+    extractor.feed(html)
+    extractor.close()
+    return extractor.paragraphs
+
+
+def _lxml_paragraphs(html: str) -> List[str]:
+    import lxml.html
+
+    if not html.strip():
+        return []
+    try:
+        root = lxml.html.document_fromstring(html)
+    except ValueError:
+        # A str with an XML encoding declaration, which lxml refuses
+        return _stream_paragraphs(html)
+    return [p.text_content() for p in root.iter('p')]
+
+
+def _bs4_paragraphs(html: str) -> List[str]:
+    from bs4 import BeautifulSoup
+
+    soup = BeautifulSoup(html, 'html.parser')
+    return [p.text for p in soup.find_all('p')]
+
+
+parsers = {
+    'lxml': _lxml_paragraphs,
+    'stream': _stream_paragraphs,
+    'bs4': _bs4_paragraphs,
+}
+
+
+def default_parser() -> str:
+    """
+    The fastest parser available: lxml if it is installed, else the streaming extractor.
+    """
+    try:
+        import lxml.html  # noqa: F401
+        return 'lxml'
+    except ImportError:
+        return 'stream'
+
+
+def extract_paragraphs(html: str, parser: Optional[str] = None) -> str:
+    """
+    Extract the text of the <p> elements of the page.
+
+    Args:
+        html (str): The page.
+        parser (str, optional): One of 'lxml', 'stream' or 'bs4'. Defaults to the fastest available.
+
+    Returns:
+        str: The text of the paragraphs, separated by spaces.
+    """
+    return ' '.join(parsers[parser or default_parser()](html))
+
+
+def split_text(text: str, chunk_size: int = 500, chunk_overlap: int = 50) -> List[str]:
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    return text_splitter.split_text(text)
+
+
+class HttpCache:
+    """
+    A size bounded, least recently used, on-disk cache of web pages: the
+    validators, the (compressed) body and the split text of each URL.
+
+    Attributes:
+        path: Path of the SQLite database file.
+        max_entries: Max number of pages to keep before evicting the least recently used.
+        revalidated: Number of cached pages the server confirmed as not modified.
+        fetched: Number of pages that had to be downloaded.
+        evictions: Number of pages evicted from the cache.
+    """
+
+    def __init__(self, path: str = default_cache_path, max_entries: int = default_max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.revalidated = 0
+        self.fetched = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages ("
+            " url TEXT PRIMARY KEY,"
+            " etag TEXT,"
+            " last_modified TEXT,"
+            " body BLOB NOT NULL,"
+            " split_key TEXT NOT NULL,"
+            " splits TEXT NOT NULL,"
+            " last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS pages_lru ON pages (last_used)")
+        self.conn.commit()
+
+    def get(self, url: str) -> Optional[Dict[str, Any]]:
+        """
+        Return the cached page, or None if the URL isn't cached.
+        """
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT etag, last_modified, body, split_key, splits FROM pages WHERE url = ?", (url,)
+            ).fetchone()
+        if row is None:
+            return None
+        etag, last_modified, body, split_key, splits = row
+        return {
+            'etag': etag,
+            'last_modified': last_modified,
+            'body': zlib.decompress(body).decode('utf-8'),
+            'split_key': split_key,
+            'splits': json.loads(splits),
+        }
+
+    def put(self,
+            url: str,
+            etag: Optional[str],
+            last_modified: Optional[str],
+            body: str,
+            split_key: str,
+            splits: List[str]
+            ) -> None:
+        """
+        Store a page, evicting the least recently used pages if the cache
+        grows beyond max_entries.
+        """
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO pages (url, etag, last_modified, body, split_key, splits, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, etag, last_modified, zlib.compress(body.encode('utf-8')), split_key, json.dumps(splits), time.time())
+            )
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+            if entries > self.max_entries:
+                cursor = self.conn.execute(
+                    "DELETE FROM pages WHERE rowid IN"
+                    " (SELECT rowid FROM pages ORDER BY last_used, rowid LIMIT ?)",
+                    (entries - self.max_entries,)
+                )
+                self.evictions += cursor.rowcount
+            self.conn.commit()
+
+    def touch(self, url: str) -> None:
+        with self.lock:
+            self.conn.execute("UPDATE pages SET last_used = ? WHERE url = ?", (time.time(), url))
+            self.conn.commit()
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            (entries,) = self.conn.execute("SELECT COUNT(*) FROM pages").fetchone()
+            lookups = self.revalidated + self.fetched
+            return {
+                'entries': entries,
+                'revalidated': self.revalidated,
+                'fetched': self.fetched,
+                'evictions': self.evictions,
+                'hit_rate': self.revalidated / lookups if lookups else 0.0,
+            }
+
+    def close(self) -> None:
+        with self.lock:
+            self.conn.close()
+
+
+_shared_cache = None
+_shared_cache_lock = threading.Lock()
+
+
+def get_http_cache() -> Optional[HttpCache]:
+    """
+    Return the process wide HTTP cache, or None if caching is turned off.
+
+    The cache location and size are taken from the QAI_HTTP_CACHE and
+    QAI_HTTP_CACHE_SIZE environment variables; set QAI_HTTP_CACHE=off
+    to disable the cache.
+    """
+    global _shared_cache
+    path = os.getenv('QAI_HTTP_CACHE', default_cache_path)
+    if path.lower() in ('', 'off', 'none'):
+        return None
+    with _shared_cache_lock:
+        if _shared_cache is None:
+            max_entries = int(os.getenv('QAI_HTTP_CACHE_SIZE', default_max_entries))
+            _shared_cache = HttpCache(path, max_entries=max_entries)
+        return _shared_cache
+
+
+def fetch_text_splits(url: str,
+                      session: Optional['requests.Session'] = None,
+                      cache: Optional[HttpCache] = None,
+                      timeout: Optional[float] = 4.0,
+                      verify: bool = True,
+                      chunk_size: int = 500,
+                      chunk_overlap: int = 50,
+                      parser: Optional[str] = None
+                      ) -> List[str]:
+    """
+    Fetch the page at the URL and return the text of its paragraphs, split
+    into chunks. A cached page is revalidated with a conditional GET and,
+    if it hasn't been modified, its cached text splits are returned.
+
+    Args:
+        url (str): The URL to extract content from.
+        session (requests.Session, optional): Session to fetch with. Defaults to a plain request.
+        cache (HttpCache, optional): The cache of pages. Defaults to no caching.
+        timeout (float, optional): Seconds to wait for the server. Defaults to 4.0.
+        verify (bool): Verify the TLS certificate of the server. Defaults to True.
+        chunk_size (int): Max number of characters of a split. Defaults to 500.
+        chunk_overlap (int): Number of characters of overlap between splits. Defaults to 50.
+        parser (str, optional): See extract_paragraphs(). Defaults to the fastest available.
+
+    Returns:
+        List[str]: The text splits.
+    """
+    import requests
+
+    with qtrace.span('fetch', url=url) as fetch_span:
+        http = session or requests
+        split_key = f"{chunk_size}:{chunk_overlap}"
+        cached = cache.get(url) if cache else None
+        headers = {}
+        if cached and cached['etag']:
+            headers['If-None-Match'] = cached['etag']
+        if cached and cached['last_modified']:
+            headers['If-Modified-Since'] = cached['last_modified']
+
+        response = http.get(url, headers=headers, verify=verify, timeout=timeout)
+        fetch_span.set(status=response.status_code)
+        if cached and response.status_code == 304:
+            with cache.lock:
+                cache.revalidated += 1
+            fetch_span.set(cache="revalidated")
+            if cached['split_key'] == split_key:
+                cache.touch(url)
+                fetch_span.set(chunks=len(cached['splits']))
+                return cached['splits']
+            body = cached['body']
+            etag, last_modified = cached['etag'], cached['last_modified']
+        else:
+            if cache:
+                with cache.lock:
+                    cache.fetched += 1
+            body = response.text
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            if qtrace.tracer.enabled:
+                fetch_span.set(bytes=len(response.content))
+
+        with qtrace.span('parse', parser=parser or default_parser()) as parse_span:
+            text = extract_paragraphs(body, parser)
+            parse_span.set(chars=len(text))
+        with qtrace.span('split') as split_span:
+            text_splits = split_text(text, chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+            split_span.set(chunks=len(text_splits))
+        fetch_span.set(chunks=len(text_splits))
+
+        # Without a validator the page can't be revalidated, so there is no point keeping it.
+        if cache and response.status_code in (200, 304) and (etag or last_modified):
+            cache.put(url, etag, last_modified, body, split_key, text_splits)
+        return text_splits
@@ -4,7 +4,15 @@
 #   Poster_Link,Series_Title,Released_Year,Certificate,Runtime,Genre,IMDB_Rating,Overview,Meta_score,Director,Star1,Star2,Star3,Star4,No_of_Votes,Gross
 import argparse
 import csv
+import hashlib
+import json
+import os
+import sqlite3
+from typing import Any, Dict, Iterator, List, Optional, Tuple
 from qutils import VectorStore, print_verbose, Spinner
+import qtrace
+from qembed import get_embedding_cache
+from qclient import default_server_url, forward_to_server
 
 template="""
 Title: {title}
@@ -14,11 +22,197 @@ Starring: {starring}
 Story: {story}
 """
 
-def parse_csv(file_path):
-    with open(file_path, 'r') as file:
-        reader = csv.DictReader(file)
-        data = [row for row in reader]
-    return data
+def iter_csv(file_path) -> Iterator[Dict[str, str]]:
+    """
+    Read the rows of the CSV file lazily, one at a time.
+    """
+    with open(file_path, 'r', newline='') as file:
+        for row in csv.DictReader(file):
+            yield row
+
+
+def format_entry(row: Dict[str, str]) -> str:
+    return template.format(
+        title = row['Series_Title'],
+        rating = row['IMDB_Rating'],
+        genre = row['Genre'],
+        starring = f"{row['Star1']}, {row['Star2']}, {row['Star3']}",
+        story = row['Overview']
+    )
+
+
+def genre_key(genre: str) -> str:
+    """
+    The metadata key flagging a genre. Chroma metadata values can't be sets,
+    so every genre of a row is stored as a boolean key of its own.
+    """
+    return "genre_" + genre.strip().lower()
+
+
+def row_metadata(row: Dict[str, str]) -> Dict[str, Any]:
+    """
+    The typed metadata of a row, which the search flags filter on.
+    Values that can't be parsed (e.g. a year of "PG") are left out.
+    """
+    metadata = {
+        'poster_link': row['Poster_Link'],
+        'title': row['Series_Title'],
+        'director': row['Director'].strip(),
+    }
+    for number in range(1, 5):
+        if row.get(f'Star{number}'):
+            metadata[f'star{number}'] = row[f'Star{number}'].strip()
+    for genre in row['Genre'].split(','):
+        if genre.strip():
+            metadata[genre_key(genre)] = True
+    if row['Released_Year'].strip().isdigit():
+        metadata['year'] = int(row['Released_Year'])
+    try:
+        metadata['rating'] = float(row['IMDB_Rating'])
+    except ValueError:
+        pass
+    return metadata
+
+
+def parse_year_range(release_year: str) -> Tuple[int, int]:
+    """
+    Parse a release year ("1994") or an inclusive range of years ("1990-1999").
+    """
+    first, _, last = release_year.partition('-')
+    return int(first), int(last or first)
+
+
+def build_filter(args) -> Optional[Dict[str, Any]]:
+    """
+    Turn the genre, rating, director and release year flags into a Chroma
+    `where` filter, so that only the matching rows are ranked by similarity.
+
+    Returns:
+        Optional[Dict[str, Any]]: The filter, or None if no flag is given.
+    """
+    conditions = []
+    if args.genre:
+        conditions.append({genre_key(args.genre): True})
+    if args.rating:
+        conditions.append({'rating': {'$gte': float(args.rating)}})
+    if args.director:
+        conditions.append({'director': args.director.strip()})
+    if args.release_year:
+        first, last = parse_year_range(args.release_year)
+        if first == last:
+            conditions.append({'year': first})
+        else:
+            conditions.append({'year': {'$gte': first}})
+            conditions.append({'year': {'$lte': last}})
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {'$and': conditions}
+
+
+def row_id(row: Dict[str, str]) -> str:
+    """
+    A stable id for a row, so that it survives rows being added or removed
+    elsewhere in the CSV file.
+    """
+    key = f"{row['Series_Title']}|{row['Released_Year']}|{row['Director']}"
+    return "id-" + hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+
+class IndexManifest:
+    """
+    Keeps track of the hash of every row stored in the VectorStore DB, so that
+    only new or changed rows have to be embedded when the CSV file changes.
+    It is updated after each stored batch, which makes it the checkpoint
+    an interrupted build resumes from.
+    """
+
+    def __init__(self, persist_directory: str):
+        os.makedirs(persist_directory, exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(persist_directory, "qimdb_manifest.db"))
+        self.conn.execute("CREATE TABLE IF NOT EXISTS rows (id TEXT PRIMARY KEY, hash TEXT NOT NULL)")
+        self.conn.commit()
+
+    def hashes(self) -> Dict[str, str]:
+        return dict(self.conn.execute("SELECT id, hash FROM rows"))
+
+    def update(self, ids: List[str], hashes: List[str]) -> None:
+        self.conn.executemany("INSERT OR REPLACE INTO rows (id, hash) VALUES (?, ?)", zip(ids, hashes))
+        self.conn.commit()
+
+    def delete(self, ids: List[str]) -> None:
+        self.conn.executemany("DELETE FROM rows WHERE id = ?", [(entry_id,) for entry_id in ids])
+        self.conn.commit()
+
+    def close(self) -> None:
+        self.conn.close()
+
+
+@qtrace.traced('index')
+def update_index(v: VectorStore, csv_file: str, persist_directory: str, batch_size: int = 256) -> Dict[str, int]:
+    """
+    Bring the VectorStore DB up to date with the CSV file: new and changed
+    rows are embedded and stored in batches, and removed rows are deleted.
+
+    Args:
+        v (VectorStore): The VectorStore to update.
+        csv_file (str): Location of the CSV file.
+        persist_directory (str): Directory where the VectorStore DB is stored.
+        batch_size (int): Number of rows to embed and store per batch.
+
+    Returns:
+        Dict[str, int]: The number of rows that were stored, deleted and unchanged.
+    """
+    manifest = IndexManifest(persist_directory)
+    stored = manifest.hashes()
+    if not stored and v.db:
+        # A DB built before we kept a manifest; its ids can't be mapped to rows.
+        v.delete(v.db.get(include=[])['ids'])
+
+    counts = {'stored': 0, 'deleted': 0, 'unchanged': 0}
+    seen = set()
+    entries, metadatas, ids, hashes = [], [], [], []
+
+    def flush():
+        v.upsert(entries, metadatas, ids)
+        manifest.update(ids, hashes)
+        counts['stored'] += len(ids)
+        print_verbose(f"<info> Stored {counts['stored']} rows")
+        for batch in (entries, metadatas, ids, hashes):
+            batch.clear()
+
+    for row in iter_csv(csv_file):
+        entry_id = row_id(row)
+        if entry_id in seen:
+            continue
+        seen.add(entry_id)
+        entry = format_entry(row)
+        metadata = row_metadata(row)
+        # A row embedded by another embedding model has to be embedded again
+        entry_hash = hashlib.sha256(f"{v.embedding_id}|{entry}|{json.dumps(metadata, sort_keys=True)}".encode('utf-8')).hexdigest()
+        if stored.get(entry_id) == entry_hash:
+            counts['unchanged'] += 1
+            continue
+        entries.append(entry)
+        metadatas.append(metadata)
+        ids.append(entry_id)
+        hashes.append(entry_hash)
+        if len(ids) >= batch_size:
+            flush()
+    if ids:
+        flush()
+
+    removed = [entry_id for entry_id in stored if entry_id not in seen]
+    if removed:
+        v.open()
+        v.delete(removed)
+        manifest.delete(removed)
+        counts['deleted'] = len(removed)
+
+    manifest.close()
+    qtrace.current().set(**counts)
+    return counts
 
 
 def genres():
@@ -27,30 +221,34 @@ def genres():
         'Comedy', 'History', 'Adventure', 'Sport', 'Biography', 'Film-Noir', 'Horror'}
 
 
-def main() -> None:
-    # Default directory where to store the VectorStore DB
-    default_persist_directory = "qimdb"
+# Default directory where to store the VectorStore DB
+default_persist_directory = "qimdb"
 
-    # Default location of the CSV file
-    default_csv_file = "./data/imdb_top_1000.csv"
+# Default location of the CSV file
+default_csv_file = "./data/imdb_top_1000.csv"
 
-    # Default number of results
-    default_num_of_results = 3
+# Default number of results
+default_num_of_results = 3
 
+
+def parse_args():
     genre_set = genres()
     genre_help_text = "Genre of the movie. Possible values are: " + ", ".join(genre_set)
 
     parser = argparse.ArgumentParser(description='Search for similar Movies')
     parser.add_argument('--title', type=str, help='Title of the movie')
     parser.add_argument('--genre', type=str, help=genre_help_text)
-    parser.add_argument('--rating', type=str, help='IMDB rating of the movie')
+    parser.add_argument('--rating', type=str, help='Minimum IMDB rating of the movie')
     parser.add_argument('--stars', type=str, help='Stars of the movie (separated by comma)')
     parser.add_argument('--director', type=str, help='Director of the movie')
-    parser.add_argument('--release-year', type=str, help='Release year of the movie')
+    parser.add_argument('--release-year', type=str, help='Release year of the movie, or a range of years (e.g. 1990-1999)')
     parser.add_argument('--story', type=str, help='Story of the movie')
     parser.add_argument('--db-dir', type=str, help='Directory where to store the VectorStore DB')
     parser.add_argument('--csv-file', type=str, help='Location of CSV file')
     parser.add_argument('--num-of-results', type=int, help='Number of returned results')
+    parser.add_argument('--batch-size', type=int, default=256, help='Number of rows to embed and store per batch (default: 256)')
+    parser.add_argument('--skip-update', action='store_true', help='Use the existing VectorStore DB without checking the CSV file for changes')
+    parser.add_argument('--server', nargs='?', const=default_server_url, default=None, help=f'Ask a running qserver instead (default: {default_server_url})')
 
     args = parser.parse_args()
 
@@ -58,60 +256,79 @@ def main() -> None:
         print(f"Error: Invalid genre '{args.genre}'. Use --help to see valid genres.")
         exit(1)
 
-    # Parse the CSV file
-    csv_file = args.csv_file or default_csv_file
-    data = parse_csv(csv_file)
-
-    # Format the entries to be stored in the VectorStore DB
-    entries = []
-    metadatas = []
-    ids = []
-    #genres = set()
-    for index, d in enumerate(data):
-        #genre_list = d['Genre'].split(', ')
-        #for genre in genre_list:
-        #    genres.add(genre)
-        e = template.format(
-            title = d['Series_Title'],
-            rating = d['IMDB_Rating'],
-            genre = d['Genre'],
-            starring = f"{d['Star1']}, {d['Star2']}, {d['Star3']}",
-            story = d['Overview']
-        )
-        entries.append(e)
-        metadatas.append({'poster_link': d['Poster_Link']})
-        ids.append(f"id{index}")
- 
-    # Store the entries in the VectorStore DB
-    persist_directory = args.db_dir or default_persist_directory
-    v = VectorStore(persist_directory=persist_directory)
-    if not v.db:
-        print(f"Storing into VectorStore as: {persist_directory}")
-        spinner = Spinner()
-        spinner.start()
-        v.store(entries, metadatas, ids, persist_directory=persist_directory)
-        spinner.stop()
-    else:
-        print(f"Using existing VectorStore at: {persist_directory}")
+    try:
+        if args.rating:
+            float(args.rating)
+        if args.release_year:
+            parse_year_range(args.release_year)
+    except ValueError:
+        print("Error: The rating must be a number and the release year a year or a range of years.")
+        exit(1)
 
-    # Run the Similarity Search!
+    return args
+
+
+@qtrace.traced('qimdb')
+def similarity_search(v: VectorStore, args) -> str:
+    """
+    Run the similarity search described by the command line arguments.
+    The genre, rating, director and release year are hard constraints that
+    filter the rows before the rest is ranked by similarity.
+
+    Returns:
+        str: The matching entries, separated by blank lines.
+    """
     query = template.format(
             title = args.title or "",
-            rating = args.rating or "",
-            genre = args.genre or "",
+            rating = "",
+            genre = "",
             starring = args.stars or "",
             story = args.story or ""
             )
+    where = build_filter(args)
+    print_verbose(f"<info> Filter: {where}")
     num_results = args.num_of_results or default_num_of_results
-    similarity_result = v.similarity_search(query=query, num_results=num_results)
-    search_result = "\n\n".join([result.page_content.strip() for result in similarity_result])
+    similarity_result = v.similarity_search(query=query, num_results=num_results, where=where)
+    return "\n\n".join([result.page_content.strip() for result in similarity_result])
+
+
+def main() -> None:
+    args = parse_args()
+
+    if args.server:
+        # Let the (warm) qserver do the work
+        print("")
+        print(forward_to_server(args.server, 'qimdb', vars(args)))
+        return
+
+    # Bring the VectorStore DB up to date with the CSV file
+    csv_file = args.csv_file or default_csv_file
+    persist_directory = args.db_dir or default_persist_directory
+    v = VectorStore(persist_directory=persist_directory)
+    if v.db and args.skip_update:
+        print(f"Using existing VectorStore at: {persist_directory}")
+    else:
+        print(f"Updating VectorStore at: {persist_directory}")
+        spinner = Spinner()
+        spinner.start()
+        try:
+            counts = update_index(v, csv_file, persist_directory, batch_size=args.batch_size)
+        finally:
+            spinner.stop()
+        print(f"Stored {counts['stored']}, deleted {counts['deleted']}, kept {counts['unchanged']} entries")
+
+    # Run the Similarity Search!
+    search_result = similarity_search(v, args)
 
     # Print out the answer!
     print("")
     print(search_result)
 
+    embed_cache = get_embedding_cache()
+    if embed_cache:
+        print_verbose(f"<info> Embedding cache: {embed_cache.stats()}")
+
 
 
 if __name__ == "__main__":
     main()
-
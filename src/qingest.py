@@ -0,0 +1,95 @@
+#
+# Ingestion of PDF files: parallel page extraction and chunking.
+#
+# Used by qai_pdf.py. It lives in a module of its own so that the worker
+# processes can import the extraction function (a Streamlit script can't
+# be imported).
+#
+import os
+import hashlib
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor
+from typing import (
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# Below this number of pages, starting worker processes costs more than it saves.
+min_pages_per_worker = 8
+
+
+def content_hash(contents: bytes) -> str:
+    return hashlib.sha256(contents).hexdigest()
+
+
+def extract_page_range(pdf_contents: bytes, start: int, stop: int) -> List[Tuple[int, str]]:
+    """
+    Extract the text of the pages start..stop-1 of a PDF.
+
+    Returns:
+        List[Tuple[int, str]]: The (1-based) page number and text of each page.
+    """
+    import PyPDF2
+
+    pdf_reader = PyPDF2.PdfReader(BytesIO(pdf_contents))
+    return [(page_number + 1, pdf_reader.pages[page_number].extract_text() or "")
+            for page_number in range(start, stop)]
+
+
+def extract_pages(pdf_contents: bytes, max_workers: Optional[int] = None) -> List[Tuple[int, str]]:
+    """
+    Extract the text of all pages of a PDF, spreading the pages over a pool of processes.
+
+    Args:
+        pdf_contents (bytes): The PDF file contents.
+        max_workers (int, optional): Max number of processes. Defaults to the number of CPUs.
+
+    Returns:
+        List[Tuple[int, str]]: The (1-based) page number and text of each page, in order.
+    """
+    import PyPDF2
+
+    num_pages = len(PyPDF2.PdfReader(BytesIO(pdf_contents)).pages)
+    workers = min(max_workers or os.cpu_count() or 1, num_pages // min_pages_per_worker)
+    if workers <= 1:
+        return extract_page_range(pdf_contents, 0, num_pages)
+
+    step = -(-num_pages // workers)
+    ranges = [(start, min(start + step, num_pages)) for start in range(0, num_pages, step)]
+    pages = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(extract_page_range, pdf_contents, start, stop) for start, stop in ranges]
+        for future in futures:
+            pages.extend(future.result())
+    return pages
+
+
+def split_pages(pages: List[Tuple[int, str]],
+                source: str,
+                chunk_size: int = 1000,
+                chunk_overlap: int = 100
+                ) -> Tuple[List[str], List[Dict]]:
+    """
+    Split the pages into overlapping chunks, remembering the page of each chunk.
+
+    Args:
+        pages (List[Tuple[int, str]]): The page number and text of each page.
+        source (str): The name of the PDF file.
+        chunk_size (int): Max number of characters of a chunk.
+        chunk_overlap (int): Number of characters of overlap between chunks.
+
+    Returns:
+        Tuple[List[str], List[Dict]]: The chunks and their metadata.
+    """
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+    text_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    texts = []
+    metadatas = []
+    for page_number, text in pages:
+        for split in text_splitter.split_text(text):
+            texts.append(split)
+            metadatas.append({'source': source, 'page': page_number})
+    return texts, metadatas
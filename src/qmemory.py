@@ -0,0 +1,180 @@
+#
+# Conversation memory for the chat and game loops.
+#
+# Replaying the whole transcript in every prompt makes every turn slower
+# than the last. A ConversationMemory keeps the cost of a turn flat in one
+# of two ways:
+#
+#  - Context reuse: the `context` tokens Ollama returns with a response
+#    (see qai.py) are passed back with the next prompt, so only the new
+#    input has to be evaluated. Once the context grows beyond the token
+#    budget it is dropped and a new one is started from a summary.
+#
+#  - A sliding window: the most recent turns that fit in the token budget
+#    are put in the prompt verbatim, after a summary of the older ones.
+#
+# Either way, the turns that no longer fit are condensed into a rolling
+# summary in the background, while the user is typing the next input.
+#
+import threading
+from typing import (
+    Callable,
+    List,
+    Optional,
+    Tuple,
+)
+from qpack import TokenCounter
+
+
+summary_template = """
+Summarize the conversation below in at most {max_words} words. Keep the facts,
+names and numbers that later turns may refer to. Only output the summary.
+
+Summary of the earlier conversation:
+{summary}
+
+Conversation:
+{transcript}
+"""
+
+# Max length of the summary when the model fails to summarize
+max_fallback_chars = 2000
+
+
+def ollama_summarizer(model: str, max_words: int = 150) -> Callable[[str, str], str]:
+    """
+    Return a function that summarizes a transcript (and an earlier summary) with an Ollama model.
+    """
+    def summarize(summary: str, transcript: str) -> str:
+        import qollama
+
+        prompt = summary_template.format(max_words=max_words, summary=summary or "(none)", transcript=transcript)
+        # Summaries are made in the background, so they give way to the user's requests
+        output = qollama.generate(model=model, prompt=prompt, priority=qollama.BULK, options={"temperature": 0.0})
+        return output['response'].strip()
+
+    return summarize
+
+
+class ConversationMemory:
+    """
+    Remembers a conversation within a token budget: as recent turns (or the
+    Ollama context of them) plus a rolling summary of the older turns.
+
+    Attributes:
+        budget: Max number of tokens of turns (or context) to carry over.
+        reuse_context: Carry the turns over as Ollama context rather than as text.
+        context: The Ollama context tokens to pass with the next prompt, if any.
+        summary: Summary of the turns that no longer fit in the budget.
+        turns: The recent (input, response) turns.
+        summarizations: Number of times turns have been summarized.
+    """
+
+    def __init__(self,
+                 model: str,
+                 budget: int = 4096,
+                 reuse_context: bool = True,
+                 summarize: Optional[Callable[[str, str], str]] = None,
+                 counter: Optional[TokenCounter] = None,
+                 user: str = "User",
+                 assistant: str = "Assistant"
+                 ):
+        self.budget = budget
+        self.reuse_context = reuse_context
+        self.summarize = summarize or ollama_summarizer(model)
+        self.counter = counter or TokenCounter(model)
+        self.user = user
+        self.assistant = assistant
+        self.context: Optional[List[int]] = None
+        self.summary = ""
+        self.turns: List[Tuple[str, str]] = []
+        self.turn_tokens: List[int] = []
+        self.summarizations = 0
+        # Turns waiting to be summarized, and the thread doing it
+        self.pending: List[Tuple[str, str]] = []
+        self.summarizing: List[Tuple[str, str]] = []
+        self.summarizer: Optional[threading.Thread] = None
+        self.lock = threading.Lock()
+
+    def next_context(self) -> Optional[List[int]]:
+        """
+        Return the context to continue the conversation with, or None to
+        start a new one (with history() in the prompt).
+        """
+        if self.reuse_context and self.context is None:
+            # The new context starts from the summary of the old one
+            self.wait()
+        return self.context
+
+    def history(self) -> str:
+        """
+        Return the conversation to put in the prompt: nothing while a context
+        is being continued, else the summary and the turns in the window.
+        Turns that are still being summarized are included verbatim.
+        """
+        if self.reuse_context and self.context is not None:
+            return ""
+        with self.lock:
+            summary = self.summary
+            turns = self.summarizing + self.pending + self.turns
+        parts = []
+        if summary:
+            parts.append(f"Summary of the conversation so far:\n{summary}\n")
+        if turns:
+            parts.append(self.transcript(turns))
+        return "\n".join(parts)
+
+    def record(self, user_input: str, response: str, context: Optional[List[int]] = None) -> None:
+        """
+        Remember a turn (and the context returned with its response, when
+        reusing context). The turns that no longer fit in the budget are
+        summarized in the background.
+        """
+        tokens = self.counter.count(self.transcript([(user_input, response)]))
+        with self.lock:
+            self.turns.append((user_input, response))
+            self.turn_tokens.append(tokens)
+            if self.reuse_context:
+                self.context = context
+                if context is None or len(context) > self.budget:
+                    self.context = None
+                    self.pending.extend(self.turns)
+                    self.turns, self.turn_tokens = [], []
+            else:
+                # Keep at least the last turn
+                while sum(self.turn_tokens) > self.budget and len(self.turns) > 1:
+                    self.pending.append(self.turns.pop(0))
+                    self.turn_tokens.pop(0)
+            if self.pending and not self.summarizer:
+                self.summarizer = threading.Thread(target=self._summarize_pending, daemon=True)
+                self.summarizer.start()
+
+    def wait(self) -> None:
+        """
+        Wait for the summarization in progress to finish.
+        """
+        summarizer = self.summarizer
+        if summarizer:
+            summarizer.join()
+
+    def transcript(self, turns: List[Tuple[str, str]]) -> str:
+        return "\n".join(f"{self.user}: {user_input}\n{self.assistant}: {response}" for user_input, response in turns)
+
+    def _summarize_pending(self) -> None:
+        while True:
+            with self.lock:
+                if not self.pending:
+                    self.summarizer = None
+                    return
+                self.summarizing, self.pending = self.pending, []
+                summary = self.summary
+            transcript = self.transcript(self.summarizing)
+            try:
+                summary = self.summarize(summary, transcript)
+            except Exception:
+                # Better the tail of the transcript than a forgotten conversation
+                summary = f"{summary}\n{transcript}".strip()[-max_fallback_chars:]
+            with self.lock:
+                self.summary = summary
+                self.summarizing = []
+                self.summarizations += 1
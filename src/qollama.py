@@ -0,0 +1,413 @@
+#
+# A client-side scheduler for the requests to Ollama, used by all the programs.
+#
+# Many processes share one Ollama host. Talking to it through the module
+# level ollama.generate()/ollama.chat() gives no limits, retries or
+# priorities, and bulk embedding competes with interactive generation.
+# The OllamaScheduler sits in between:
+#
+#  - one pooled HTTP client per process,
+#  - a cap on the requests in flight per model, and in total,
+#  - priorities: INTERACTIVE requests (a user is waiting) are let through
+#    before BULK ones (ingestion, background summaries),
+#  - backpressure: a request is rejected with OllamaBusyError when too many
+#    are already waiting, rather than queueing without bound,
+#  - retries with exponential backoff and full jitter on connection errors
+#    and overloaded (429/5xx) responses,
+#  - concurrent embedding requests for a model are coalesced into batched
+#    /api/embed calls.
+#
+# See fakeollama.py for a fake Ollama server to try it out against.
+#
+import os
+import time
+import heapq
+import random
+import itertools
+import threading
+from concurrent.futures import Future
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+)
+
+# ollama (and httpx) are imported when the scheduler is created, so that
+# importing this module stays cheap.
+
+# Request priorities, lower runs first
+INTERACTIVE = 0
+BULK = 10
+
+default_max_in_flight = 2
+default_max_total = 4
+default_max_waiting = 64
+default_retries = 3
+default_backoff = 0.5
+default_embed_batch_size = 64
+default_embed_batch_wait = 0.005
+
+retryable_status_codes = {429, 500, 502, 503, 504}
+
+
+class OllamaBusyError(Exception):
+    """
+    Raised when a request can't be queued (or waited too long) because
+    Ollama is busy with other requests.
+    """
+
+
+class PrioritySlots:
+    """
+    A semaphore that hands out its slots to the waiter with the highest
+    priority (lowest number) first, in arrival order within a priority.
+
+    Attributes:
+        limit: Number of slots.
+        max_waiting: Max number of waiters before OllamaBusyError is raised.
+        in_flight: Number of slots taken.
+    """
+
+    def __init__(self, limit: int, max_waiting: int = default_max_waiting):
+        self.limit = limit
+        self.max_waiting = max_waiting
+        self.in_flight = 0
+        self.waiting: List[Tuple[int, int]] = []
+        self.arrivals = itertools.count()
+        self.cond = threading.Condition()
+
+    def acquire(self, priority: int = INTERACTIVE, timeout: Optional[float] = None) -> None:
+        with self.cond:
+            if self.in_flight < self.limit and not self.waiting:
+                self.in_flight += 1
+                return
+            if len(self.waiting) >= self.max_waiting:
+                raise OllamaBusyError(f"{len(self.waiting)} requests are already waiting")
+
+            entry = (priority, next(self.arrivals))
+            heapq.heappush(self.waiting, entry)
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not (self.in_flight < self.limit and self.waiting[0] == entry):
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    self.waiting.remove(entry)
+                    heapq.heapify(self.waiting)
+                    self.cond.notify_all()
+                    raise OllamaBusyError(f"No slot within {timeout} seconds")
+                self.cond.wait(remaining)
+            heapq.heappop(self.waiting)
+            self.in_flight += 1
+            # The next in line may fit as well
+            self.cond.notify_all()
+
+    def release(self) -> None:
+        with self.cond:
+            self.in_flight -= 1
+            self.cond.notify_all()
+
+
+class EmbedBatcher:
+    """
+    Coalesces concurrent embedding requests for a model into batches: the
+    first request waits batch_wait seconds for others to join, then one
+    /api/embed call (per batch_size texts) embeds them all.
+    """
+
+    def __init__(self, scheduler: 'OllamaScheduler', model: str, batch_size: int, batch_wait: float):
+        self.scheduler = scheduler
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.queue: List[Tuple[int, int, List[str], Future]] = []
+        self.arrivals = itertools.count()
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self.run, daemon=True, name=f"embed-{model}")
+        self.thread.start()
+
+    def embed(self, texts: List[str], priority: int = BULK) -> List[List[float]]:
+        if not texts:
+            return []
+        future = Future()
+        with self.cond:
+            heapq.heappush(self.queue, (priority, next(self.arrivals), list(texts), future))
+            self.cond.notify()
+        return future.result()
+
+    def run(self) -> None:
+        while True:
+            with self.cond:
+                while not self.queue:
+                    self.cond.wait()
+                # Give concurrent callers a moment to join the batch
+                deadline = time.monotonic() + self.batch_wait
+                while sum(len(texts) for _, _, texts, _ in self.queue) < self.batch_size:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                batch = [heapq.heappop(self.queue)]
+                count = len(batch[0][2])
+                while self.queue and count + len(self.queue[0][2]) <= self.batch_size:
+                    count += len(self.queue[0][2])
+                    batch.append(heapq.heappop(self.queue))
+
+            texts = [text for _, _, request_texts, _ in batch for text in request_texts]
+            priority = min(request_priority for request_priority, _, _, _ in batch)
+            try:
+                vectors = []
+                for start in range(0, len(texts), self.batch_size):
+                    vectors.extend(self.scheduler.embed_batch(self.model, texts[start:start + self.batch_size], priority))
+            except Exception as e:
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            offset = 0
+            for _, _, request_texts, future in batch:
+                future.set_result(vectors[offset:offset + len(request_texts)])
+                offset += len(request_texts)
+
+
+class OllamaScheduler:
+    """
+    Schedules the requests of this process to an Ollama host.
+
+    Attributes:
+        max_in_flight: Max number of requests in flight per model.
+        max_total: Max number of requests in flight over all models.
+        max_waiting: Max number of requests waiting per model before OllamaBusyError is raised.
+        queue_timeout: Max seconds to wait for a slot, None to wait as long as it takes.
+        retries: Number of times a failed request is retried.
+        backoff: Base delay in seconds of the exponential backoff between retries.
+    """
+
+    def __init__(self,
+                 host: Optional[str] = None,
+                 max_in_flight: int = default_max_in_flight,
+                 max_total: int = default_max_total,
+                 max_waiting: int = default_max_waiting,
+                 queue_timeout: Optional[float] = None,
+                 retries: int = default_retries,
+                 backoff: float = default_backoff,
+                 embed_batch_size: int = default_embed_batch_size,
+                 embed_batch_wait: float = default_embed_batch_wait,
+                 client: Any = None
+                 ):
+        import httpx
+        import ollama
+
+        self.max_in_flight = max_in_flight
+        self.max_waiting = max_waiting
+        self.queue_timeout = queue_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.embed_batch_size = embed_batch_size
+        self.embed_batch_wait = embed_batch_wait
+        self.ResponseError = ollama.ResponseError
+        self.TransportError = httpx.TransportError
+
+        # One client, with its pool of keep-alive connections, for all requests
+        limits = httpx.Limits(max_connections=max_total * 2, max_keepalive_connections=max_total * 2)
+        self.client = client or ollama.Client(host=host, limits=limits)
+
+        self.total_slots = PrioritySlots(max_total, max_waiting=max_waiting * 4)
+        self.model_slots: Dict[str, PrioritySlots] = {}
+        self.batchers: Dict[str, EmbedBatcher] = {}
+        self.lock = threading.Lock()
+        self.counters = {'requests': 0, 'retries': 0, 'rejected': 0, 'embed_batches': 0, 'embedded': 0}
+
+    def stats(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(self.counters)
+
+    def count(self, name: str, n: int = 1) -> None:
+        with self.lock:
+            self.counters[name] += n
+
+    def slots(self, model: str) -> PrioritySlots:
+        with self.lock:
+            if model not in self.model_slots:
+                self.model_slots[model] = PrioritySlots(self.max_in_flight, max_waiting=self.max_waiting)
+            return self.model_slots[model]
+
+    def acquire(self, model: str, priority: int) -> None:
+        # Always the model slot first, then the total slot, to not deadlock
+        try:
+            self.slots(model).acquire(priority, timeout=self.queue_timeout)
+        except OllamaBusyError:
+            self.count('rejected')
+            raise
+        try:
+            self.total_slots.acquire(priority, timeout=self.queue_timeout)
+        except OllamaBusyError:
+            self.slots(model).release()
+            self.count('rejected')
+            raise
+
+    def release(self, model: str) -> None:
+        self.total_slots.release()
+        self.slots(model).release()
+
+    def retryable(self, e: Exception) -> bool:
+        if isinstance(e, self.ResponseError):
+            return e.status_code in retryable_status_codes
+        return isinstance(e, (ConnectionError, self.TransportError))
+
+    def with_retries(self, request: Callable[[], Any]) -> Any:
+        for attempt in range(self.retries + 1):
+            try:
+                self.count('requests')
+                return request()
+            except Exception as e:
+                if attempt == self.retries or not self.retryable(e):
+                    raise
+                self.count('retries')
+                # Exponential backoff with full jitter, so that clients don't retry in lockstep
+                time.sleep(random.uniform(0, self.backoff * 2 ** attempt))
+
+    def call(self, model: str, priority: int, request: Callable[[], Any]) -> Any:
+        self.acquire(model, priority)
+        try:
+            return self.with_retries(request)
+        finally:
+            self.release(model)
+
+    def stream(self, model: str, priority: int, request: Callable[[], Iterator[Any]]) -> Iterator[Any]:
+        """
+        Start a streamed request, holding its slot until the stream is
+        consumed (or closed). It is retried until the first chunk arrives.
+        """
+        self.acquire(model, priority)
+        try:
+            def first_chunk():
+                chunks = request()
+                return chunks, next(chunks, None)
+            chunks, head = self.with_retries(first_chunk)
+        except BaseException:
+            self.release(model)
+            raise
+
+        def relay():
+            try:
+                if head is not None:
+                    yield head
+                yield from chunks
+            finally:
+                self.release(model)
+
+        return relay()
+
+    def generate(self, model: str = '', prompt: Optional[str] = None, priority: int = INTERACTIVE, stream: bool = False, **kwargs) -> Any:
+        """
+        Like ollama.generate(), with a priority.
+        """
+        request = lambda: self.client.generate(model=model, prompt=prompt, stream=stream, **kwargs)
+        if stream:
+            return self.stream(model, priority, request)
+        return self.call(model, priority, request)
+
+    def chat(self, model: str = '', messages: Optional[List[Dict[str, Any]]] = None, priority: int = INTERACTIVE, stream: bool = False, **kwargs) -> Any:
+        """
+        Like ollama.chat(), with a priority.
+        """
+        request = lambda: self.client.chat(model=model, messages=messages, stream=stream, **kwargs)
+        if stream:
+            return self.stream(model, priority, request)
+        return self.call(model, priority, request)
+
+    def embed(self, model: str, texts: List[str], priority: int = BULK) -> List[List[float]]:
+        """
+        Embed the texts, batched together with the concurrent requests for the same model.
+        """
+        with self.lock:
+            if model not in self.batchers:
+                self.batchers[model] = EmbedBatcher(self, model, self.embed_batch_size, self.embed_batch_wait)
+            batcher = self.batchers[model]
+        return batcher.embed(texts, priority)
+
+    def embed_batch(self, model: str, texts: List[str], priority: int = BULK) -> List[List[float]]:
+        self.count('embed_batches')
+        self.count('embedded', len(texts))
+        response = self.call(model, priority, lambda: self.client.embed(model=model, input=texts))
+        return [list(vector) for vector in response['embeddings']]
+
+
+class ScheduledEmbeddings:
+    """
+    LangChain embeddings computed by Ollama through the shared scheduler. It
+    implements the interface of langchain_core.embeddings.Embeddings without
+    importing LangChain, like qembed.CachedEmbeddings.
+
+    Documents are embedded as BULK requests, queries as INTERACTIVE ones.
+    """
+
+    def __init__(self, model: str = "nomic-embed-text", priority: int = BULK):
+        self.model = model
+        self.priority = priority
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return get_scheduler().embed(self.model, texts, self.priority)
+
+    def embed_query(self, text: str) -> List[float]:
+        return get_scheduler().embed(self.model, [text], INTERACTIVE)[0]
+
+
+_shared_scheduler = None
+_shared_scheduler_lock = threading.Lock()
+
+
+def get_scheduler() -> OllamaScheduler:
+    """
+    Return the process wide scheduler.
+
+    The Ollama host is taken from OLLAMA_HOST, as by the ollama client, and
+    the limits from the QAI_OLLAMA_MAX_IN_FLIGHT (per model), QAI_OLLAMA_MAX_TOTAL
+    and QAI_OLLAMA_MAX_WAITING environment variables.
+    """
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = OllamaScheduler(
+                host=os.getenv('OLLAMA_HOST'),
+                max_in_flight=int(os.getenv('QAI_OLLAMA_MAX_IN_FLIGHT', default_max_in_flight)),
+                max_total=int(os.getenv('QAI_OLLAMA_MAX_TOTAL', default_max_total)),
+                max_waiting=int(os.getenv('QAI_OLLAMA_MAX_WAITING', default_max_waiting)),
+            )
+        return _shared_scheduler
+
+
+def configure_scheduler(**kwargs) -> OllamaScheduler:
+    """
+    Replace the process wide scheduler with one made with the given
+    arguments (see OllamaScheduler), for programs that set the limits
+    from their command line rather than from the environment.
+    """
+    global _shared_scheduler
+    with _shared_scheduler_lock:
+        kwargs.setdefault('host', os.getenv('OLLAMA_HOST'))
+        _shared_scheduler = OllamaScheduler(**kwargs)
+        return _shared_scheduler
+
+
+def generate(*args, **kwargs) -> Any:
+    """
+    ollama.generate() through the shared scheduler; see OllamaScheduler.generate().
+    """
+    return get_scheduler().generate(*args, **kwargs)
+
+
+def chat(*args, **kwargs) -> Any:
+    """
+    ollama.chat() through the shared scheduler; see OllamaScheduler.chat().
+    """
+    return get_scheduler().chat(*args, **kwargs)
+
+
+def embed(model: str, texts: List[str], priority: int = BULK) -> List[List[float]]:
+    """
+    Embed texts through the shared scheduler; see OllamaScheduler.embed().
+    """
+    return get_scheduler().embed(model, texts, priority)
@@ -0,0 +1,134 @@
+#
+# Context-window-aware packing of retrieved documents into a prompt.
+#
+# Ollama slows down sharply, or silently truncates the prompt, when the
+# prompt doesn't fit the context window of the model. Instead of joining
+# whatever the vector search returns, the candidate chunks are ranked,
+# deduplicated, stripped of the overlap the text splitter put between
+# neighbouring chunks, and then greedily packed into a token budget.
+#
+import re
+import hashlib
+from typing import (
+    Any,
+    Dict,
+    List,
+    Optional,
+)
+
+# Rough number of characters per token, used when tiktoken isn't available.
+# Models with smaller vocabularies need more tokens for the same text.
+chars_per_token = {
+    'llama3': 4.0,
+    'mistral': 3.5,
+    'phi3': 3.5,
+    'gemma': 4.0,
+}
+default_chars_per_token = 3.5
+
+
+class TokenCounter:
+    """
+    Counts (or estimates) the number of tokens a text takes for a model.
+
+    tiktoken's cl100k_base encoding is used when it is installed, which is
+    close to the Llama 3 tokenizer; otherwise the count is estimated from
+    the number of characters.
+    """
+
+    def __init__(self, model: str = 'llama3'):
+        self.model = model
+        family = model.split(':')[0]
+        self.chars_per_token = chars_per_token.get(family, default_chars_per_token)
+        self.encoding = None
+        if family.startswith('llama3'):
+            try:
+                import tiktoken
+                self.encoding = tiktoken.get_encoding("cl100k_base")
+            except Exception:
+                # Not installed, or the encoding can't be downloaded
+                self.encoding = None
+
+    def count(self, text: str) -> int:
+        if self.encoding:
+            return len(self.encoding.encode(text, disallowed_special=()))
+        return int(len(text) / self.chars_per_token) + 1
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r'\s+', ' ', text).strip().lower()
+
+
+def trim_overlap(other: str, text: str, max_overlap: int = 200, min_overlap: int = 10) -> str:
+    """
+    Remove the part of text that repeats the end (or beginning) of other, as
+    left by the chunk_overlap of a RecursiveCharacterTextSplitter between
+    neighbouring chunks.
+    """
+    longest = min(len(other), len(text), max_overlap)
+    for size in range(longest, min_overlap - 1, -1):
+        # text follows other
+        if other.endswith(text[:size]):
+            return text[size:].lstrip()
+        # text precedes other
+        if other.startswith(text[-size:]):
+            return text[:-size].rstrip()
+    return text
+
+
+def pack_chunks(chunks: List[Dict[str, Any]],
+                budget: int,
+                counter: Optional[TokenCounter] = None,
+                max_overlap: int = 200
+                ) -> Dict[str, Any]:
+    """
+    Pick the best chunks that fit into the token budget.
+
+    Args:
+        chunks: Candidate chunks as dicts with a 'text', an optional 'source'
+            and an optional 'distance' (lower is better, as returned by Chroma).
+        budget: Max number of tokens of the packed chunks.
+        counter: The TokenCounter of the target model. Defaults to llama3.
+        max_overlap: Max number of characters of overlap to trim between
+            chunks from the same source.
+
+    Returns:
+        A dict with the packed 'chunks' (best first), and the number of
+        'packed_tokens', 'dropped_tokens', 'dropped' chunks and 'duplicates'.
+    """
+    counter = counter or TokenCounter()
+    ranked = sorted(chunks, key=lambda chunk: chunk.get('distance', 0.0))
+
+    packed = []
+    packed_texts = []
+    seen = set()
+    packed_tokens = dropped_tokens = dropped = duplicates = 0
+    for chunk in ranked:
+        text = chunk['text']
+        normalized = _normalize(text)
+        key = hashlib.sha1(normalized.encode('utf-8')).hexdigest()
+        if key in seen or any(normalized in other for other in packed_texts):
+            duplicates += 1
+            continue
+        seen.add(key)
+
+        for other in packed:
+            if other.get('source') == chunk.get('source'):
+                text = trim_overlap(other['text'], text, max_overlap=max_overlap)
+
+        tokens = counter.count(text)
+        if packed_tokens + tokens > budget:
+            dropped += 1
+            dropped_tokens += tokens
+            continue
+        packed.append(dict(chunk, text=text, tokens=tokens))
+        packed_texts.append(normalized)
+        packed_tokens += tokens
+
+    return {
+        'chunks': packed,
+        'packed_tokens': packed_tokens,
+        'dropped_tokens': dropped_tokens,
+        'dropped': dropped,
+        'duplicates': duplicates,
+    }
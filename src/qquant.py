@@ -0,0 +1,345 @@
+#
+# Quantized embeddings, to search large in-memory collections in a fraction
+# of the memory the float32 embeddings take.
+#
+# A QuantizedIndex is a FlatIndex (see qflat) that keeps compact codes of the
+# embeddings in memory instead of the embeddings themselves:
+#
+#  - 'int8': scalar quantization, every component scaled to a byte, with one
+#    float32 scale per embedding: about 4x smaller.
+#  - 'pq': product quantization, every run of 8 components replaced by the
+#    number of the nearest of 256 centroids learned by k-means: 32x smaller.
+#
+# A search scores all codes approximately, then reranks the rerank * k best
+# candidates by their full precision embeddings. Those are kept in a memory
+# mapped temporary file, so that only the rows of the candidates are read
+# back; with rerank=0 they aren't kept at all. A persisted (Chroma) VectorDB
+# with a quantization keeps such an index without them, and fetches the
+# full precision embeddings of the candidates from Chroma to rerank them
+# (see VectorDB.quantized_index).
+#
+# measure_recall() gives the recall@k of a quantization against exact search
+# over the same embeddings, e.g. those of an existing collection (see
+# VectorDB.measure_quantization), to choose the trade-off per collection.
+# See also: bench_vdb.py --quantization
+#
+import tempfile
+from typing import (
+    TYPE_CHECKING,
+    Any,
+    Dict,
+    List,
+    Optional,
+    Sequence,
+    Tuple,
+)
+
+from qflat import FlatIndex, grown, normalized, top_k
+
+if TYPE_CHECKING:
+    import numpy
+
+# Rows scored per step, to bound the temporary memory of a search
+block_size = 16384
+
+
+class ScalarQuantizer:
+    """
+    int8 codes of the embeddings, each scaled by the largest of its components.
+    """
+
+    def __init__(self, dimensions: int, capacity: int = 256):
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self.codes: Optional['numpy.ndarray'] = None
+        self.scales: Optional['numpy.ndarray'] = None
+
+    def set(self, rows: 'numpy.ndarray', vectors: 'numpy.ndarray', size: int) -> None:
+        import numpy as np
+
+        self.codes = grown(self.codes, size, (self.dimensions,), self.capacity, np.int8)
+        self.scales = grown(self.scales, size, (), self.capacity, np.float32)
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1.0
+        self.codes[rows] = np.rint(vectors / scales[:, None]).astype(np.int8)
+        self.scales[rows] = scales
+
+    def move(self, source: int, target: int) -> None:
+        self.codes[target] = self.codes[source]
+        self.scales[target] = self.scales[source]
+
+    def decode(self, rows: 'numpy.ndarray') -> 'numpy.ndarray':
+        import numpy as np
+
+        return self.codes[rows].astype(np.float32) * self.scales[rows][:, None]
+
+    def scores(self, queries: 'numpy.ndarray', rows: 'numpy.ndarray') -> 'numpy.ndarray':
+        import numpy as np
+
+        return (queries @ self.codes[rows].T.astype(np.float32)) * self.scales[rows]
+
+    def nbytes(self, size: int) -> int:
+        return size * (self.dimensions + 4)
+
+
+def kmeans(points: 'numpy.ndarray', clusters: int, iterations: int, rng: Any) -> 'numpy.ndarray':
+    """
+    Return the centroids of the points found by Lloyd's algorithm.
+    """
+    import numpy as np
+
+    centroids = points[rng.choice(len(points), clusters, replace=False)].copy()
+    for _ in range(iterations):
+        assignment = nearest(points, centroids)
+        counts = np.bincount(assignment, minlength=clusters)
+        nonempty = counts > 0
+        for dimension in range(points.shape[1]):
+            sums = np.bincount(assignment, weights=points[:, dimension], minlength=clusters)
+            centroids[nonempty, dimension] = sums[nonempty] / counts[nonempty]
+    return centroids
+
+
+def nearest(points: 'numpy.ndarray', centroids: 'numpy.ndarray') -> 'numpy.ndarray':
+    """
+    Return the index of the centroid nearest to each point.
+    """
+    return ((centroids ** 2).sum(axis=1) - 2 * points @ centroids.T).argmin(axis=1)
+
+
+class ProductQuantizer:
+    """
+    uint8 codes of the embeddings: the number of the nearest centroid in
+    each subspace of subspace_dimensions components.
+
+    The centroids are learned from the first train_size embeddings; until
+    there are that many, they are kept (and searched) as they are.
+    """
+
+    def __init__(self,
+                 dimensions: int,
+                 capacity: int = 256,
+                 subspace_dimensions: int = 8,
+                 train_size: int = 4096,
+                 iterations: int = 10,
+                 seed: int = 0):
+        if dimensions % subspace_dimensions:
+            raise ValueError(f"Product quantization needs a multiple of {subspace_dimensions} dimensions, not {dimensions}")
+        self.dimensions = dimensions
+        self.capacity = capacity
+        self.subspace_dimensions = subspace_dimensions
+        self.subspaces = dimensions // subspace_dimensions
+        self.train_size = train_size
+        self.iterations = iterations
+        self.seed = seed
+        self.centroids: Optional['numpy.ndarray'] = None
+        self.codes: Optional['numpy.ndarray'] = None
+        self.pending: Optional['numpy.ndarray'] = None
+
+    def set(self, rows: 'numpy.ndarray', vectors: 'numpy.ndarray', size: int) -> None:
+        import numpy as np
+
+        if self.centroids is None:
+            self.pending = grown(self.pending, size, (self.dimensions,), self.capacity)
+            self.pending[rows] = vectors
+            if size < self.train_size:
+                return
+            self.train(self.pending[:size])
+            self.codes = grown(None, size, (self.subspaces,), self.capacity, np.uint8)
+            self.codes[:size] = self.encode(self.pending[:size])
+            self.pending = None
+            return
+        self.codes = grown(self.codes, size, (self.subspaces,), self.capacity, np.uint8)
+        self.codes[rows] = self.encode(vectors)
+
+    def train(self, vectors: 'numpy.ndarray') -> None:
+        import numpy as np
+
+        rng = np.random.default_rng(self.seed)
+        if len(vectors) > self.train_size:
+            vectors = vectors[rng.choice(len(vectors), self.train_size, replace=False)]
+        clusters = min(256, len(vectors))
+        self.centroids = np.stack([
+            kmeans(np.ascontiguousarray(subspace), clusters, self.iterations, rng)
+            for subspace in self.split(vectors)
+        ])
+
+    def split(self, vectors: 'numpy.ndarray') -> List['numpy.ndarray']:
+        return [vectors[:, s * self.subspace_dimensions:(s + 1) * self.subspace_dimensions]
+                for s in range(self.subspaces)]
+
+    def encode(self, vectors: 'numpy.ndarray') -> 'numpy.ndarray':
+        import numpy as np
+
+        return np.stack([nearest(subspace, centroids) for subspace, centroids in zip(self.split(vectors), self.centroids)],
+                        axis=1).astype(np.uint8)
+
+    def move(self, source: int, target: int) -> None:
+        stored = self.pending if self.centroids is None else self.codes
+        stored[target] = stored[source]
+
+    def decode(self, rows: 'numpy.ndarray') -> 'numpy.ndarray':
+        import numpy as np
+
+        if self.centroids is None:
+            return self.pending[rows]
+        codes = self.codes[rows]
+        return self.centroids[np.arange(self.subspaces), codes].reshape(len(codes), self.dimensions)
+
+    def scores(self, queries: 'numpy.ndarray', rows: 'numpy.ndarray') -> 'numpy.ndarray':
+        import numpy as np
+
+        if self.centroids is None:
+            return queries @ self.pending[rows].T
+        # The similarity of every query subspace with every centroid, looked up per code
+        tables = np.einsum('qsd,scd->qsc', queries.reshape(len(queries), self.subspaces, self.subspace_dimensions), self.centroids)
+        codes = self.codes[rows]
+        similarities = np.zeros((len(queries), len(codes)), dtype=np.float32)
+        for s in range(self.subspaces):
+            similarities += tables[:, s, codes[:, s]]
+        return similarities
+
+    def nbytes(self, size: int) -> int:
+        if self.centroids is None:
+            return size * self.dimensions * 4
+        return size * self.subspaces + self.centroids.nbytes
+
+
+quantizers = {'int8': ScalarQuantizer, 'pq': ProductQuantizer}
+
+
+class QuantizedIndex(FlatIndex):
+    """
+    A FlatIndex keeping quantized codes of the embeddings in memory.
+
+    Args:
+        quantization: 'int8' or 'pq'.
+        rerank: Candidates per result to rerank by the full precision embeddings; 0 keeps no full precision copy.
+        directory: Where to keep the full precision embeddings. Defaults to the temporary directory.
+    """
+
+    def __init__(self, quantization: str = 'int8', rerank: int = 4, directory: Optional[str] = None, capacity: int = 256):
+        if quantization not in quantizers:
+            raise ValueError(f"Unknown quantization: {quantization}, expected one of: {', '.join(quantizers)}")
+        super().__init__(capacity)
+        self.quantization = quantization
+        self.rerank = rerank
+        self.directory = directory
+        self.quantizer: Any = None
+        self.full: Optional['numpy.ndarray'] = None
+        self.file = None
+
+    def store(self, rows: List[int], vectors: 'numpy.ndarray') -> None:
+        import numpy as np
+
+        if self.quantizer is None:
+            self.quantizer = quantizers[self.quantization](vectors.shape[1], capacity=self.capacity)
+        size = len(self.ids)
+        self.quantizer.set(np.asarray(rows, dtype=np.intp), vectors, size)
+        if self.rerank:
+            self.full = self.mapped(size, vectors.shape[1])
+            self.full[rows] = vectors
+
+    def mapped(self, size: int, dimensions: int) -> 'numpy.ndarray':
+        """
+        Return the memory mapped full precision embeddings, with room for size rows.
+        """
+        import numpy as np
+
+        if self.full is not None and size <= self.full.shape[0]:
+            return self.full
+        capacity = max(size, self.capacity if self.full is None else 2 * self.full.shape[0])
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(dir=self.directory)
+        self.file.truncate(capacity * dimensions * 4)
+        return np.memmap(self.file, dtype=np.float32, mode='r+', shape=(capacity, dimensions))
+
+    def move(self, source: int, target: int) -> None:
+        self.quantizer.move(source, target)
+        if self.full is not None:
+            self.full[target] = self.full[source]
+
+    def vectors(self) -> 'numpy.ndarray':
+        """
+        The full precision embeddings if they are kept, else the decoded codes.
+        """
+        import numpy as np
+
+        if self.full is not None:
+            return self.full[:len(self.ids)]
+        if self.quantizer is None:
+            return np.empty((0, 0), dtype=np.float32)
+        return self.quantizer.decode(np.arange(len(self.ids)))
+
+    def nbytes(self) -> int:
+        """
+        The memory taken by the codes (not counting the memory mapped embeddings).
+        """
+        return self.quantizer.nbytes(len(self.ids)) if self.quantizer else 0
+
+    def search(self,
+               queries: Any,
+               k: int,
+               candidates: Optional[Sequence[int]] = None
+               ) -> List[List[Tuple[str, float]]]:
+        import numpy as np
+
+        q = normalized(queries)
+        rows = np.arange(len(self.ids)) if candidates is None else np.asarray(candidates, dtype=np.intp)
+        k = min(k, len(rows))
+        if k <= 0:
+            return [[] for _ in range(q.shape[0])]
+
+        similarities = np.concatenate([self.quantizer.scores(q, rows[start:start + block_size])
+                                       for start in range(0, len(rows), block_size)], axis=1)
+        if not self.rerank:
+            top, top_similarities = top_k(similarities, k)
+            return self.results(rows[top], top_similarities)
+
+        shortlist, _ = top_k(similarities, k * self.rerank)
+        shortlist = rows[shortlist]
+        exact = np.einsum('qd,qcd->qc', q, self.full[shortlist])
+        top, top_similarities = top_k(exact, k)
+        return self.results(np.take_along_axis(shortlist, top, axis=1), top_similarities)
+
+
+def recall_at_k(exact: List[List[str]], approximate: List[List[str]]) -> float:
+    """
+    The fraction of the exact results that the approximate search found too.
+    """
+    found = sum(len(set(e) & set(a)) for e, a in zip(exact, approximate))
+    return found / max(1, sum(len(e) for e in exact))
+
+
+def measure_recall(embeddings: Any,
+                   queries: Any,
+                   k: int = 10,
+                   quantization: str = 'int8',
+                   rerank: int = 4
+                   ) -> Dict[str, float]:
+    """
+    Compare a quantized index of the embeddings with exact search over them.
+
+    Args:
+        embeddings: The embeddings of a collection.
+        queries: Query embeddings, ideally of typical questions.
+        k: Number of results per query.
+        quantization: 'int8' or 'pq'.
+        rerank: Candidates per result reranked by the full precision embeddings.
+
+    Returns:
+        The recall@k, the bytes per embedding in memory, and the compression against float32.
+    """
+    ids = [str(i) for i in range(len(embeddings))]
+    exact = FlatIndex()
+    exact.add(ids, embeddings)
+    quantized = QuantizedIndex(quantization, rerank=rerank)
+    quantized.add(ids, embeddings)
+
+    expected = [[doc_id for doc_id, _ in hits] for hits in exact.search(queries, k)]
+    found = [[doc_id for doc_id, _ in hits] for hits in quantized.search(queries, k)]
+    bytes_per_vector = quantized.nbytes() / max(1, len(ids))
+    return {
+        'recall': recall_at_k(expected, found),
+        'bytes_per_vector': bytes_per_vector,
+        'compression': exact.dimensions * 4 / bytes_per_vector if bytes_per_vector else 0.0,
+    }
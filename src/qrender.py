@@ -0,0 +1,299 @@
+#
+# Renderers for the drawings of qutils.Painter.
+#
+# A Painter keeps the drawing state (the color and the line width) and turns
+# instructions into primitives: lines, polygons, ovals and text. A renderer
+# draws those primitives somewhere:
+#
+#  - TkRenderer, in a Tk window (the default, as in qdraw),
+#  - ImageRenderer, on a Pillow image, saved as PNG (or any format Pillow writes),
+#  - SvgRenderer, as SVG elements.
+#
+# The last two need no display, so drawings can be made on a server or in
+# CI, and render_sessions() renders many drawing sessions in parallel in a
+# worker pool. See also: bench_draw.py
+#
+#   >>> from qutils import Painter
+#   >>> p = Painter(renderer=ImageRenderer(400, 300))
+#   >>> p.handle_instruction({'draw_circle': {'center': [150, 75], 'radius': 25}})
+#   >>> p.save("circle.png")
+#
+import os
+import re
+import functools
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+from xml.sax.saxutils import escape, quoteattr
+
+import numpy as np
+
+# The points of lines and polygons, as (n, 2) arrays (see qgeom)
+Points = np.ndarray
+
+
+class TkRenderer:
+    """
+    Draws on the canvas of a Tk window. Tk may only be used from the thread
+    running its main loop: see Painter.submit().
+    """
+
+    interactive = True
+    # Every point of a line costs, so long ones are simplified first (see qgeom)
+    simplified = True
+
+    def __init__(self, title: str = "Title", width: int = 800, height: int = 600):
+        import tkinter as tk
+
+        self.root = tk.Tk()
+        self.root.title(title)
+        self.canvas = tk.Canvas(self.root, width=width, height=height, bg="white")
+        self.canvas.pack(fill="both", expand=True)
+
+    def line(self, points: Points, color: str, width: int) -> None:
+        if len(points) >= 2:
+            self.canvas.create_line(points.ravel().tolist(), fill=color, width=width)
+
+    def polygon(self, points: Points, color: str, width: int) -> None:
+        if len(points) >= 2:
+            self.canvas.create_polygon(points.ravel().tolist(), outline=color, fill="", width=width)
+
+    def oval(self, box: Tuple[float, float, float, float], outline: str, fill: str, width: int) -> None:
+        self.canvas.create_oval(*box, outline=outline, fill=fill, width=width)
+
+    def text(self, x: float, y: float, text: str, color: str) -> None:
+        self.canvas.create_text(x, y, text=text, fill=color)
+
+    def clear(self) -> None:
+        self.canvas.delete("all")
+
+    def run(self, painter: Any) -> None:
+        """
+        Run the Tk main loop, carrying out the painter's queued instructions every frame.
+        """
+        def frame():
+            if painter.draw_pending():
+                self.root.after(painter.frame_ms, frame)
+            else:
+                self.root.destroy()
+
+        self.root.after(painter.frame_ms, frame)
+        self.root.mainloop()
+
+    def save(self, path: str) -> None:
+        self.canvas.postscript(file=path)
+
+
+@functools.lru_cache(maxsize=256)
+def color_rgb(color: str) -> Optional[Tuple[int, int, int]]:
+    """
+    Return the RGB of a Tk color name, such as 'blue', 'Light Blue' or '#00ff00',
+    or None if it isn't known.
+    """
+    from PIL import ImageColor
+
+    name = color.replace(' ', '').lower()
+    for candidate in (color, name):
+        try:
+            return ImageColor.getrgb(candidate)[:3]
+        except ValueError:
+            pass
+    # Tk's gray0 to gray100
+    match = re.fullmatch(r'gr[ae]y(\d{1,3})', name)
+    if match and int(match.group(1)) <= 100:
+        level = round(int(match.group(1)) * 255 / 100)
+        return (level, level, level)
+    return None
+
+
+class ImageRenderer:
+    """
+    Draws on a Pillow image, in memory.
+    """
+
+    interactive = False
+    # Pillow draws the points of a line faster than they are simplified
+    simplified = False
+
+    def __init__(self, width: int = 800, height: int = 600, background: str = "white"):
+        from PIL import Image, ImageDraw, ImageFont
+
+        self.background = background
+        self.image = Image.new("RGB", (width, height), background)
+        self.draw = ImageDraw.Draw(self.image)
+        self.font = ImageFont.load_default()
+
+    def rgb(self, color: str) -> Tuple[int, int, int]:
+        return color_rgb(color) or (0, 0, 0)
+
+    def line(self, points: Points, color: str, width: int) -> None:
+        if len(points) >= 2:
+            self.draw.line(points.ravel().tolist(), fill=self.rgb(color), width=width, joint="curve")
+
+    def polygon(self, points: Points, color: str, width: int) -> None:
+        if len(points) >= 2:
+            self.draw.polygon(points.ravel().tolist(), outline=self.rgb(color), width=width)
+
+    def oval(self, box: Tuple[float, float, float, float], outline: str, fill: str, width: int) -> None:
+        x0, y0, x1, y1 = box
+        self.draw.ellipse((min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1)),
+                          outline=self.rgb(outline), fill=self.rgb(fill) if fill else None, width=width)
+
+    def text(self, x: float, y: float, text: str, color: str) -> None:
+        # Centered on (x, y), as on a Tk canvas
+        left, top, right, bottom = self.draw.textbbox((0, 0), text, font=self.font)
+        self.draw.text((x - (right + left) / 2, y - (bottom + top) / 2), text, fill=self.rgb(color), font=self.font)
+
+    def clear(self) -> None:
+        self.draw.rectangle((0, 0) + self.image.size, fill=self.background)
+
+    def save(self, path: str) -> None:
+        self.image.save(path)
+
+
+class SvgRenderer:
+    """
+    Collects the drawing as SVG elements.
+    """
+
+    interactive = False
+    simplified = True
+
+    def __init__(self, width: int = 800, height: int = 600, background: str = "white"):
+        self.width = width
+        self.height = height
+        self.background = background
+        self.elements: List[str] = []
+
+    @staticmethod
+    def color(color: str) -> str:
+        try:
+            rgb = color_rgb(color)
+        except ImportError:
+            # Without Pillow, the name is left to the SVG viewer
+            return quoteattr(color)
+        return quoteattr('#%02x%02x%02x' % rgb if rgb else 'black')
+
+    @staticmethod
+    def points(points: Points) -> str:
+        return quoteattr(' '.join(f"{x:g},{y:g}" for x, y in points.tolist()))
+
+    def line(self, points: Points, color: str, width: int) -> None:
+        self.elements.append(f'<polyline points={self.points(points)} fill="none" stroke={self.color(color)} '
+                             f'stroke-width="{width}" stroke-linejoin="round"/>')
+
+    def polygon(self, points: Points, color: str, width: int) -> None:
+        self.elements.append(f'<polygon points={self.points(points)} fill="none" stroke={self.color(color)} '
+                             f'stroke-width="{width}"/>')
+
+    def oval(self, box: Tuple[float, float, float, float], outline: str, fill: str, width: int) -> None:
+        x0, y0, x1, y1 = box
+        fill_color = self.color(fill) if fill else '"none"'
+        self.elements.append(f'<ellipse cx="{(x0 + x1) / 2:g}" cy="{(y0 + y1) / 2:g}" rx="{abs(x1 - x0) / 2:g}" '
+                             f'ry="{abs(y1 - y0) / 2:g}" fill={fill_color} stroke={self.color(outline)} stroke-width="{width}"/>')
+
+    def text(self, x: float, y: float, text: str, color: str) -> None:
+        lines = text.split('\n')
+        # Centered on (x, y), as on a Tk canvas
+        spans = ''.join(f'<tspan x="{x:g}" dy="{"1.2em" if i else f"{-0.6 * (len(lines) - 1):g}em"}">{escape(line)}</tspan>'
+                        for i, line in enumerate(lines))
+        self.elements.append(f'<text x="{x:g}" y="{y:g}" fill={self.color(color)} text-anchor="middle" '
+                             f'dominant-baseline="middle" font-family="sans-serif" font-size="12">{spans}</text>')
+
+    def clear(self) -> None:
+        self.elements = []
+
+    def render(self) -> str:
+        """
+        Return the drawing as an SVG document.
+        """
+        return "\n".join([
+            f'<svg xmlns="http://www.w3.org/2000/svg" width="{self.width}" height="{self.height}" '
+            f'viewBox="0 0 {self.width} {self.height}">',
+            f'<rect width="100%" height="100%" fill={self.color(self.background)}/>',
+        ] + self.elements + ["</svg>", ""])
+
+    def save(self, path: str) -> None:
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(self.render())
+
+
+# The headless renderers, by the extension of the file they write
+renderers: Dict[str, Callable[[int, int], Any]] = {
+    'png': ImageRenderer,
+    'svg': SvgRenderer,
+}
+
+
+def renderer_for(path: str, width: int = 800, height: int = 600) -> Any:
+    """
+    Return a headless renderer for the kind of file named by the path: SVG for .svg, else a Pillow image.
+    """
+    extension = os.path.splitext(path)[1].lstrip('.').lower()
+    return renderers.get(extension, ImageRenderer)(width, height)
+
+
+def render(instructions: Iterable[Dict[str, Any]], path: str, width: int = 800, height: int = 600) -> str:
+    """
+    Draw the instructions headless and save the drawing.
+
+    Args:
+        instructions: Drawing instructions, as for Painter.handle_instruction().
+        path: File to write; its extension selects SVG or an image format.
+        width: Width of the drawing.
+        height: Height of the drawing.
+
+    Returns:
+        The path.
+    """
+    from qutils import Painter
+
+    painter = Painter(renderer=renderer_for(path, width, height))
+    for instruction in instructions:
+        painter.handle_instruction(instruction)
+    painter.save(path)
+    return path
+
+
+def render_sessions(sessions: Dict[str, List[Dict[str, Any]]],
+                    directory: str,
+                    file_format: str = 'png',
+                    width: int = 800,
+                    height: int = 600,
+                    executor: Optional[Executor] = None,
+                    workers: Optional[int] = None
+                    ) -> Dict[str, str]:
+    """
+    Render many drawing sessions in parallel, a file per session.
+
+    Args:
+        sessions: The drawing instructions of every session, by session name.
+        directory: Where to write the files, named after the sessions.
+        file_format: 'png', 'svg', or another image format Pillow writes.
+        width: Width of the drawings.
+        height: Height of the drawings.
+        executor (optional): Worker pool to render in. Defaults to a pool of processes, as
+            rendering is mostly Python code holding the GIL.
+        workers (optional): Number of processes of the default pool. Defaults to the number of CPUs.
+
+    Returns:
+        The path of the file of every session.
+    """
+    os.makedirs(directory, exist_ok=True)
+    pool = executor or ProcessPoolExecutor(max_workers=workers)
+    try:
+        futures = {
+            name: pool.submit(render, instructions, os.path.join(directory, f"{name}.{file_format}"), width, height)
+            for name, instructions in sessions.items()
+        }
+        return {name: future.result() for name, future in futures.items()}
+    finally:
+        if executor is None:
+            pool.shutdown()
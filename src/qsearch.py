@@ -2,33 +2,40 @@
 # Created: 25 Apr 2024 by kruskakli@gmail.com
 #
 import os
-import ollama
 import argparse
-import requests
 import itertools
 import threading
 import time
-import functools
-from bs4 import BeautifulSoup
-from langchain.text_splitter import RecursiveCharacterTextSplitter
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 import warnings
-from googlesearch import search
-from requests.packages.urllib3.exceptions import InsecureRequestWarning
-from qvdb import VectorDB
+from qvdb import VectorDB, BatchWriter
+from qembed import get_embedding_cache
+from qcache import StageCache, get_answer_cache, get_stage_cache
+from qhttp import fetch_text_splits, get_http_cache
+from qclient import default_server_url, forward_to_server
+from qpack import TokenCounter, pack_chunks
+from qmemory import ConversationMemory
+import qtrace
 from typing import (
     TYPE_CHECKING,
     Any,
     Callable,
     Dict,
     Iterable,
+    Iterator,
     List,
     Optional,
     Tuple,
     Type,
 )
 
-# Suppress warnings about insecure HTTPS requests.
-warnings.simplefilter('ignore', InsecureRequestWarning)
+# Ollama, requests, BeautifulSoup, googlesearch and langchain are imported
+# where they are used, so that starting up (e.g. as a --server client) is fast.
+if TYPE_CHECKING:
+    import requests
+
+# Suppress warnings about insecure HTTPS requests (urllib3's InsecureRequestWarning).
+warnings.filterwarnings('ignore', message='Unverified HTTPS request')
 
 
 system="""
@@ -53,21 +60,6 @@ Here are the documents and the corresponding sources:
 """
 
 
-def log_execution_time(func):
-    """Decorator to log the execution time of a function."""
-
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        start_time = time.time()
-        result = func(*args, **kwargs)
-        end_time = time.time()
-        execution_time = end_time - start_time
-        if os.getenv('QSEARCH_RUNTIME'):
-            print(f"{func.__name__} executed in {execution_time:.4f} seconds")
-        return result
-
-    return wrapper
-
 class Spinner:
     def __init__(self, message='Loading...'):
         self.spinner = itertools.cycle(['-', '/', '|', '\\'])
@@ -103,28 +95,105 @@ def print_verbose(*args) -> None:
         print(*args)
         
 
-@log_execution_time
-def extract_url_content(url: str) -> List[str]:
+def extract_url_content(url: str, session: Optional['requests.Session'] = None) -> List[str]:
         """
         Extracts the content from the given URL.
 
         Args:
             url (str): The URL to extract content from.
+            session (requests.Session, optional): Session to fetch with, so that
+                connections can be pooled between calls. Defaults to a plain request.
 
         Returns:
             str: The extracted content.
         """
-        response = requests.get(url, verify=False, timeout=4.0)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        text = ' '.join([p.text for p in soup.find_all('p')])  # Extract text from <p> tags
+        # Unchanged pages are taken from the HTTP cache, already split up
+        return fetch_text_splits(url, session=session, cache=get_http_cache(), timeout=4.0, verify=False)
+
+def fetch_url_content(url: str, session: 'requests.Session') -> List[str]:
+    """
+    Worker for fetch_and_split_urls(): extract the content of one URL, in
+    a fetch span of its own (see qhttp).
+    """
+    return extract_url_content(url, session=session)
+
 
-        # We need to split it up into smaller pieces
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        text_splits = text_splitter.split_text(text)
+def fetch_and_split_urls(urls: Iterable[str],
+                         max_workers: int = 3,
+                         deadline: float = 10.0
+                         ) -> Iterator[Tuple[str, List[str]]]:
+    """
+    Download, parse and split the given URLs concurrently.
 
-        return text_splits
+    The (url, text_splits) pairs are yielded in the order the fetches complete,
+    so the caller can start storing the first page while the others are still
+    downloading. URLs that haven't completed within the deadline are skipped.
 
-@log_execution_time
+    Args:
+        urls (Iterable[str]): The URLs to extract content from.
+        max_workers (int): The max number of concurrent fetches. Defaults to 3.
+        deadline (float): Seconds of waiting for the fetches after which any
+            unfinished fetch is abandoned. The time the caller spends on the
+            pages yielded doesn't count. Defaults to 10.0.
+
+    Yields:
+        Tuple[str, List[str]]: The URL and its text splits.
+    """
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    # The fetch spans of the workers nest under the span of the caller
+    futures = {executor.submit(qtrace.bind(fetch_url_content), url, session): url for url in urls}
+
+    # The session is closed when the last fetch is over, which may be after
+    # we have given up on it
+    unfinished = [len(futures)]
+    unfinished_lock = threading.Lock()
+
+    def fetched(future):
+        with unfinished_lock:
+            unfinished[0] -= 1
+            last = unfinished[0] == 0
+        if last:
+            session.close()
+
+    if not futures:
+        session.close()
+    for future in futures:
+        future.add_done_callback(fetched)
+
+    def result_of(future):
+        try:
+            return future.result()
+        except Exception as e:
+            print_verbose(f"<error> Failed to extract content from {futures[future]}: {e}")
+            return None
+
+    end_time = time.monotonic() + deadline
+    pending = set(futures)
+    try:
+        while pending:
+            finished, pending = wait(pending, timeout=max(0.0, end_time - time.monotonic()), return_when=FIRST_COMPLETED)
+            if not finished:
+                late = [futures[future] for future in pending]
+                print_verbose(f"<error> Fetch deadline of {deadline}s exceeded, skipping: {late}")
+                break
+            for future in finished:
+                text_splits = result_of(future)
+                if text_splits is not None:
+                    paused = time.monotonic()
+                    yield futures[future], text_splits
+                    end_time += time.monotonic() - paused
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+@qtrace.traced('search')
 def google_search(query: str, num_results: int = 3) -> List[str]:
     """
     Performs a Google Search for documents related to the given query.
@@ -137,66 +206,102 @@ def google_search(query: str, num_results: int = 3) -> List[str]:
     Returns:
         List[str]: The URLs of the search results.
     """
+    from googlesearch import search
+
     query += " filetype:html"  # Only search for HTML files
     return search(query, num_results)
 
 
-@log_execution_time
-def store_documents(qvdb: VectorDB, text_splits: List[str], url: str) -> None:
+def store_documents(writer: BatchWriter, text_splits: List[str], url: str) -> None:
         """
-        Stores the documents in the VectorDB.
+        Stores the documents in the VectorDB, batched through the given writer.
 
         Args:
-            qvdb (VectorDB): The VectorDB instance to store the documents in.
+            writer (BatchWriter): The VectorDB batch writer to store the documents with.
             text_splits (List[str]): The list of document text splits.
             url (str): The URL of the source of the documents.
 
         Returns:
             None
         """
-        for index, text in enumerate(text_splits):
-            if len(text) > 0:
-                qvdb.add(
-                    documents=[text],
-                    metadatas=[{"source": url}],
-                    ids=[f"id-{url}-{index}"]
-                )
-            
-
-
-@log_execution_time
-def search_and_store(qvdb: VectorDB, query: str, num_results: int = 3) -> None:
+        splits = [(index, text) for index, text in enumerate(text_splits) if len(text) > 0]
+        writer.add(
+            documents=[text for _, text in splits],
+            metadatas=[{"source": url} for _ in splits],
+            ids=[f"id-{url}-{index}" for index, _ in splits]
+        )
+
+
+@qtrace.traced('search_and_store')
+def search_and_store(qvdb: VectorDB,
+                     query: str,
+                     num_results: int = 3,
+                     max_workers: int = 3,
+                     deadline: float = 10.0,
+                     batch_size: Optional[int] = None,
+                     cache: Optional[StageCache] = None
+                     ) -> None:
         """
         Performs a Google Search for documents related to the given query,
-        extracts their content, and stores them in the vector store.
+        extracts their content concurrently, and stores them in the vector store
+        as soon as each page is ready.
 
         Args:
             query (str): The query to search for documents.
-            num_results (int): The number of URLs to retrieve. Defaults to 5.
+            num_results (int): The number of URLs to retrieve. Defaults to 3.
+            max_workers (int): The max number of concurrent fetches. Defaults to 3.
+            deadline (float): Seconds to wait for the fetches. Defaults to 10.0.
+            batch_size (int, optional): Documents embedded per call. Defaults to the VectorDB setting.
+            cache (StageCache, optional): Cache of search results and page contents of earlier runs.
 
         Returns:
             None
         """
-        for index, url in enumerate(google_search(query, num_results)):
-            print_verbose(f"<info> ({index}) Extracting content from: {url}")
-            try:
-                text_splits = extract_url_content(url=url)
-            except Exception as e:
-                print_verbose(f"<error> Failed to extract content from {url}")
-                continue
-            store_documents(qvdb, text_splits, url)
+        search_key = f"{num_results}:{query}"
+        urls = cache.get('search', search_key) if cache else None
+        if urls is None:
+            urls = list(google_search(query, num_results))
+            if cache and urls:
+                cache.put('search', search_key, urls)
+
+        pages = {url: cache.get('page', url) for url in urls} if cache else {}
+        for index, url in enumerate(urls):
+            print_verbose(f"<info> ({index}) Extracting content from: {url}{' (cached)' if pages.get(url) is not None else ''}")
+        with qvdb.batch_writer(batch_size) as writer:
+            for url, text_splits in pages.items():
+                if text_splits is not None:
+                    store_documents(writer, text_splits, url)
+            to_fetch = [url for url in urls if pages.get(url) is None]
+            for url, text_splits in fetch_and_split_urls(to_fetch, max_workers=max_workers, deadline=deadline):
+                if cache:
+                    cache.put('page', url, text_splits)
+                store_documents(writer, text_splits, url)
+        qtrace.current().set(urls=len(urls), stored=writer.stored, skipped=writer.skipped)
+        print_verbose(f"<info> Stored {writer.stored} documents, skipped {writer.skipped} already stored")
 
 
 def parse_args() -> str:
     parser = argparse.ArgumentParser(description='Ask an AI model for answer to you question')
 
+    parser.add_argument('--batch-size', type=int, default=64, help='Number of documents to embed and store per batch (default: 64)')
+    parser.add_argument('--cache-threshold', type=float, default=0.95, help='Min similarity to a cached question for reusing its answer (default: 0.95)')
     parser.add_argument('-c', '--chat', action='store_true' , help='Chat mode (i.e not just a single question)')
+    parser.add_argument('--context-tokens', type=int, default=2048, help='Max number of tokens of documents to put in the prompt (default: 2048)')
+    parser.add_argument('--fetch-deadline', type=float, default=10.0, help='Max seconds to wait for the search result pages (default: 10.0)')
+    parser.add_argument('--fetch-workers', type=int, default=3, help='Number of search result pages to fetch concurrently (default: 3)')
+    parser.add_argument('--history-tokens', type=int, default=4096, help='Max number of tokens of conversation to carry over in chat mode before summarizing it (default: 4096)')
+    parser.add_argument('--hybrid', action='store_true' , help='Combine vector search with keyword (BM25) search')
+    parser.add_argument('--lexical-weight', type=float, default=1.0, help='Weight of the keyword search results with --hybrid (default: 1.0)')
     parser.add_argument('-m', '--model', default='llama3', help='Use this Ollama model (default: llama3)')
+    parser.add_argument('--no-cache', action='store_true' , help='Do not use (or fill) the answer, search and page caches')
     parser.add_argument('--no-search', action='store_true' , help='Do not search for documents')
+    parser.add_argument('--num-candidates', type=int, default=6, help='Number of documents to retrieve before packing the prompt (default: 6)')
     parser.add_argument('--persist', nargs='?', const='QAI_DB', default=False, help='Persist/Reuse the VectorDB to/from disk (default: QAI_DB)')
     parser.add_argument('--pdf', type=str, help='PDF files, separated by comma (e.g. file1.pdf,file2.pdf). Requires --rag.')
+    parser.add_argument('--quantization', choices=['int8', 'pq'], default=None, help='Search quantized embeddings, reranked at full precision, to save memory on large collections')
     parser.add_argument('-q', '--question', type=str, help='Your question')
     parser.add_argument('-r', '--rag', action='store_true' , help='Enable RAG functionality')
+    parser.add_argument('--server', nargs='?', const=default_server_url, default=None, help=f'Ask a running qserver instead (default: {default_server_url})')
     parser.add_argument('-s', '--stream', action='store_true' , help='Enable streaming of the response')
     parser.add_argument('-t', '--time', action='store_true' , help='Output some runtime info')
     parser.add_argument('--temperature', type=float, default=0.2, help='Set the temperature for creativity (default: 0.2)')
@@ -205,37 +310,54 @@ def parse_args() -> str:
 
     args = parser.parse_args()
 
-    if not args.question:
+    if not args.question and not args.chat:
         print(f"Error: No question asked. Use --help to see valid input.")
         exit(1)
 
     if args.verbose:
         os.environ['QSEARCH_VERBOSE'] = 'True'
     
-    if args.time:
-        os.environ['QSEARCH_RUNTIME'] = 'True'
-
     return args
 
-@log_execution_time
-def query_qvdb(qvdb: VectorDB, question, num_results=3) -> Dict[str, Any]:
-    return qvdb.query(question, num_results=num_results)
+def query_qvdb(qvdb: VectorDB, question, num_results=3, hybrid=False, lexical_weight=1.0) -> Dict[str, Any]:
+    return qvdb.query(question, num_results=num_results, hybrid=hybrid, lexical_weight=lexical_weight)
 
-@log_execution_time
-def pick_results_from_qvdb(results: Dict[str, Any]) -> str:
-    docs=[]
+@qtrace.traced('pack')
+def pick_results_from_qvdb(results: Dict[str, Any],
+                           budget: int = 2048,
+                           counter: Optional[TokenCounter] = None
+                           ) -> str:
+    """
+    Pack the best of the query results into at most budget tokens of documents.
+    """
+    chunks=[]
     for doc, src, dist in zip(results['documents'][0], results['metadatas'][0], results['distances'][0]):
-            docs.append(f"SOURCE: {src['source']}\nDOCUMENT: {doc}\n")
+            chunks.append({'text': doc, 'source': src['source'], 'distance': dist})
             print_verbose(f"qvdb found source: {src['source']} ,at distance: {dist}\n")
+
+    packed = pack_chunks(chunks, budget=budget, counter=counter)
+    qtrace.current().set(candidates=len(chunks),
+                         chunks=len(packed['chunks']),
+                         tokens=packed['packed_tokens'],
+                         dropped=packed['dropped'],
+                         duplicates=packed['duplicates'])
+    if os.getenv('QSEARCH_VERBOSE'):
+        print(f"pick_results_from_qvdb packed {len(packed['chunks'])} documents in {packed['packed_tokens']} tokens, "
+              f"dropped {packed['dropped']} documents of {packed['dropped_tokens']} tokens "
+              f"and {packed['duplicates']} duplicates")
+
+    docs=[]
+    for chunk in packed['chunks']:
+            docs.append(f"SOURCE: {chunk['source']}\nDOCUMENT: {chunk['text']}\n")
     return' '.join(docs)
 
 
-@log_execution_time
 def call_ollama(model: str, 
                 system: str, 
                 prompt: str, 
                 stream: bool = False, 
-                temperature: float = 0.2
+                temperature: float = 0.2,
+                context: Optional[List[int]] = None
                 ) -> Dict[str, Any]:
     """
     Calls the Ollama model with the given prompt.
@@ -246,63 +368,324 @@ def call_ollama(model: str,
         prompt (str): The prompt to send to the Ollama model.
         stream (bool): Whether to stream the response or not.
         temperature (float): The temperature to use for creativity (variation).
+        context (List[int], optional): The context returned with an earlier
+            response, to continue that conversation.
 
     Returns:
         Dict[str, Any]: The response from the Ollama model.
     """
-    return ollama.generate(
+    import qollama
+
+    return qollama.generate(
             model=model,
             system=system,
             prompt=prompt,
             stream=stream,
+            context=context,
             options={"temperature": temperature}
         )
 
 
 
-def main(args):
+def open_qvdb(args) -> VectorDB:
+    """
+    Create the VectorDB instance to use for the question.
+    """
+    if args.persist:
+        return VectorDB(db_directory=args.persist,
+                        is_persistent=True,
+                        quantization=args.quantization
+                        )
+    else:
+        return VectorDB(is_persistent=False, quantization=args.quantization)
 
-    if not args.verbose and not args.time:
-        # Start the spinner
-        spinner = Spinner()
-        spinner.start()
-    
+
+# The models this process has asked Ollama to load, see preload_model()
+preloaded_models = set()
+preloaded_lock = threading.Lock()
+
+
+def preload_model(model: str) -> Optional[threading.Thread]:
+    """
+    Ask Ollama to load the model in the background, so that loading it
+    overlaps with the retrieval instead of delaying the first token.
+    This is done once per model and process: after that the model is
+    kept loaded by the questions asked.
+
+    Returns:
+        The thread loading the model, or None if it was asked for already.
+    """
+    with preloaded_lock:
+        if model in preloaded_models:
+            return None
+        preloaded_models.add(model)
+
+    def load():
+        import qollama
+        try:
+            # A request without a prompt just loads the model.
+            qollama.generate(model=model)
+        except Exception as e:
+            print_verbose(f"<error> Failed to preload model {model}: {e}")
+            # Try again with the next question
+            with preloaded_lock:
+                preloaded_models.discard(model)
+
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    return thread
+
+
+def stream_response(output: Iterable[Dict[str, Any]],
+                    on_token: Callable[[str], None],
+                    final_chunk: Optional[Dict[str, Any]] = None,
+                    start_time: Optional[float] = None
+                    ) -> str:
+    """
+    Pass each token of a streamed Ollama response to on_token as it arrives,
+    and add the time to the first token and the tokens per second to the
+    current span.
+
+    Args:
+        output (Iterable[Dict[str, Any]]): The chunks of the streamed response.
+        on_token (Callable[[str], None]): Called with each token.
+        final_chunk (Dict[str, Any], optional): Updated with the final chunk,
+            which holds the context and the statistics of the response.
+        start_time (float, optional): When the request was sent, as by time.time().
+            Defaults to now.
+
+    Returns:
+        str: The complete response.
+    """
+    start_time = start_time or time.time()
+    first_token_time = None
+    tokens = []
+    chunk = {}
+    for chunk in output:
+        token = chunk['response']
+        if first_token_time is None:
+            first_token_time = time.time()
+        tokens.append(token)
+        on_token(token)
+    end_time = time.time()
+    if final_chunk is not None:
+        final_chunk.update(chunk)
+
+    # Prefer Ollama's own count and timing (in nanoseconds) from the final chunk.
+    if chunk.get('eval_count') and chunk.get('eval_duration'):
+        tokens_per_second = chunk['eval_count'] / (chunk['eval_duration'] / 1e9)
+    elif first_token_time and end_time > first_token_time:
+        tokens_per_second = (len(tokens) - 1) / (end_time - first_token_time)
+    else:
+        tokens_per_second = 0.0
+    qtrace.current().set(time_to_first_token=(first_token_time or end_time) - start_time,
+                         tokens_per_second=tokens_per_second)
+
+    return ''.join(tokens)
+
+
+@qtrace.traced('qsearch')
+def answer_question(args,
+                    qvdb: VectorDB,
+                    on_token: Optional[Callable[[str], None]] = None,
+                    memory: Optional[ConversationMemory] = None,
+                    preload: bool = True
+                    ) -> str:
+    """
+    Answer the question in args, using (and populating) the given VectorDB.
+
+    Args:
+        args: The parsed command line arguments.
+        qvdb (VectorDB): The VectorDB to search for documents.
+        on_token (Callable[[str], None], optional): Called with each token
+            of the response as it arrives, when args.stream is set.
+        memory (ConversationMemory, optional): The conversation so far, in
+            chat mode. The question is asked as the next turn of it.
+        preload (bool, optional): Let Ollama load the model while documents are
+            retrieved. qserver turns it off, as a preload would get around its
+            limit on concurrent generations, and its questions keep the model loaded.
+
+    Returns:
+        str: The response from the Ollama model.
+    """
     # Get the some info from the command line arguments
     question = args.question
 
-    # Create a new VectorDB instance
-    if args.persist:
-        qvdb = VectorDB(db_directory=args.persist,
-                        is_persistent=True
-                        )
-    else:
-        qvdb = VectorDB(is_persistent=False)
+    # A similar enough question may have been answered already (unless
+    # it is a follow-up, whose answer depends on the conversation)
+    use_answer_cache = not args.no_cache and memory is None
+    answer_cache = get_answer_cache(embed_executor=qvdb.embed_executor) if use_answer_cache else None
+    if answer_cache:
+        cached = answer_cache.lookup(question, args.model, threshold=args.cache_threshold)
+        if cached:
+            print_verbose(f"<info> Cached answer to: {cached['question']} (similarity: {cached['similarity']:.3f}), "
+                          f"sources: {cached['sources']}")
+            qtrace.current().set(answer_cache="hit")
+            if args.stream and on_token:
+                on_token(cached['answer'])
+            return cached['answer']
+
+    # Let Ollama load the model while we are busy retrieving documents
+    if preload:
+        preload_model(args.model)
 
     # Search for documents related to the question and store them in the VectorDB
     if not args.no_search:
-        search_and_store(qvdb=qvdb, query=question, num_results=3)
+        search_and_store(qvdb=qvdb,
+                         query=question,
+                         num_results=3,
+                         max_workers=args.fetch_workers,
+                         deadline=args.fetch_deadline,
+                         batch_size=args.batch_size,
+                         cache=None if args.no_cache else get_stage_cache())
 
     # Query the VectorDB with the question
-    results = query_qvdb(qvdb, question, num_results=3)
+    results = query_qvdb(qvdb, question,
+                         num_results=args.num_candidates,
+                         hybrid=args.hybrid,
+                         lexical_weight=args.lexical_weight)
 
     # Extract the documents and sources from the results
-    documents = pick_results_from_qvdb(results)
+    documents = pick_results_from_qvdb(results,
+                                       budget=args.context_tokens,
+                                       counter=TokenCounter(args.model))
 
-    # Generate the response
+    # Generate the response. In chat mode the earlier turns are carried by
+    # the context, so the prompt only holds the new question and documents.
     prompt = template.format(question=question, documents=documents)
-    output = call_ollama(model=args.model, 
-                         system=system, 
-                         prompt=prompt, 
-                         stream=args.stream, 
-                         temperature=args.temperature)
-    response = output['response'].strip()
-
+    context = None
+    if memory:
+        context = memory.next_context()
+        prompt = memory.history() + prompt
+    stream = bool(args.stream and on_token)
+    with qtrace.span('generate', model=args.model, stream=stream) as generate_span:
+        start_time = time.time()
+        output = call_ollama(model=args.model, 
+                             system=None if context else system, 
+                             prompt=prompt, 
+                             stream=stream, 
+                             temperature=args.temperature,
+                             context=context)
+        if stream:
+            output_chunk = {}
+            response = stream_response(output, on_token, final_chunk=output_chunk, start_time=start_time).strip()
+        else:
+            output_chunk = output
+            response = output['response'].strip()
+        generate_span.set(tokens_in=output_chunk.get('prompt_eval_count') or 0,
+                          tokens_out=output_chunk.get('eval_count') or 0)
+
+    if memory:
+        memory.record(question, response, output_chunk.get('context'))
+
+    if answer_cache:
+        sources = list(dict.fromkeys(metadata['source'] for metadata in results['metadatas'][0]))
+        answer_cache.store(question, args.model, response, sources)
+    return response
+
+
+def ask(args, qvdb: VectorDB, memory: Optional[ConversationMemory] = None) -> None:
+    """
+    Answer the question in args and print the response.
+    """
+    spinner = None
     if not args.verbose and not args.time:
+        # Start the spinner
+        spinner = Spinner()
+        spinner.start()
+
+    def print_token(token: str) -> None:
+        # Stop the spinner as soon as the first token arrives
+        if spinner and spinner.running:
+            spinner.stop()
+        print(token, end='', flush=True)
+
+    recorder = None
+    if args.time:
+        # Collect the spans of the question, to print them with the response
+        recorder = qtrace.SpanRecorder()
+        qtrace.tracer.add_exporter(recorder)
+    try:
+        response = answer_question(args, qvdb, on_token=print_token, memory=memory)
+    finally:
+        if recorder:
+            qtrace.tracer.remove_exporter(recorder)
+
+    if spinner and spinner.running:
         # Stop the spinner
         spinner.stop()
 
-    # Print the response
-    print(response)
+    # Print the response (unless it has been streamed already)
+    if args.stream:
+        print("")
+    else:
+        print(response)
+
+    if recorder:
+        print("")
+        print(qtrace.format_tree(recorder.spans))
+
+
+def chat(args, qvdb: VectorDB) -> None:
+    """
+    Answer questions until the user quits, continuing the conversation
+    from one question to the next.
+    """
+    memory = ConversationMemory(model=args.model, budget=args.history_tokens)
+    question = args.question
+    while True:
+        if not question:
+            try:
+                question = input("\n>>> ").strip()
+            except (EOFError, KeyboardInterrupt):
+                print("")
+                break
+            if question in ('exit', 'quit', '/bye'):
+                break
+            if not question:
+                continue
+        args.question = question
+        ask(args, qvdb, memory)
+        question = None
+    print_verbose(f"<info> Conversation summarized {memory.summarizations} times")
+
+
+def main(args):
+
+    if args.server:
+        if args.chat:
+            print("Error: --chat can't be used with --server.")
+            exit(1)
+        # Let the (warm) qserver do the work
+        print(forward_to_server(args.server, 'qsearch', vars(args)))
+        return
+
+    # Create a new VectorDB instance
+    qvdb = open_qvdb(args)
+
+    if args.chat:
+        chat(args, qvdb)
+    else:
+        ask(args, qvdb)
+
+    embed_cache = get_embedding_cache()
+    if args.time and embed_cache:
+        stats = embed_cache.stats()
+        print(f"embedding cache: {stats['hits']} hits, {stats['misses']} misses, "
+              f"{stats['evictions']} evictions, {stats['entries']} entries, "
+              f"saved ~{stats['saved_seconds']:.4f} seconds")
+
+    if args.time and not args.no_cache:
+        answer_cache = get_answer_cache()
+        stage_cache = get_stage_cache()
+        if answer_cache:
+            stats = answer_cache.stats()
+            print(f"answer cache: {stats['hits']} hits, {stats['misses']} misses ({stats['expired']} expired), "
+                  f"{stats['evictions']} evictions, {stats['entries']} entries, hit rate {stats['hit_rate']:.2f}")
+        if stage_cache:
+            for stage, stats in stage_cache.stats().items():
+                print(f"{stage} cache: {stats['hits']} hits, {stats['misses']} misses ({stats['expired']} expired), "
+                      f"{stats['entries']} entries, hit rate {stats['hit_rate']:.2f}")
 
 
 
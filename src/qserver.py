@@ -0,0 +1,185 @@
+#
+# A resident server for qsearch and qimdb.
+#
+# Every run of qsearch.py or qimdb.py imports langchain and chromadb, loads
+# the embedding model, opens Chroma and connects to Ollama from cold, which
+# takes much longer than answering a short question. qserver does all of that
+# once and keeps it warm; `qsearch.py --server` and `qimdb.py --server` then
+# just forward their command line arguments to it over HTTP (see qclient).
+#
+# Example:
+#
+#   $ ./pyvenv/bin/python3 ./src/qserver.py &
+#   $ ./pyvenv/bin/python3 ./src/qsearch.py --server -q "Who won the Nobel Prize in Literature 2023?"
+#
+# The stages of every request are traced (see qtrace) and their metrics
+# are served in the Prometheus text format at /metrics:
+#
+#   $ curl http://127.0.0.1:8788/metrics
+#
+import os
+import json
+import uuid
+import argparse
+import threading
+from argparse import Namespace
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from qclient import default_host, default_port
+from qollama import OllamaBusyError, configure_scheduler
+from qutils import print_verbose
+import qtrace
+
+
+class QServer:
+    """
+    Keeps the embedding model, the Chroma clients and the Ollama client warm
+    and runs qsearch and qimdb commands on them.
+
+    Attributes:
+        embed_executor: Worker pool computing the embeddings for all requests.
+    """
+
+    def __init__(self, embed_workers: int = 2, ollama_concurrency: int = 1, ollama_max_waiting: int = 16):
+        # Imported here rather than at the top, keeping this module cheap to import.
+        import qsearch
+        import qimdb
+        from qvdb import VectorDB
+        from qutils import VectorStore
+        self.qsearch = qsearch
+        self.qimdb = qimdb
+        self.VectorDB = VectorDB
+        self.VectorStore = VectorStore
+
+        self.embed_executor = ThreadPoolExecutor(max_workers=embed_workers, thread_name_prefix="embed")
+        # The scheduler limits the concurrent generations per model, and
+        # turns requests away once too many are waiting (see qollama)
+        configure_scheduler(max_in_flight=ollama_concurrency,
+                            max_total=max(ollama_concurrency, 2),
+                            max_waiting=ollama_max_waiting)
+        self.qvdbs = {}
+        self.qvdbs_lock = threading.Lock()
+        self.stores = {}
+        self.stores_lock = threading.Lock()
+
+        # Load the embedding model up front rather than on the first question.
+        self.VectorDB(is_persistent=False, collection_name="qserver-warmup", embed_executor=self.embed_executor).drop()
+
+    def run(self, command: str, args: Namespace) -> str:
+        if command == 'qsearch':
+            return self.run_qsearch(args)
+        if command == 'qimdb':
+            return self.run_qimdb(args)
+        raise ValueError(f"Unknown command: {command}")
+
+    def run_qsearch(self, args: Namespace) -> str:
+        # The response is returned in one piece
+        args.stream = False
+        if args.persist:
+            key = (args.persist, args.quantization)
+            with self.qvdbs_lock:
+                if key not in self.qvdbs:
+                    self.qvdbs[key] = self.VectorDB(db_directory=args.persist,
+                                                    is_persistent=True,
+                                                    quantization=args.quantization,
+                                                    embed_executor=self.embed_executor)
+                qvdb = self.qvdbs[key]
+            return self.qsearch.answer_question(args, qvdb, preload=False)
+
+        # In-memory collections are shared within the process, so give every
+        # question a collection of its own.
+        qvdb = self.VectorDB(is_persistent=False,
+                             collection_name=f"qsearch-{uuid.uuid4().hex}",
+                             quantization=args.quantization,
+                             embed_executor=self.embed_executor)
+        try:
+            return self.qsearch.answer_question(args, qvdb, preload=False)
+        finally:
+            qvdb.drop()
+
+    def run_qimdb(self, args: Namespace) -> str:
+        csv_file = args.csv_file or self.qimdb.default_csv_file
+        persist_directory = args.db_dir or self.qimdb.default_persist_directory
+        with self.stores_lock:
+            v, csv_mtime = self.stores.get(persist_directory, (None, None))
+            if v is None:
+                v = self.VectorStore(persist_directory=persist_directory)
+            # Only check the CSV file for changes when it has been modified.
+            mtime = os.path.getmtime(csv_file)
+            if not (v.db and args.skip_update) and mtime != csv_mtime:
+                counts = self.qimdb.update_index(v, csv_file, persist_directory, batch_size=args.batch_size)
+                print_verbose(f"<info> Updated VectorStore at: {persist_directory}: {counts}")
+                csv_mtime = mtime
+            self.stores[persist_directory] = (v, csv_mtime)
+        return self.qimdb.similarity_search(v, args)
+
+
+class QRequestHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = qtrace.get_metrics().render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        command = self.path.strip('/')
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            args = Namespace(**json.loads(self.rfile.read(length)))
+            with qtrace.span('request', command=command):
+                reply = {'output': self.server.qserver.run(command, args)}
+            status = 200
+        except OllamaBusyError as e:
+            reply = {'error': f"{type(e).__name__}: {e}"}
+            status = 503
+        except Exception as e:
+            reply = {'error': f"{type(e).__name__}: {e}"}
+            status = 500
+        body = json.dumps(reply).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        if os.getenv('QAI_VERBOSE'):
+            super().log_message(format, *args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Serve qsearch and qimdb questions from a warm process')
+    parser.add_argument('--host', default=default_host, help=f'Interface to listen on (default: {default_host})')
+    parser.add_argument('--port', type=int, default=default_port, help=f'Port to listen on (default: {default_port})')
+    parser.add_argument('--embed-workers', type=int, default=2, help='Number of threads computing embeddings (default: 2)')
+    parser.add_argument('--ollama-concurrency', type=int, default=1, help='Max number of concurrent Ollama generations per model (default: 1)')
+    parser.add_argument('--ollama-max-waiting', type=int, default=16, help='Max number of requests waiting for Ollama before turning new ones away (default: 16)')
+    return parser.parse_args()
+
+
+def main(args):
+    httpd = ThreadingHTTPServer((args.host, args.port), QRequestHandler)
+    httpd.daemon_threads = True
+    # Aggregate the spans of all requests, for /metrics
+    qtrace.get_metrics()
+    httpd.qserver = QServer(embed_workers=args.embed_workers,
+                            ollama_concurrency=args.ollama_concurrency,
+                            ollama_max_waiting=args.ollama_max_waiting)
+    print(f"qserver listening at: http://{args.host}:{args.port}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+
+
+if __name__ == '__main__':
+    main(parse_args())
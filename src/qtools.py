@@ -0,0 +1,217 @@
+#
+# Tools for the agent loop of qagent.
+#
+# The model calls a tool by writing JSON, e.g.
+#
+#   {'action': 'search', 'action_input': {'query': 'Nobel Prize 2023'}}
+#
+# A ToolExecutor carries out the calls of one model turn: the tools are
+# looked up in a ToolRegistry, and independent calls run concurrently in a
+# pool of threads (they mostly wait for the network and for Ollama). The
+# results are memoized by tool and normalized arguments, so a model asking
+# the same thing again, give or take case and whitespace, gets the answer
+# at once. A budget of steps (model turns) and seconds keeps a model that
+# goes round in circles from running forever.
+#
+import json
+import time
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    List,
+    Optional,
+    Tuple,
+)
+import qtrace
+
+default_max_steps = 8
+# Seconds for answering a question, tools and model turns together
+default_time_budget = 180.0
+default_max_workers = 4
+
+
+class Tool:
+    """
+    A tool the model may call.
+
+    Attributes:
+        name: What the model calls it, as the 'action'.
+        description: What it does, for the prompt.
+        function: Carries out a call, given the 'action_input', returning the observation.
+        memoize: Whether the result of a call may be reused for a call with the same arguments.
+    """
+
+    def __init__(self, name: str, description: str, function: Callable[[Any], str], memoize: bool = True):
+        self.name = name
+        self.description = description
+        self.function = function
+        self.memoize = memoize
+
+
+class ToolRegistry:
+    """
+    The tools the model may call, by name.
+    """
+
+    def __init__(self):
+        self.tools: Dict[str, Tool] = {}
+
+    def register(self, name: str, description: str, function: Callable[[Any], str], memoize: bool = True) -> Tool:
+        tool = Tool(name, description, function, memoize)
+        self.tools[name] = tool
+        return tool
+
+    def get(self, name: str) -> Optional[Tool]:
+        return self.tools.get(name)
+
+    def describe(self) -> str:
+        """
+        Return the tools as a list for the prompt.
+        """
+        return "\n".join(f"    - {tool.name}: {tool.description}" for tool in self.tools.values())
+
+
+def normalized(value: Any) -> Any:
+    """
+    Return the arguments of a call in a normal form: strings in lower case
+    with the whitespace collapsed, and the keys of dicts sorted.
+    """
+    if isinstance(value, str):
+        return " ".join(value.split()).lower()
+    if isinstance(value, dict):
+        return {str(key): normalized(item) for key, item in sorted(value.items(), key=lambda item: str(item[0]))}
+    if isinstance(value, (list, tuple)):
+        return [normalized(item) for item in value]
+    return value
+
+
+def call_key(name: str, action_input: Any) -> str:
+    return json.dumps([name, normalized(action_input)], sort_keys=True, default=str)
+
+
+def tool_calls(objects: Iterable[Dict[str, Any]]) -> List[Tuple[str, Any]]:
+    """
+    Return the tool calls, as (action, action_input), among the JSON objects of a model's response.
+    """
+    return [(data['action'], data.get('action_input'))
+            for data in objects if isinstance(data.get('action'), str)]
+
+
+class ToolExecutor:
+    """
+    Carries out the tool calls of the model, within a budget of steps and seconds.
+
+    Attributes:
+        registry: The tools.
+        max_steps: Max number of model turns for a question.
+        time_budget: Max seconds for a question.
+        memo: The results of the calls made, by call_key().
+        stats: Counts of the calls made, memoized and failed.
+    """
+
+    def __init__(self,
+                 registry: ToolRegistry,
+                 max_steps: int = default_max_steps,
+                 time_budget: float = default_time_budget,
+                 max_workers: int = default_max_workers,
+                 clock: Callable[[], float] = time.monotonic):
+        self.registry = registry
+        self.max_steps = max_steps
+        self.time_budget = time_budget
+        self.clock = clock
+        self.pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="tool")
+        self.memo: Dict[str, str] = {}
+        self.lock = threading.Lock()
+        self.stats = {'calls': 0, 'memoized': 0, 'failed': 0, 'timed_out': 0}
+        self.steps = 0
+        self.deadline = clock() + time_budget
+
+    def start(self) -> None:
+        """
+        Start the budget for a new question; the memoized results are kept.
+        """
+        self.steps = 0
+        self.deadline = self.clock() + self.time_budget
+
+    def remaining(self) -> float:
+        """
+        Return the seconds left of the time budget.
+        """
+        return max(0.0, self.deadline - self.clock())
+
+    def step(self) -> bool:
+        """
+        Count a model turn.
+
+        Returns:
+            False if the budget is spent, and the question should be given up on.
+        """
+        if self.steps >= self.max_steps or self.remaining() <= 0:
+            return False
+        self.steps += 1
+        return True
+
+    def run(self, calls: List[Tuple[str, Any]]) -> List[str]:
+        """
+        Carry out the tool calls of a model turn, concurrently, waiting at most until the time budget is spent.
+
+        Args:
+            calls: The calls, as (action, action_input).
+
+        Returns:
+            The observation of every call, in order: the result of the tool, or what went wrong.
+        """
+        futures: Dict[str, Future] = {}
+        observations: List[Any] = []
+        for name, action_input in calls:
+            tool = self.registry.get(name)
+            if tool is None:
+                observations.append(f"There is no tool called {name}; the tools are: {', '.join(self.registry.tools)}")
+                continue
+            key = call_key(name, action_input)
+            with self.lock:
+                self.stats['calls'] += 1
+                memoized = self.memo.get(key) if tool.memoize else None
+                if memoized is not None:
+                    self.stats['memoized'] += 1
+            if memoized is not None:
+                observations.append(memoized)
+            elif key in futures:
+                # The same call twice in one turn is carried out once
+                with self.lock:
+                    self.stats['memoized'] += 1
+                observations.append(futures[key])
+            else:
+                futures[key] = self.pool.submit(qtrace.bind(self.call), tool, key, action_input)
+                observations.append(futures[key])
+        if futures:
+            wait(futures.values(), timeout=self.remaining())
+        return [self.observation(item) for item in observations]
+
+    def call(self, tool: Tool, key: str, action_input: Any) -> str:
+        with qtrace.span('tool', tool=tool.name):
+            result = str(tool.function(action_input))
+        if tool.memoize:
+            with self.lock:
+                self.memo[key] = result
+        return result
+
+    def observation(self, item: Any) -> str:
+        if isinstance(item, str):
+            return item
+        if not item.done():
+            # Left to finish in the background; its result is memoized then
+            self.stats['timed_out'] += 1
+            return "The tool did not finish within the time budget"
+        error = item.exception()
+        if error is not None:
+            self.stats['failed'] += 1
+            return f"The tool failed: {error!r}"
+        return item.result()
+
+    def close(self) -> None:
+        self.pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,447 @@
+#
+# Tracing and metrics: nested spans per request, with attributes, exported
+# as JSON lines and aggregated into Prometheus style metrics.
+#
+# A request is traced as a tree of spans (search, fetch per URL, parse,
+# split, embed, upsert, query, pack, generate), each with its duration and
+# attributes like the bytes fetched, the number of chunks, or the tokens in
+# and out. The current span is kept in a context variable, so spans nest
+# without being passed around; use bind() to carry it into a worker thread.
+#
+# Tracing is off unless something consumes the spans, and then span()
+# returns a shared no-op span, so instrumented code costs next to nothing:
+#
+#  - QAI_TRACE=<file> appends every span to a JSON-lines trace file,
+#  - get_metrics() aggregates the spans into histograms and counters, as
+#    served by qserver at /metrics,
+#  - a SpanRecorder collects them, e.g. for `qsearch.py --time`.
+#
+import os
+import json
+import time
+import random
+import bisect
+import functools
+import threading
+import contextvars
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    List,
+    Optional,
+    Tuple,
+)
+
+# Upper bounds, in seconds, of the buckets of the span duration histograms
+default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+_current_span: contextvars.ContextVar[Optional['Span']] = contextvars.ContextVar('qtrace_span', default=None)
+
+
+class Span:
+    """
+    A timed stage of a request. Use it as a context manager; spans opened
+    inside it (in the same thread, or in a bind() function) become its children.
+
+    Attributes:
+        name: Name of the stage.
+        trace_id: Id shared by all the spans of a request.
+        span_id: Id of this span.
+        parent_id: Id of the enclosing span, None for the root of a request.
+        start: Wall clock time the span started.
+        duration: Seconds the span lasted, once it has ended.
+        attributes: Sizes, counts and other facts about the stage.
+        error: The exception that ended the span, if any.
+    """
+
+    __slots__ = ('tracer', 'name', 'trace_id', 'span_id', 'parent_id', 'start', 'duration',
+                 'attributes', 'error', 'started', 'token')
+
+    def __init__(self, tracer: 'Tracer', name: str, parent: Optional['Span'], attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent else None
+        self.attributes = attributes
+        self.start = 0.0
+        self.duration = 0.0
+        self.error: Optional[str] = None
+        self.started = 0.0
+        self.token = None
+
+    def set(self, **attributes) -> 'Span':
+        self.attributes.update(attributes)
+        return self
+
+    def add(self, key: str, value: float = 1) -> None:
+        self.attributes[key] = self.attributes.get(key, 0) + value
+
+    def __enter__(self) -> 'Span':
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.token = _current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.duration = time.perf_counter() - self.started
+        _current_span.reset(self.token)
+        if exc_type is not None:
+            self.error = f"{exc_type.__name__}: {exc}"
+        self.tracer.finish(self)
+        return False
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'start': self.start,
+            'duration': self.duration,
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+
+class NoopSpan:
+    """
+    The span handed out while tracing is off: it records nothing.
+    """
+
+    def set(self, **attributes) -> 'NoopSpan':
+        return self
+
+    def add(self, key: str, value: float = 1) -> None:
+        pass
+
+    def __enter__(self) -> 'NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+_noop_span = NoopSpan()
+
+
+class Tracer:
+    """
+    Hands out spans and passes the finished ones to its exporters. Without
+    exporters it is disabled and only hands out the no-op span.
+    """
+
+    def __init__(self):
+        self.exporters: List[Any] = []
+        self.enabled = False
+        self.lock = threading.Lock()
+
+    def add_exporter(self, exporter: Any) -> None:
+        """
+        Add an exporter: an object whose export(span) method is called with every finished span.
+        """
+        with self.lock:
+            self.exporters = self.exporters + [exporter]
+            self.enabled = True
+
+    def remove_exporter(self, exporter: Any) -> None:
+        with self.lock:
+            self.exporters = [e for e in self.exporters if e is not exporter]
+            self.enabled = bool(self.exporters)
+
+    def span(self, name: str, **attributes) -> Any:
+        if not self.enabled:
+            return _noop_span
+        return Span(self, name, _current_span.get(), attributes)
+
+    def finish(self, span: Span) -> None:
+        for exporter in self.exporters:
+            try:
+                exporter.export(span)
+            except Exception:
+                # Tracing must never break the traced request
+                pass
+
+
+class JsonLinesExporter:
+    """
+    Appends every finished span, as a JSON object, to a trace file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        line = json.dumps(span.to_dict(), default=str)
+        with self.lock:
+            if self.file is None:
+                directory = os.path.dirname(self.path)
+                if directory:
+                    os.makedirs(directory, exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8', buffering=1)
+            self.file.write(line + "\n")
+
+    def close(self) -> None:
+        with self.lock:
+            if self.file:
+                self.file.close()
+                self.file = None
+
+
+class SpanRecorder:
+    """
+    Keeps the finished spans in memory.
+    """
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self.lock:
+            self.spans.append(span)
+
+
+# Numeric attributes that count things, summed per span name. Others, like
+# num_results or tokens_per_second, mean nothing summed and are left out.
+counted_attributes = frozenset({
+    'bytes', 'candidates', 'chars', 'chunks', 'deleted', 'documents', 'results',
+    'stored', 'tokens_in', 'tokens_out', 'unchanged', 'urls',
+})
+# Attributes that are durations, in seconds, kept in histograms as the spans' own
+timed_attributes = frozenset({'time_to_first_token'})
+# Attributes whose values are counted per value, e.g. the HTTP status of a fetch
+labelled_attributes = frozenset({'answer_cache', 'cache', 'status'})
+
+
+def label(value: Any) -> str:
+    """
+    Return the value escaped for a label of the Prometheus text format.
+    """
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Histogram:
+    """
+    Counts of observed values per bucket, with their sum.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def render(self, metric: str, labels: str) -> List[str]:
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            cumulative += count
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append(f'{metric}_bucket{{{labels},le="{le}"}} {cumulative}')
+        lines.append(f'{metric}_sum{{{labels}}} {self.sum}')
+        lines.append(f'{metric}_count{{{labels}}} {self.count}')
+        return lines
+
+
+class Metrics:
+    """
+    Aggregates the finished spans per span name: a histogram of their
+    durations, a count of errors, the sums of their counted attributes,
+    histograms of their timed attributes, and a count of the spans per
+    value of their labelled attributes.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = default_buckets):
+        self.buckets = buckets
+        self.durations: Dict[str, Histogram] = {}
+        self.errors: Dict[str, int] = {}
+        self.totals: Dict[Tuple[str, str], float] = {}
+        self.timings: Dict[Tuple[str, str], Histogram] = {}
+        self.values: Dict[Tuple[str, str, str], int] = {}
+        self.lock = threading.Lock()
+
+    def export(self, span: Span) -> None:
+        with self.lock:
+            name = span.name
+            if name not in self.durations:
+                self.durations[name] = Histogram(self.buckets)
+                self.errors[name] = 0
+            self.durations[name].observe(span.duration)
+            if span.error:
+                self.errors[name] += 1
+            for key, value in span.attributes.items():
+                if key in labelled_attributes:
+                    self.values[(name, key, str(value))] = self.values.get((name, key, str(value)), 0) + 1
+                elif not isinstance(value, (int, float)) or isinstance(value, bool):
+                    continue
+                elif key in counted_attributes:
+                    self.totals[(name, key)] = self.totals.get((name, key), 0) + value
+                elif key in timed_attributes:
+                    self.timings.setdefault((name, key), Histogram(self.buckets)).observe(value)
+
+    def quantile(self, name: str, q: float) -> Optional[float]:
+        """
+        Estimate the q-quantile (0 < q < 1) of the durations of the named span
+        from its histogram, as Prometheus' histogram_quantile() does.
+        """
+        with self.lock:
+            histogram = self.durations.get(name)
+            counts = list(histogram.counts) if histogram else []
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for index, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                if index == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[index] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> str:
+        """
+        The metrics in the Prometheus text exposition format.
+        """
+        with self.lock:
+            lines = [
+                "# HELP qai_span_duration_seconds Duration of the traced stages.",
+                "# TYPE qai_span_duration_seconds histogram",
+            ]
+            for name in sorted(self.durations):
+                lines.extend(self.durations[name].render('qai_span_duration_seconds', f'span="{label(name)}"'))
+            lines.append("# HELP qai_span_errors_total Traced stages that ended with an error.")
+            lines.append("# TYPE qai_span_errors_total counter")
+            for name in sorted(self.errors):
+                lines.append(f'qai_span_errors_total{{span="{label(name)}"}} {self.errors[name]}')
+            lines.append("# HELP qai_span_attribute_total Sum of the counts (bytes, chunks, tokens, ...) of the traced stages.")
+            lines.append("# TYPE qai_span_attribute_total counter")
+            for (name, key), value in sorted(self.totals.items()):
+                lines.append(f'qai_span_attribute_total{{span="{label(name)}",attribute="{label(key)}"}} {value}')
+            lines.append("# HELP qai_span_attribute_seconds Timings (as the time to the first token) within the traced stages.")
+            lines.append("# TYPE qai_span_attribute_seconds histogram")
+            for (name, key), histogram in sorted(self.timings.items()):
+                lines.extend(histogram.render('qai_span_attribute_seconds', f'span="{label(name)}",attribute="{label(key)}"'))
+            lines.append("# HELP qai_span_attribute_values_total Traced stages per value of their status attributes.")
+            lines.append("# TYPE qai_span_attribute_values_total counter")
+            for (name, key, value), count in sorted(self.values.items()):
+                lines.append(f'qai_span_attribute_values_total{{span="{label(name)}",attribute="{label(key)}",value="{label(value)}"}} {count}')
+            return "\n".join(lines) + "\n"
+
+
+tracer = Tracer()
+
+
+def span(name: str, **attributes) -> Any:
+    """
+    Open a span (as a context manager) under the current one.
+
+    Args:
+        name (str): Name of the stage.
+        **attributes: Attributes of the span; more can be added with set() and add().
+
+    Returns:
+        Span: The span, or a no-op span if tracing is off.
+    """
+    return tracer.span(name, **attributes)
+
+
+def current() -> Any:
+    """
+    Return the current span, to add attributes to, or a no-op span if there is none.
+    """
+    return _current_span.get() or _noop_span
+
+
+def traced(name: Optional[str] = None) -> Callable:
+    """
+    Decorator running every call of the function in a span, named after the function by default.
+    """
+    def decorator(func: Callable) -> Callable:
+        span_name = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not tracer.enabled:
+                return func(*args, **kwargs)
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def bind(func: Callable) -> Callable:
+    """
+    Return the function bound to the current span, so that the spans it
+    opens in another thread (e.g. in a worker pool) nest under it.
+    """
+    if not tracer.enabled:
+        return func
+    context = contextvars.copy_context()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        return context.run(func, *args, **kwargs)
+
+    return wrapper
+
+
+def format_tree(spans: List[Span]) -> str:
+    """
+    Format the spans as an indented tree of durations and attributes.
+    """
+    ids = {s.span_id for s in spans}
+    children: Dict[Optional[str], List[Span]] = {}
+    for s in spans:
+        children.setdefault(s.parent_id if s.parent_id in ids else None, []).append(s)
+
+    lines = []
+
+    def walk(parent_id: Optional[str], depth: int) -> None:
+        for s in sorted(children.get(parent_id, []), key=lambda s: s.start):
+            attributes = ' '.join(f"{key}={value:.4g}" if isinstance(value, float) else f"{key}={value}"
+                                  for key, value in s.attributes.items())
+            error = f" error={s.error}" if s.error else ""
+            lines.append(f"{'  ' * depth}{s.name} {s.duration * 1000:.1f} ms {attributes}{error}".rstrip())
+            walk(s.span_id, depth + 1)
+
+    walk(None, 0)
+    return "\n".join(lines)
+
+
+_shared_metrics = None
+_shared_metrics_lock = threading.Lock()
+
+
+def get_metrics() -> Metrics:
+    """
+    Return the process wide metrics, which from then on aggregate all spans.
+    """
+    global _shared_metrics
+    with _shared_metrics_lock:
+        if _shared_metrics is None:
+            _shared_metrics = Metrics()
+            tracer.add_exporter(_shared_metrics)
+        return _shared_metrics
+
+
+def _export_from_env() -> None:
+    path = os.getenv('QAI_TRACE', '')
+    if path.lower() not in ('', 'off', 'none'):
+        tracer.add_exporter(JsonLinesExporter(path))
+
+
+_export_from_env()
@@ -1,17 +1,10 @@
 import json
-import requests
 import os
-from bs4 import BeautifulSoup
-from googlesearch import search
-from langchain_community.embeddings import OllamaEmbeddings
-from langchain_community.vectorstores import Chroma
-from langchain.text_splitter import RecursiveCharacterTextSplitter
-from langchain_core.documents import Document
-import tkinter as tk
+import re
+import queue
 import threading
 import time
 import itertools
-import math
 import functools
 import logging
 from typing import (
@@ -25,19 +18,34 @@ from typing import (
     Tuple,
     Type,
 )
+import qtrace
+
+# The heavy dependencies (tkinter, BeautifulSoup, googlesearch, langchain and
+# Chroma) are imported where they are used, so that programs only needing
+# a few of the utilities here don't have to pay for loading all of them.
+if TYPE_CHECKING:
+    import numpy as np
+    from langchain_core.documents import Document
 
-logging.basicConfig(filename="./logs/qdraw.log", level=logging.INFO, format='%(name)s : %(levelname)-8s : %(message)s')
 logger = logging.getLogger(__name__)
 
+def setup_logging() -> None:
+    """Log to ./logs/qdraw.log; done on first use rather than when importing this module."""
+    if not logging.getLogger().handlers:
+        os.makedirs("./logs", exist_ok=True)
+        logging.basicConfig(filename="./logs/qdraw.log", level=logging.INFO, format='%(name)s : %(levelname)-8s : %(message)s')
+
 def log_execution_time(func):
-    """Decorator to log the execution time of a function."""
+    """Decorator to log the execution time of a function, and trace it as a span (see qtrace)."""
 
     @functools.wraps(func)
     def wrapper(*args, **kwargs):
         start_time = time.time()
-        result = func(*args, **kwargs)
+        with qtrace.span(func.__name__):
+            result = func(*args, **kwargs)
         end_time = time.time()
         execution_time = end_time - start_time
+        setup_logging()
         logger.info(f"{func.__name__} executed in {execution_time:.4f} seconds")
         return result
 
@@ -93,12 +101,15 @@ def print_verbose(*args) -> None:
 # iteration of a loop), it picks up where it left off and finds the next JSON object,
 # if there is one.
 #
-def extract_json_objects(text, decoder=json.JSONDecoder()) -> Iterable[Dict[str, Any]]:
+def extract_json_objects(text, decoder=None) -> Iterable[Dict[str, Any]]:
     """Find JSON objects in text, and yield the decoded JSON data
 
+    Single quoted strings, trailing commas and Python's True, False and None
+    are accepted too, as LLMs tend to write them (see JsonStreamExtractor).
+
     Args:
         text (str): The text to search for JSON objects.
-        decoder (json.JSONDecoder, optional): The JSON decoder to use. Defaults to json.JSONDecoder().
+        decoder (json.JSONDecoder, optional): The JSON decoder to use. Defaults to one accepting control characters in strings.
 
     Yields:
         dict: The decoded JSON data.
@@ -109,20 +120,315 @@ def extract_json_objects(text, decoder=json.JSONDecoder()) -> Iterable[Dict[str,
     Returns:
         None
     """
-    pos = 0
-    while True:
-        match = text.find('{', pos)
-        if match == -1:
-            break
-        try:
-            result, index = decoder.raw_decode(text[match:])
-            yield result
-            pos = match + index
-        except ValueError as e:
-            print_verbose(f"<error> extract_json_objects: {e}")
-            pos = match + 1
+    extractor = JsonStreamExtractor(decoder)
+    yield from extractor.feed(text)
+    yield from extractor.close()
+
 
+def extract_json_stream(chunks: Iterable[str], decoder=None, nested: bool = False) -> Iterable[Dict[str, Any]]:
+    """Yield the JSON objects in a stream of text chunks, e.g. the tokens of
+    a streamed LLM response, each as soon as it is complete.
 
+    Args:
+        chunks (Iterable[str]): The text, in pieces.
+        decoder (json.JSONDecoder, optional): The JSON decoder to use.
+        nested (bool, optional): Yield the objects within objects too, innermost first,
+            as (path, object, outer); see JsonStreamExtractor.
+
+    Yields:
+        dict: The decoded JSON data.
+    """
+    extractor = JsonStreamExtractor(decoder, nested=nested)
+    for chunk in chunks:
+        yield from extractor.feed(chunk)
+    yield from extractor.close()
+
+
+# Tokens within a JSON object, except strings: whitespace, punctuation, numbers and literals
+# (with NaN and the infinities, which the decoder accepts too)
+_json_token = re.compile(r'(\s+)|([{}\[\]:,])|(-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?)|(true|false|null|True|False|None|NaN|-?Infinity)')
+# The body of a string, up to its closing quote, the end of the text, or a trailing backslash
+_json_string_body = {
+    '"': re.compile(r'[^"\\]*(?:\\.[^"\\]*)*', re.DOTALL),
+    "'": re.compile(r"[^'\\]*(?:\\.[^'\\]*)*", re.DOTALL),
+}
+_json_escapes = {
+    '"': re.compile(r"\\(.)", re.DOTALL),
+    "'": re.compile(r'\\(.)|"', re.DOTALL),
+}
+_json_literals = {'true': 'true', 'false': 'false', 'null': 'null', 'True': 'true', 'False': 'false', 'None': 'null',
+                  'NaN': 'NaN', 'Infinity': 'Infinity', '-Infinity': '-Infinity'}
+_json_longest_literal = max(len(literal) for literal in _json_literals)
+_json_number_chars = frozenset('0123456789.eE+-')
+# Characters from a '{' that the C decoder gets to try to decode
+_json_window = 2048
+
+
+def _strict_string(body: str, quote: str) -> str:
+    """Return the body of a (single or double) quoted string as a JSON string."""
+    if quote == '"' and "\\'" not in body:
+        return f'"{body}"'
+    if quote == "'" and '\\' not in body and '"' not in body:
+        return f'"{body}"'
+
+    def escape(match):
+        escaped = match.group(1)
+        if escaped is None:
+            return '\\"'
+        if escaped == "'":
+            return "'"
+        return match.group(0)
+
+    return '"' + _json_escapes[quote].sub(escape, body) + '"'
+
+
+class _JsonFrame:
+    """An open object or array, with the state of its grammar."""
+
+    __slots__ = ('kind', 'state', 'start', 'children', 'key', 'index', 'members')
+
+    def __init__(self, kind: str, start: int):
+        self.kind = kind
+        self.state = 'first'
+        # Where it starts in the output, and where its complete objects are
+        self.start = start
+        self.children: List[Tuple[int, int]] = []
+        # In nested mode: the key (of an object) or index (of an array) of the
+        # value being read, and the scalar members of an object read so far
+        self.key: Optional[str] = None
+        self.index = 0
+        self.members: Dict[str, Any] = {}
+
+
+class JsonStreamExtractor:
+    """
+    Finds the JSON objects in text fed to it in chunks, in a single pass.
+
+    It skips to the next '{', then follows the grammar of the object token
+    by token, writing it out as strict JSON: single quoted strings become
+    double quoted ones, trailing commas are dropped and True, False and None
+    become true, false and null. An object is decoded (by the C decoder) as
+    soon as it closes; one in strict JSON is decoded right away. Where the
+    text turns out not to be an object, such as a brace in prose, the
+    complete objects found in it are kept and the search goes on from
+    there, so no part of the text is scanned more than twice.
+
+    With nested set, the objects within an object are returned too, each as
+    soon as it closes, such as the instructions in the list of an action
+    that is still being generated. They are returned as (path, object,
+    outer): the keys and indices leading to the object from the outermost
+    one (() for that one), and the strings, numbers, booleans and nulls of
+    the outermost object read so far.
+    """
+
+    def __init__(self, decoder: Optional[json.JSONDecoder] = None, nested: bool = False):
+        self.decoder = decoder or json.JSONDecoder(strict=False)
+        self.nested = nested
+        self.buffer = ''
+        self.stack: List[_JsonFrame] = []
+        self.out: List[str] = []
+        # The parts of a string being received, and its quote
+        self.string: Optional[List[str]] = None
+        self.quote = ''
+
+    def feed(self, chunk: str) -> List[Dict[str, Any]]:
+        """
+        Add text, and return the objects completed by it.
+        """
+        self.buffer += chunk
+        return self._scan(final=False)
+
+    def close(self) -> List[Dict[str, Any]]:
+        """
+        End the text, and return the objects found in what remained open.
+        """
+        found = self._scan(final=True)
+        found.extend(self._abandon())
+        self.buffer = ''
+        return found
+
+    def _scan(self, final: bool) -> List[Dict[str, Any]]:
+        found: List[Dict[str, Any]] = []
+        buffer = self.buffer
+        n = len(buffer)
+        pos = 0
+        while pos < n:
+            if self.string is not None:
+                end = _json_string_body[self.quote].match(buffer, pos).end()
+                self.string.append(buffer[pos:end])
+                if end == n or buffer[end] == '\\':
+                    # Not closed yet; only a trailing backslash needs to be seen again
+                    pos = end
+                    break
+                body = ''.join(self.string)
+                self.string = None
+                self._value(_strict_string(body, self.quote))
+                pos = end + 1
+                continue
+
+            if not self.stack:
+                start = buffer.find('{', pos)
+                if start == -1:
+                    pos = n
+                    break
+                # Strict JSON is left to the C decoder; it fails fast on anything else.
+                # It is given a window, since its errors take time in the offset of the error.
+                data = None if self.nested else self._decode_strict(buffer[start:start + _json_window])
+                if data is not None:
+                    found.append(data[0])
+                    pos = start + data[1]
+                    continue
+                self.stack.append(_JsonFrame('{', len(self.out)))
+                self.out.append('{')
+                pos = start + 1
+                continue
+
+            char = buffer[pos]
+            if char == '"' or char == "'":
+                if not self._expects_value(key=True):
+                    found.extend(self._abandon())
+                    continue
+                self.string = []
+                self.quote = char
+                pos += 1
+                continue
+
+            match = _json_token.match(buffer, pos)
+            if match is None:
+                rest = buffer[pos:pos + _json_longest_literal]
+                if not final and n - pos < _json_longest_literal and any(literal.startswith(rest) for literal in _json_literals):
+                    break
+                found.extend(self._abandon())
+                continue
+            end = match.end()
+            kind = match.lastindex
+            if kind == 1:
+                pos = end
+                continue
+            if kind == 3 and not final:
+                following = end
+                while following < n and buffer[following] in _json_number_chars:
+                    following += 1
+                if following == n:
+                    # The number may go on in the next chunk
+                    break
+
+            token = match.group(kind)
+            if kind == 2:
+                accepted = self._punctuation(token, found)
+            elif kind == 3:
+                accepted = self._expects_value() and self._value(token)
+            else:
+                accepted = self._expects_value() and self._value(_json_literals[token])
+            if not accepted:
+                found.extend(self._abandon())
+                continue
+            pos = end
+
+        self.buffer = buffer[pos:]
+        return found
+
+    def _decode_strict(self, text: str) -> Optional[Tuple[Dict[str, Any], int]]:
+        try:
+            return self.decoder.raw_decode(text)
+        except (ValueError, RecursionError):
+            return None
+
+    def _expects_value(self, key: bool = False) -> bool:
+        frame = self.stack[-1]
+        if frame.kind == '{':
+            return frame.state == 'value' or (key and frame.state in ('first', 'key'))
+        return frame.state in ('first', 'value')
+
+    def _value(self, piece: str) -> bool:
+        frame = self.stack[-1]
+        if frame.kind == '{' and frame.state in ('first', 'key'):
+            frame.state = 'colon'
+            if self.nested:
+                frame.key = json.loads(piece)
+        else:
+            frame.state = 'after'
+            if self.nested and frame.kind == '{' and len(self.stack) == 1:
+                frame.members[frame.key] = json.loads(piece)
+        self.out.append(piece)
+        return True
+
+    def _punctuation(self, token: str, found: List[Dict[str, Any]]) -> bool:
+        frame = self.stack[-1]
+        if token == '{' or token == '[':
+            if not self._expects_value():
+                return False
+            frame.state = 'after'
+            self.stack.append(_JsonFrame(token, len(self.out)))
+            self.out.append(token)
+        elif token == '}' or token == ']':
+            if frame.kind != ('{' if token == '}' else '['):
+                return False
+            if frame.state in ('key', 'value') and self.out[-1] == ',':
+                # A trailing comma
+                self.out.pop()
+            elif frame.state not in ('first', 'after'):
+                return False
+            self.out.append(token)
+            self.stack.pop()
+            self._closed(frame, found)
+        elif token == ':':
+            if frame.kind != '{' or frame.state != 'colon':
+                return False
+            frame.state = 'value'
+            self.out.append(token)
+        else:
+            if frame.state != 'after':
+                return False
+            frame.state = 'key' if frame.kind == '{' else 'value'
+            frame.index += 1
+            self.out.append(token)
+        return True
+
+    def _closed(self, frame: _JsonFrame, found: List[Dict[str, Any]]) -> None:
+        if self.stack:
+            parent = self.stack[-1]
+            if self.nested:
+                if frame.kind == '{':
+                    decoded = self._decode(frame.start, len(self.out))
+                    if decoded is not None:
+                        path = tuple(f.key if f.kind == '{' else f.index for f in self.stack)
+                        found.append((path, decoded, dict(self.stack[0].members)))
+            elif frame.kind == '{':
+                parent.children.append((frame.start, len(self.out)))
+            else:
+                parent.children.extend(frame.children)
+            return
+        decoded = self._decode(0, len(self.out))
+        if decoded is not None:
+            found.append(((), decoded, frame.members) if self.nested else decoded)
+        elif not self.nested:
+            found.extend(self._decoded(frame.children))
+        self.out = []
+
+    def _abandon(self) -> List[Dict[str, Any]]:
+        """
+        Give up on the open objects, returning the complete objects within them.
+        """
+        found = []
+        for frame in self.stack:
+            found.extend(self._decoded(frame.children))
+        self.stack = []
+        self.out = []
+        self.string = None
+        return found
+
+    def _decoded(self, spans: List[Tuple[int, int]]) -> List[Dict[str, Any]]:
+        objects = (self._decode(start, end) for start, end in spans)
+        return [data for data in objects if data is not None]
+
+    def _decode(self, start: int, end: int) -> Optional[Dict[str, Any]]:
+        try:
+            data = self.decoder.decode(''.join(self.out[start:end]))
+        except (ValueError, RecursionError) as e:
+            print_verbose(f"<error> extract_json_objects: {e}")
+            return None
+        return data if isinstance(data, dict) else None
 
 
 class VectorStore:
@@ -131,15 +437,30 @@ class VectorStore:
 
     Attributes:
         db (Chroma): The Chroma database used for storing vectors.
-        embedding_model (OllamaEmbeddings): The embedding model used for vectorization.
+        embedding_model (ScheduledEmbeddings): The embedding model used for vectorization,
+            wrapped by the shared embedding cache (see qembed) unless that is turned off.
+        embedding_id (str): Identifies the embeddings; stored vectors made by another
+            embedding model can't be compared with new ones.
     """
 
+    embedding_id = "ollama-embed:nomic-embed-text"
+
     def __init__(self, persist_directory: Optional[str] = None):
-        
-        self.embedding_model = OllamaEmbeddings(model="nomic-embed-text")
+        from qollama import ScheduledEmbeddings
+        from qembed import CachedEmbeddings, get_embedding_cache
+
+        # Embedded through the shared scheduler, in batches (see qollama)
+        self.embedding_model = ScheduledEmbeddings(model="nomic-embed-text")
+        embed_cache = get_embedding_cache()
+        if embed_cache:
+            self.embedding_model = CachedEmbeddings(self.embedding_model, model=self.embedding_id, cache=embed_cache)
         self.persist_directory = persist_directory 
+        # The pages stored by search_and_store(), which needn't be fetched again
+        self.sources = set()
+        self.lock = threading.Lock()
 
         if persist_directory and os.path.isdir(persist_directory):
+            from langchain_community.vectorstores import Chroma
             self.db = Chroma(
                 embedding_function=self.embedding_model,
                 persist_directory=persist_directory
@@ -148,30 +469,41 @@ class VectorStore:
             self.db = None
         
 
-    def search_and_store(self, query: str, num_results: int = 5) -> None:
+    def search_and_store(self, query: str, num_results: int = 5) -> List[str]:
         """
         Performs a Google Search for documents related to the given query,
-        extracts their content, and stores them in the vector store.
+        extracts their content, and adds them to the vector store. Pages
+        stored by an earlier search are neither fetched nor embedded again.
 
         Args:
             query (str): The query to search for documents.
             num_results (int): The number of URLs to retrieve. Defaults to 5.
 
         Returns:
-            None
+            List[str]: The URLs found, to filter a similarity search with.
         """
+        from googlesearch import search
+
+        urls = list(search(query, num_results))
         documents = []
         metadatas = []
         ids = []
-        for index, url in enumerate(search(query, num_results)):
+        for index, url in enumerate(urls):
+            with self.lock:
+                if url in self.sources:
+                    continue
             print_verbose(f"<info> ({index}) Extracting content from: {url}")
             text_splits = self.extract_content(url)
             for jindex, text in enumerate(text_splits):
                 documents.append(text)
                 metadatas.append({'source': url})
-                ids.append(f"id{index}.{jindex}")
+                ids.append(f"{url}#{jindex}")
 
-        self.store(documents, metadatas, ids)
+        if documents:
+            self.upsert(documents, metadatas, ids)
+        with self.lock:
+            self.sources.update(urls)
+        return urls
 
     def store(self, documents: List[str], metadatas: List[dict], ids: List[str], persist_directory: Optional[str] = None) -> None:
         """
@@ -185,6 +517,7 @@ class VectorStore:
         Returns:
             None
         """
+        from langchain_community.vectorstores import Chroma
         self.db = Chroma.from_texts(
             documents,
             metadatas=metadatas,
@@ -193,7 +526,52 @@ class VectorStore:
             persist_directory=persist_directory
         )
 
-    def store_documents(self, documents: List[Document]) -> None:
+    def open(self, persist_directory: Optional[str] = None) -> None:
+        """
+        Open the database, creating an empty one if it doesn't exist yet.
+
+        Args:
+            persist_directory (str, optional): Directory to persist the database in.
+                Defaults to the directory given when the VectorStore was created.
+        """
+        with self.lock:
+            if not self.db:
+                from langchain_community.vectorstores import Chroma
+                self.db = Chroma(
+                    embedding_function=self.embedding_model,
+                    persist_directory=persist_directory or self.persist_directory
+                )
+
+    def upsert(self, documents: List[str], metadatas: List[dict], ids: List[str]) -> None:
+        """
+        Add the given documents to the database, replacing any documents with the same ids.
+
+        Args:
+            documents (List[str]): The list of documents to store.
+            metadatas (List[dict]): The list of metadata dictionaries corresponding to each document.
+            ids (List[str]): The list of ids corresponding to each document.
+
+        Returns:
+            None
+        """
+        self.open()
+        self.db.add_texts(documents, metadatas=metadatas, ids=ids)
+
+    def delete(self, ids: List[str]) -> None:
+        """
+        Delete the documents with the given ids from the database.
+
+        Args:
+            ids (List[str]): The ids of the documents to delete.
+
+        Returns:
+            None
+        """
+        if self.db and ids:
+            self.db.delete(ids=ids)
+
+    def store_documents(self, documents: List['Document']) -> None:
+        from langchain_community.vectorstores import Chroma
         self.db = Chroma.from_documents(
             documents,
             embedding=self.embedding_model,
@@ -210,28 +588,27 @@ class VectorStore:
         Returns:
             str: The extracted content.
         """
-        response = requests.get(url)
-        soup = BeautifulSoup(response.text, 'html.parser')
-        text = ' '.join([p.text for p in soup.find_all('p')])  # Extract text from <p> tags
+        from qhttp import fetch_text_splits, get_http_cache
 
-        # We need to split it up into smaller pieces
-        text_splitter = RecursiveCharacterTextSplitter(chunk_size=500, chunk_overlap=50)
-        text_splits = text_splitter.split_text(text)
+        # Unchanged pages are taken from the HTTP cache, already split up
+        return fetch_text_splits(url, cache=get_http_cache(), timeout=None)
 
-        return text_splits
-
-    def similarity_search(self, query: str, num_results: int = 1) -> List[Document]:
+    def similarity_search(self, query: str, num_results: int = 1, where: Optional[dict] = None) -> List['Document']:
         """
         Performs a similarity search on the vector store using the given query.
 
         Args:
             query (str): The query for similarity search.
             num_results (int): The number of results to retrieve. Defaults to 1.
+            where (dict, optional): A Chroma metadata filter; only the matching
+                documents are ranked.
 
         Returns:
             List[Document]: The similarity search results.
         """
-        results = self.db.similarity_search(query=query, k=num_results)
+        with qtrace.span('query', num_results=num_results, filtered=where is not None) as query_span:
+            results = self.db.similarity_search(query=query, k=num_results, filter=where)
+            query_span.set(results=len(results))
         return results
     
 def example_similarity_search():
@@ -245,125 +622,171 @@ def example_similarity_search():
 
 
 
+def geometry():
+    # The points are computed with NumPy (see qgeom), loaded once something is drawn
+    import qgeom
+    return qgeom
+
+
+def draw_curves(painter: Any, curves: Iterable[Any]) -> None:
+    for points in curves:
+        painter.draw_curve(points)
+
+
+# How to carry out each drawing instruction, by its name, on a Painter
+instruction_handlers: Dict[str, Callable[[Any, Any], None]] = {
+    'draw_line': lambda painter, argument: painter.draw_line(geometry().as_points(argument['points'])),
+    'draw_circle': lambda painter, argument: painter.draw_circle(*argument['center'], argument['radius']),
+    'draw_curve': lambda painter, argument: painter.draw_curve(geometry().as_points(argument['points'])),
+    'draw_triangle': lambda painter, argument: painter.draw_triangle(geometry().as_points(argument['points'])),
+    'draw_polygon': lambda painter, argument: painter.draw_polygon(geometry().as_points(argument['points'])),
+    'draw_sinus': lambda painter, argument: painter.draw_curve(geometry().sinus_points(argument['start'], argument['range'])),
+    'draw_function': lambda painter, argument: draw_curves(painter, geometry().function_points(
+        argument['function'], argument.get('start', (0, 0)), argument['range'])),
+    'draw_bezier': lambda painter, argument: painter.draw_curve(geometry().bezier_points(argument['points'])),
+    'draw_arc': lambda painter, argument: painter.draw_curve(geometry().arc_points(
+        argument['center'], argument['radius'], argument['angles'])),
+    'draw_text': lambda painter, argument: painter.draw_text(*argument['position'], argument['text']),
+    'set_color': lambda painter, argument: painter.set_color(argument),
+    'clear_all': lambda painter, argument: painter.clear_all(),
+}
+
+
+def instruction_handler(instruction: Any) -> Optional[Tuple[Callable[[Any, Any], None], Any]]:
+    """
+    Return the handler of a drawing instruction and its argument, or None if it isn't one.
+    """
+    if isinstance(instruction, dict):
+        for name, argument in instruction.items():
+            handler = instruction_handlers.get(name)
+            if handler:
+                return handler, argument
+    return None
+
+
 class Painter():
-    def __init__(self, title: Optional[str] = "Title", width: Optional[int] = 800, height: Optional[int] = 600):
-        self.root = root = tk.Tk()
-        self.root.title(title)
-        self.canvas = tk.Canvas(self.root, width=width, height=height, bg="white")
-        self.canvas.pack(fill="both", expand=True)
+    """
+    Carries out drawing instructions, keeping the color and line width, on a
+    renderer (see qrender): a Tk window by default, or a headless one drawing
+    a PNG or SVG file. Instructions may be handled from any thread.
+
+    Tk may only be used from the thread running its main loop, so other
+    threads submit() instructions. They are queued and carried out in a
+    batch every frame, so that the canvas is redrawn once per frame rather
+    than after every instruction.
+    """
+
+    def __init__(self,
+                 title: Optional[str] = "Title",
+                 width: Optional[int] = 800,
+                 height: Optional[int] = 600,
+                 frame_ms: Optional[int] = 16,
+                 renderer: Optional[Any] = None,
+                 tolerance: Optional[float] = 0.5):
+        if renderer is None:
+            from qrender import TkRenderer
+            renderer = TkRenderer(title, width, height)
+        self.renderer = renderer
         self.color = "black"
         self.width = 1
+        self.frame_ms = frame_ms
+        # How far (in pixels) a simplified polyline may be from its points, see qgeom.simplify()
+        self.tolerance = tolerance
+        self.pending = queue.SimpleQueue()
+        self.lock = threading.RLock()
+
+    def polyline(self, points: Any) -> 'np.ndarray':
+        points = geometry().as_points(points)
+        if self.renderer.simplified and len(points) > geometry().min_simplified:
+            return geometry().simplify(points, self.tolerance)
+        return points
 
-    def draw_line(self, points: List[Tuple]) -> None:
-        self.canvas.create_line(points, fill=self.color, width=self.width)
+    def draw_line(self, points: Any) -> None:
+        self.renderer.line(self.polyline(points), self.color, self.width)
 
     def draw_circle(self, x, y, r):
-        self.canvas.create_oval(x-r, y-r, x+r, y+r, outline=self.color, width=self.width)
+        self.renderer.oval((x-r, y-r, x+r, y+r), outline=self.color, fill="", width=self.width)
 
     def draw_point(self, x, y):
-        self.canvas.create_oval(x, y, x+1, y+1, outline=self.color, fill=self.color)
+        self.renderer.oval((x, y, x+1, y+1), outline=self.color, fill=self.color, width=1)
 
-    def draw_curve(self, points: List[Dict]) -> None:
-        self.canvas.create_line(points, fill=self.color, width=self.width)
+    def draw_curve(self, points: Any) -> None:
+        self.renderer.line(self.polyline(points), self.color, self.width)
 
-    def draw_triangle(self, points: List[Dict]):
-        self.canvas.create_polygon(points, outline=self.color, fill="", width=self.width)
+    def draw_triangle(self, points: Any):
+        self.renderer.polygon(geometry().as_points(points), self.color, self.width)
 
-    def draw_polygon(self, points: List[Dict]):
-        self.canvas.create_polygon(points, outline=self.color, fill="", width=self.width)
+    def draw_polygon(self, points: Any):
+        self.renderer.polygon(self.polyline(points), self.color, self.width)
 
     def draw_text(self, x, y, text):
-        self.canvas.create_text(x, y, text=text, fill=self.color)
+        self.renderer.text(x, y, text, self.color)
 
     def set_color(self, color):
         self.color = color
 
     def clear_all(self):
-        self.canvas.delete("all")
+        self.renderer.clear()
 
 
     def handle_instruction(self, instruction: Dict) -> None:
 
         print_verbose(f"<info> Handle instruction: {instruction}")
 
-        if 'draw_line' in instruction:
-            # Unpack the points to be of type: List[tuple]
-            points = [tuple(point) for point in instruction['draw_line']['points']]
-            # Perform the drawing operation
-            print_verbose(f"draw_line: points={points}")
-            self.draw_line(points)
+        found = instruction_handler(instruction)
+        if found is None:
+            print_verbose(f"<error> Unknown instruction: {instruction}")
             return
+        handler, argument = found
+        try:
+            with self.lock:
+                handler(self, argument)
+        except (KeyError, TypeError, ValueError, OverflowError) as e:
+            # A malformed instruction from the model mustn't stop the drawing
+            print_verbose(f"<error> Bad instruction: {instruction}: {e!r}")
 
-        if 'draw_circle' in instruction:
-            # Unpack the data
-            x, y = instruction['draw_circle']['center']
-            r = instruction['draw_circle']['radius']
-            # Perform the drawing operation
-            print_verbose(f"draw_circle: x={x},y={y},r={r}")
-            self.draw_circle(x, y, r)
-            return
-        
-        if 'draw_curve' in instruction:
-            # Unpack the points to be of type: List[tuple]
-            points = [tuple(point) for point in instruction['draw_curve']['points']]
-            # Perform the drawing operation
-            print_verbose(f"draw_curve: points={points}")
-            self.draw_curve(points)
-            return
-        
-        if 'draw_triangle' in instruction:
-            # Unpack the points to be of type: List[tuple]
-            points = [tuple(point) for point in instruction['draw_triangle']['points']]
-            # Perform the drawing operation
-            print_verbose(f"draw_triangle: points={points}")
-            self.draw_triangle(points)
-            return
-        
-        if 'draw_polygon' in instruction:
-            # Unpack the points to be of type: List[tuple]
-            points = [tuple(point) for point in instruction['draw_polygon']['points']]
-            # Perform the drawing operation
-            print_verbose(f"draw_polygon: points={points}")
-            self.draw_polygon(points)
-            return
-        
-        if 'draw_sinus' in instruction:
-            # Unpack the data which is a range from Start to Stop degrees with a step of Step degrees 
-            start, stop, step, yscale = instruction['draw_sinus']['range']
-            xoff, yoff = instruction['draw_sinus']['start']
-            # Generate the points
-            x_range = range(start, stop, step)  # From 0 to 360 degrees with a step of 5 degrees
-            points = [(x+xoff, (math.sin(math.radians(x))*yscale) + yoff) for x in x_range]
-            # Perform the drawing operation
-            print_verbose(f"draw_curve: points={points}")
-            self.draw_curve(points)
-            return
-        
-        if 'draw_text' in instruction:
-            # Unpack the text and the position where to center it. 
-            x, y = instruction['draw_text']['position']
-            text = instruction['draw_text']['text']
-            # Perform the drawing operation
-            print_verbose(f"draw_text: text={text}")
-            self.draw_text(x, y, text)
-            return
-        
-        if 'set_color' in instruction:
-            # Unpack the color
-            color = instruction['set_color']
-            # Perform the drawing operation
-            print_verbose(f"draw_color: {color}")
-            self.set_color(color)
-            return
+    def submit(self, instruction: Dict) -> None:
+        """
+        Queue an instruction, from any thread, to be carried out with the next
+        frame; a headless painter carries it out right away.
+        """
+        if self.renderer.interactive:
+            self.pending.put(instruction)
+        else:
+            self.handle_instruction(instruction)
 
-        if 'clear_all' in instruction:
-            self.clear_all()
-            return
-        
-        print_verbose(f"<error> Unknown instruction: {instruction}")
+    def close(self) -> None:
+        """
+        Close the window (from any thread) once the queued instructions are carried out.
+        """
+        self.pending.put(None)
+
+    def draw_pending(self) -> bool:
+        """
+        Carry out the queued instructions as one batch.
+
+        Returns:
+            False once the painter has been closed.
+        """
+        while True:
+            try:
+                instruction = self.pending.get_nowait()
+            except queue.Empty:
+                return True
+            if instruction is None:
+                return False
+            self.handle_instruction(instruction)
+
+    def save(self, path: str) -> None:
+        """
+        Write the drawing to a file, e.g. a PNG or SVG file for a headless renderer.
+        """
+        with self.lock:
+            self.renderer.save(path)
 
     def start(self):
-        self.root.mainloop()
+        if self.renderer.interactive:
+            self.renderer.run(self)
 
 
 example_draw_instructions = """
@@ -385,9 +808,8 @@ Action:
 if __name__ == "__main__":
     p = Painter("Drawing Example")
     
-    json_text = example_draw_instructions.replace("'", '"')
     # Extract JSON objects
-    for data in extract_json_objects(json_text):
+    for data in extract_json_objects(example_draw_instructions):
         print_verbose(f"<info> Extracted JSON object: {data}")
 
         # If the JSON object contains an 'action_input' key, and 'query' is in 'action_input',
@@ -1,6 +1,9 @@
-import chromadb
-from chromadb.utils import embedding_functions
-from chromadb.config import Settings
+import hashlib
+import threading
+from concurrent.futures import Executor
+from qbm25 import BM25Index, reciprocal_rank_fusion
+from qflat import FlatCollection
+import qtrace
 from typing import (
     TYPE_CHECKING,
     Any,
@@ -13,8 +16,34 @@ from typing import (
     Type,
 )
 
+# Chroma (and the sentence transformer) are imported when the first VectorDB
+# is created, so that importing this module stays cheap.
+if TYPE_CHECKING:
+    from qembed import EmbeddingCache
+    from qquant import QuantizedIndex
+
 # See also: https://realpython.com/chromadb-vector-database/
 
+# Collections that aren't persisted are searched exhaustively (see qflat)
+# and, by default, never moved to Chroma's HNSW index. Building the index
+# costs far more than exact search saves until a collection is both large
+# and queried often. Measured with bench_vdb.py (384 dimensions, 10
+# queries), exact search wins at every size up to 150k; at 100k the index
+# takes 128 s to build and saves 14 ms per query, so it pays off only after
+# about 9000 queries, and its recall@6 is down to 0.87. The in-memory
+# collections here live for one question (qserver) or one session (qai_pdf),
+# far short of that. Set ann_threshold for a collection queried that often.
+default_ann_threshold = None
+
+backends = ('auto', 'flat', 'chroma')
+
+
+def content_hash(text: str) -> str:
+    """
+    Return a hash of the text, used to recognize content that is already stored.
+    """
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
 
 class VectorDB:
     """
@@ -24,68 +53,541 @@ class VectorDB:
         db_directory (optional): Directory where to store the DB.
         collection_name (optional): Name of the collection.
         embed_model (optional): Name of the sentence transformer model to use for embedding.
+        batch_size (optional): Number of documents embedded and stored per call by bulk_add().
+        embed_cache (optional): Cache of computed embeddings. Defaults to the shared cache, see qembed.
+        embed_executor (optional): Executor to compute embeddings in, e.g. a worker pool shared by many DBs.
+        embedding_function (optional): Chroma embedding function to use instead of the sentence
+            transformer, e.g. a deterministic one for benchmarks. Name it with embed_model.
+        backend (optional): 'chroma', 'flat' (exact NumPy search in memory, see qflat), or
+            'auto' (the default): flat for a DB that isn't persisted, until it grows beyond
+            ann_threshold documents if one is set, then Chroma.
+        ann_threshold (optional): Number of documents beyond which 'auto' moves to Chroma;
+            None (the default) keeps it flat.
+        quantization (optional): 'int8' or 'pq' to search quantized embeddings in memory (see
+            qquant). A DB that isn't persisted then keeps only those, and stays flat however
+            large it grows; a Chroma DB is searched through a quantized copy of its stored
+            embeddings instead of its HNSW index, see quantized_index().
+        rerank (optional): Candidates per result reranked by the full precision embeddings of a
+            quantized DB; 0 keeps no full precision copy.
     """
 
     def __init__(self,
                  db_directory: Optional[str] = "qvdb",
                  collection_name: Optional[str] = "qvdb-collection",
                  is_persistent: Optional[bool] = True,
-                 embed_model: Optional[str] = None
+                 embed_model: Optional[str] = None,
+                 batch_size: Optional[int] = 64,
+                 embed_cache: Optional['EmbeddingCache'] = None,
+                 embed_executor: Optional[Executor] = None,
+                 embedding_function: Optional[Callable[[List[str]], List[List[float]]]] = None,
+                 backend: Optional[str] = 'auto',
+                 ann_threshold: Optional[int] = default_ann_threshold,
+                 quantization: Optional[str] = None,
+                 rerank: Optional[int] = 4
                  ):
-        
+        from chromadb.utils import embedding_functions
+        from qembed import get_embedding_cache
+
+        if backend not in backends:
+            raise ValueError(f"Unknown backend: {backend}, expected one of: {', '.join(backends)}")
+        if backend == 'flat' and is_persistent:
+            raise ValueError("The flat backend only keeps a DB in memory")
+
         self.db_directory = db_directory
         self.collection_name = collection_name
+        self.is_persistent = is_persistent
+        self.batch_size = batch_size
+        self.backend = backend
+        self.ann_threshold = ann_threshold
+        self.quantization = quantization
+        self.rerank = rerank
 
         # See also: https://www.sbert.net/docs/pretrained_models.html
         self.embed_model = embed_model or "all-MiniLM-L6-v2"
-        self.embedding_func = embedding_functions.SentenceTransformerEmbeddingFunction(
+        self.embedding_func = embedding_function or embedding_functions.SentenceTransformerEmbeddingFunction(
             model_name=self.embed_model
         )
+        self.embed_cache = embed_cache or get_embedding_cache()
+        self.embed_executor = embed_executor
 
-        self.client_settings = Settings(
-            anonymized_telemetry=False,
-            is_persistent=is_persistent,
-            persist_directory=db_directory,
-            allow_reset=True,
-        )
-        
-        self.client = chromadb.Client(settings=self.client_settings)
+        # The lexical index for hybrid queries; built on first use, see lexical_index()
+        self.bm25 = None
+        self.bm25_lock = threading.Lock()
+        # The quantized index of a Chroma DB; built on first use, see quantized_index()
+        self.quantized = None
+        self.quantized_lock = threading.Lock()
+
+        # A small throwaway collection is searched faster than Chroma starts up
+        self.client = None
+        if backend == 'flat' or (backend == 'auto' and not is_persistent):
+            self.collection = self.new_flat()
+        else:
+            self.collection = self.open_chroma()
+
+    def open_chroma(self):
+        """
+        Create the Chroma client (once) and return its collection of the DB.
+        """
+        if self.client is None:
+            import chromadb
+            from chromadb.config import Settings
+
+            self.client_settings = Settings(
+                anonymized_telemetry=False,
+                is_persistent=self.is_persistent,
+                persist_directory=self.db_directory,
+                allow_reset=True,
+            )
+            self.client = chromadb.Client(settings=self.client_settings)
 
-        self.collection = self.client.get_or_create_collection(
-            name=collection_name,
+        return self.client.get_or_create_collection(
+            name=self.collection_name,
             metadata={"hnsw:space": "cosine"}, # l2 is the default
             embedding_function=self.embedding_func,
         )
 
+    def new_flat(self) -> FlatCollection:
+        """
+        Return an empty in-memory collection for the DB, quantized if so configured.
+        """
+        if self.quantization:
+            from qquant import QuantizedIndex
+            return FlatCollection(self.collection_name, QuantizedIndex(self.quantization, rerank=self.rerank))
+        return FlatCollection(self.collection_name)
+
+    def uses_flat(self) -> bool:
+        """
+        Whether the DB is searched exhaustively in memory (see qflat) rather than by Chroma.
+        """
+        return isinstance(self.collection, FlatCollection)
+
+    def check_size(self) -> None:
+        """
+        Move an 'auto' DB that has outgrown exhaustive search to Chroma.
+        """
+        if self.backend != 'auto' or self.quantization or self.ann_threshold is None or not self.uses_flat() \
+           or self.collection.count() <= self.ann_threshold:
+            return
+        with qtrace.span('move_to_ann', documents=self.collection.count()):
+            flat = self.collection
+            collection = self.open_chroma()
+            stored = flat.get(include=["documents", "metadatas", "embeddings"])
+            batch_size = self.client.get_max_batch_size()
+            for start in range(0, len(stored['ids']), batch_size):
+                end = start + batch_size
+                collection.add(ids=stored['ids'][start:end],
+                               documents=stored['documents'][start:end],
+                               metadatas=stored['metadatas'][start:end],
+                               embeddings=stored['embeddings'][start:end])
+            self.collection = collection
+
     def add(self, documents: List[str], metadatas: List[dict], ids: List[str]) -> None:
         """
-        Add documents to the DB.
+        Add documents to the DB. Unlike add_batch(), documents whose content
+        is already stored are added again, but with their content hash so
+        that add_batch() recognizes them.
+
+        Args:
+            documents: List of document strings to add to the DB.
+            metadatas: List of metadata dictionaries to add to the DB.
+            ids: List of ID strings to add to the DB.
+        """
+        metadatas = [dict(metadata, content_hash=content_hash(doc)) for doc, metadata in zip(documents, metadatas)]
+        with qtrace.span('upsert', documents=len(documents), stored=len(documents)):
+            embeddings = self.embed(documents)
+            self.collection.add(documents=documents, metadatas=metadatas, ids=ids, embeddings=embeddings)
+            self.indexed(ids, documents, embeddings)
+        self.check_size()
+
+    def delete(self, ids: List[str]) -> None:
+        """
+        Delete documents from the DB, and from the indexes built on first use.
+
+        Args:
+            ids: List of ID strings of the documents to delete.
+        """
+        with qtrace.span('delete', documents=len(ids)):
+            self.collection.delete(ids=ids)
+            with self.bm25_lock:
+                if self.bm25 is not None:
+                    self.bm25.remove(ids)
+            with self.quantized_lock:
+                if self.quantized is not None:
+                    self.quantized.remove(ids)
+
+    def indexed(self, ids: List[str], documents: List[str], embeddings: List[List[float]]) -> None:
+        """
+        Keep the indexes built on first use up to date with documents just stored.
+        """
+        # Checked under the locks, so documents stored while an index is built aren't missed
+        with self.bm25_lock:
+            if self.bm25 is not None:
+                self.bm25.add(ids, documents)
+        with self.quantized_lock:
+            if self.quantized is not None:
+                self.quantized.add(ids, embeddings)
+
+    def embed(self, documents: List[str], query: bool = False) -> List[List[float]]:
+        """
+        Compute the embeddings of the documents, reusing cached embeddings when possible.
+
+        Args:
+            documents: List of document strings to embed.
+            query: Whether the documents are queries, which are cached apart from
+                the stored documents (as by qembed.CachedEmbeddings).
+
+        Returns:
+            List of embeddings, one per document.
+        """
+        with qtrace.span('embed', model=self.embed_model, documents=len(documents)):
+            if self.embed_executor:
+                return self.embed_executor.submit(self._embed, documents, query).result()
+            return self._embed(documents, query)
+
+    def _embed(self, documents: List[str], query: bool = False) -> List[List[float]]:
+        if self.embed_cache:
+            model = f"sentence-transformers:{self.embed_model}" + (":query" if query else "")
+            return self.embed_cache.embed(model, documents, self.embedding_func)
+        return self.embedding_func(documents)
+
+    def add_batch(self, documents: List[str], metadatas: List[dict], ids: List[str]) -> int:
+        """
+        Embed and store a batch of documents using a single embedding call
+        and a single upsert. Documents whose content is already stored in the
+        collection (or occurs earlier in the batch) are skipped.
+
+        Args:
+            documents: List of document strings to add to the DB.
+            metadatas: List of metadata dictionaries to add to the DB.
+            ids: List of ID strings to add to the DB.
+
+        Returns:
+            The number of documents that were actually stored.
+        """
+        hashes = [content_hash(doc) for doc in documents]
+        if not hashes:
+            return 0
+        with qtrace.span('upsert', documents=len(documents)) as upsert_span:
+            stored = self._add_batch(documents, metadatas, ids, hashes)
+            upsert_span.set(stored=stored)
+        self.check_size()
+        return stored
+
+    def _add_batch(self, documents: List[str], metadatas: List[dict], ids: List[str], hashes: List[str]) -> int:
+        existing = self.collection.get(
+            where={"content_hash": {"$in": list(set(hashes))}},
+            include=["metadatas"]
+        )
+        seen = {metadata["content_hash"] for metadata in existing["metadatas"]}
+
+        new_documents, new_metadatas, new_ids = [], [], []
+        for doc, metadata, doc_id, doc_hash in zip(documents, metadatas, ids, hashes):
+            if doc_hash in seen:
+                continue
+            seen.add(doc_hash)
+            new_documents.append(doc)
+            new_metadatas.append(dict(metadata, content_hash=doc_hash))
+            new_ids.append(doc_id)
+
+        if new_documents:
+            embeddings = self.embed(new_documents)
+            self.collection.upsert(
+                documents=new_documents,
+                metadatas=new_metadatas,
+                ids=new_ids,
+                embeddings=embeddings
+            )
+            self.indexed(new_ids, new_documents, embeddings)
+        return len(new_documents)
+
+    def bulk_add(self,
+                 documents: List[str],
+                 metadatas: List[dict],
+                 ids: List[str],
+                 batch_size: Optional[int] = None
+                 ) -> int:
+        """
+        Add documents to the DB in batches, see add_batch().
 
         Args:
             documents: List of document strings to add to the DB.
             metadatas: List of metadata dictionaries to add to the DB.
             ids: List of ID strings to add to the DB.
+            batch_size: Documents per batch. Defaults to the batch size of the DB.
+
+        Returns:
+            The number of documents that were actually stored.
         """
-        self.collection.add(documents=documents, metadatas=metadatas, ids=ids)
+        with self.batch_writer(batch_size) as writer:
+            writer.add(documents, metadatas, ids)
+        return writer.stored
 
-    def query(self, query: str, num_results: int = 5) -> List[dict]:
+    def batch_writer(self, batch_size: Optional[int] = None) -> 'BatchWriter':
+        """
+        Return a BatchWriter that collects documents and stores them in batches.
+
+        Args:
+            batch_size: Documents per batch. Defaults to the batch size of the DB.
+        """
+        batch_size = batch_size or self.batch_size
+        if self.client:
+            batch_size = min(batch_size, self.client.get_max_batch_size())
+        return BatchWriter(self, batch_size)
+
+    def query(self,
+              query: str,
+              num_results: int = 5,
+              hybrid: bool = False,
+              dense_weight: float = 1.0,
+              lexical_weight: float = 1.0,
+              rrf_k: int = 60
+              ) -> List[dict]:
         """
         Query the DB.
 
+        In hybrid mode the results of the dense (embedding) search and of a
+        lexical BM25 search are fused with reciprocal rank fusion. The
+        distances returned are then 1 - the fused score relative to the best
+        result, so that they follow the fused order.
+
         Args:
             query: Query string.
             num_results: Number of results to return.
+            hybrid: Fuse dense and lexical results.
+            dense_weight: Weight of the dense results in hybrid mode.
+            lexical_weight: Weight of the lexical results in hybrid mode.
+            rrf_k: Rank damping of the reciprocal rank fusion.
 
         Returns:
             List of dictionaries containing the results.
         """
-        return self.collection.query(query_texts=query, n_results=num_results)
+        with qtrace.span('query', num_results=num_results, hybrid=hybrid):
+            return self._query(query, num_results, hybrid, dense_weight, lexical_weight, rrf_k)
+
+    def _query(self, query, num_results, hybrid, dense_weight, lexical_weight, rrf_k) -> List[dict]:
+        queries = [query] if isinstance(query, str) else list(query)
+        if not hybrid:
+            return self.dense_query(self.embed(queries, query=True), num_results)
+
+        # Fuse from a deeper list of candidates than we return
+        candidates = max(4 * num_results, 20)
+        dense = self.dense_query(self.embed(queries, query=True), candidates)
+        index = self.lexical_index()
+
+        results = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        for i, text in enumerate(queries):
+            found = {
+                doc_id: (doc, metadata)
+                for doc_id, doc, metadata in zip(dense['ids'][i], dense['documents'][i], dense['metadatas'][i])
+            }
+            with self.bm25_lock:
+                lexical = [doc_id for doc_id, _ in index.search(text, candidates)]
+            fused = reciprocal_rank_fusion([dense['ids'][i], lexical],
+                                           weights=[dense_weight, lexical_weight],
+                                           k=rrf_k)
+
+            ranked = []
+            while fused and len(ranked) < num_results:
+                wanted, fused = fused[:num_results - len(ranked)], fused[num_results - len(ranked):]
+                missing = [doc_id for doc_id, _ in wanted if doc_id not in found]
+                if missing:
+                    stored = self.collection.get(ids=missing, include=["documents", "metadatas"])
+                    found.update(zip(stored['ids'], zip(stored['documents'], stored['metadatas'])))
+                    # Documents deleted from the collection behind our back are left out
+                    stale = [doc_id for doc_id in missing if doc_id not in found]
+                    if stale:
+                        with self.bm25_lock:
+                            index.remove(stale)
+                ranked.extend((doc_id, score) for doc_id, score in wanted if doc_id in found)
+            fused = ranked
+
+            best = fused[0][1] if fused else 1.0
+            results['ids'].append([doc_id for doc_id, _ in fused])
+            results['documents'].append([found[doc_id][0] for doc_id, _ in fused])
+            results['metadatas'].append([found[doc_id][1] for doc_id, _ in fused])
+            results['distances'].append([1.0 - score / best for _, score in fused])
+        return results
+
+    def dense_query(self, embeddings: List[List[float]], num_results: int) -> Dict[str, List[List[Any]]]:
+        """
+        Return the stored documents most similar to the query embeddings, as a Chroma query does.
+        """
+        if not self.quantization or self.uses_flat():
+            return self.collection.query(query_embeddings=embeddings, n_results=num_results)
+        return self.quantized_query(embeddings, num_results)
+
+    def quantized_query(self, embeddings: List[List[float]], num_results: int) -> Dict[str, List[List[Any]]]:
+        """
+        Query a Chroma DB through its quantized index: the rerank * num_results
+        best candidates by their codes are reranked by their full precision
+        embeddings, fetched from Chroma along with their documents.
+        """
+        import numpy as np
+        from qflat import normalized, top_k
+
+        index = self.quantized_index()
+        with self.quantized_lock:
+            shortlists = index.search(embeddings, num_results * max(1, self.rerank))
+        include = ["documents", "metadatas"] + (["embeddings"] if self.rerank else [])
+        wanted = list(dict.fromkeys(doc_id for hits in shortlists for doc_id, _ in hits))
+        stored = self.collection.get(ids=wanted, include=include) if wanted else {'ids': []}
+        position = {doc_id: i for i, doc_id in enumerate(stored['ids'])}
+        vectors = normalized(stored['embeddings']) if self.rerank and wanted else None
+
+        results = {'ids': [], 'documents': [], 'metadatas': [], 'distances': []}
+        for query, hits in zip(normalized(embeddings), shortlists):
+            # Documents deleted from Chroma behind our back are left out
+            hits = [(doc_id, similarity) for doc_id, similarity in hits if doc_id in position]
+            if vectors is not None and hits:
+                rows = np.array([position[doc_id] for doc_id, _ in hits], dtype=np.intp)
+                top, similarities = top_k((vectors[rows] @ query)[None, :], num_results)
+                hits = [(hits[i][0], similarity) for i, similarity in zip(top[0].tolist(), similarities[0].tolist())]
+            hits = hits[:num_results]
+            results['ids'].append([doc_id for doc_id, _ in hits])
+            results['documents'].append([stored['documents'][position[doc_id]] for doc_id, _ in hits])
+            results['metadatas'].append([stored['metadatas'][position[doc_id]] for doc_id, _ in hits])
+            # Cosine distances, as in a Chroma collection with "hnsw:space": "cosine"
+            results['distances'].append([1.0 - similarity for _, similarity in hits])
+        return results
+
+    def quantized_index(self) -> 'QuantizedIndex':
+        """
+        Return the quantized index of a Chroma DB, building it from the
+        stored embeddings the first time, a batch at a time. After that it
+        is kept up to date by add() and delete(). It keeps only the codes:
+        the full precision embeddings of the candidates are fetched from Chroma.
+        """
+        from qquant import QuantizedIndex
+
+        with self.quantized_lock:
+            if self.quantized is None:
+                with qtrace.span('build_quantized', quantization=self.quantization) as build_span:
+                    index = QuantizedIndex(self.quantization, rerank=0)
+                    batch_size = self.client.get_max_batch_size()
+                    offset = 0
+                    while True:
+                        stored = self.collection.get(include=["embeddings"], limit=batch_size, offset=offset)
+                        if not len(stored['ids']):
+                            break
+                        index.add(stored['ids'], stored['embeddings'])
+                        offset += len(stored['ids'])
+                    build_span.set(documents=offset)
+                self.quantized = index
+            return self.quantized
+
+    def lexical_index(self) -> BM25Index:
+        """
+        Return the BM25 index of the collection, building it from the stored
+        documents the first time. After that it is kept up to date by add() and delete().
+        """
+        with self.bm25_lock:
+            if self.bm25 is None:
+                index = BM25Index()
+                stored = self.collection.get(include=["documents"])
+                index.add(stored['ids'], stored['documents'])
+                self.bm25 = index
+            return self.bm25
     
     def reset(self):
         """
         Reset the DB.
         """
-        self.client.reset() 
+        if self.client:
+            self.client.reset()
+        if self.uses_flat():
+            self.collection = self.new_flat()
+        self.bm25 = None
+        self.quantized = None
+
+    def drop(self):
+        """
+        Delete the collection, leaving any other collections of the DB intact.
+        """
+        if self.uses_flat():
+            self.collection = self.new_flat()
+        else:
+            self.client.delete_collection(self.collection_name)
+        self.bm25 = None
+        self.quantized = None
+
+    def measure_quantization(self,
+                             queries: List[str],
+                             k: int = 10,
+                             quantization: str = 'int8',
+                             rerank: int = 4
+                             ) -> Dict[str, float]:
+        """
+        Measure how a quantized copy of the stored embeddings would search, against exact search.
+
+        Args:
+            queries: Typical questions to the DB.
+            k: Number of results per query.
+            quantization: 'int8' or 'pq'.
+            rerank: Candidates per result reranked by the full precision embeddings.
+
+        Returns:
+            The recall@k, the bytes per embedding in memory, and the compression, see qquant.measure_recall.
+        """
+        from qquant import measure_recall
+
+        embeddings = self.collection.get(include=["embeddings"])['embeddings']
+        return measure_recall(embeddings, self.embed(queries, query=True), k=k, quantization=quantization, rerank=rerank)
+
+
+class BatchWriter:
+    """
+    Collects documents and stores them in a VectorDB one batch at a time.
+
+    Documents can be added in any number of calls as they become available;
+    whenever batch_size documents have been collected they are embedded and
+    stored together. Use it as a context manager, or call flush() at the end,
+    to store the remaining documents.
+
+    Attributes:
+        stored: Number of documents stored so far.
+        skipped: Number of documents skipped since their content already was stored.
+    """
+
+    def __init__(self, qvdb: VectorDB, batch_size: int):
+        self.qvdb = qvdb
+        self.batch_size = batch_size
+        self.documents = []
+        self.metadatas = []
+        self.ids = []
+        self.stored = 0
+        self.skipped = 0
+
+    def add(self, documents: List[str], metadatas: List[dict], ids: List[str]) -> None:
+        """
+        Add documents, storing a batch whenever enough of them have been collected.
+        """
+        self.documents.extend(documents)
+        self.metadatas.extend(metadatas)
+        self.ids.extend(ids)
+        while len(self.documents) >= self.batch_size:
+            self._store(self.batch_size)
+
+    def flush(self) -> None:
+        """
+        Store any remaining documents.
+        """
+        while self.documents:
+            self._store(self.batch_size)
+
+    def _store(self, n: int) -> None:
+        documents, self.documents = self.documents[:n], self.documents[n:]
+        metadatas, self.metadatas = self.metadatas[:n], self.metadatas[n:]
+        ids, self.ids = self.ids[:n], self.ids[n:]
+        stored = self.qvdb.add_batch(documents, metadatas, ids)
+        self.stored += stored
+        self.skipped += len(documents) - stored
+
+    def __enter__(self) -> 'BatchWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.flush()
 
 
 #
@@ -136,12 +638,11 @@ skins their tusks stand out in a most striking manner, making these weapons
 present a singularly formidable appearance.
 """
     documents = text.split("\n\n")
-    for i, doc in enumerate(documents):
-        qvdb.add(
-            documents=[doc],
-            metadatas=[{"paragraph": i}],
-            ids=[str(i)]
-        )
+    qvdb.bulk_add(
+        documents=documents,
+        metadatas=[{"paragraph": i} for i in range(len(documents))],
+        ids=[str(i) for i in range(len(documents))]
+    )
     query = "What did the creatures look like"
     results = qvdb.query(query, num_results=3)
     print(f"\nQuery: {query}")
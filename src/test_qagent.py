@@ -0,0 +1,43 @@
+import unittest
+from qagent import answer, convert_time
+from qtools import ToolExecutor, ToolRegistry
+
+class TestAgent(unittest.TestCase):
+    def test_convert_time(self):
+        self.assertEqual(convert_time({'time': '1:30:00'}), "5400 seconds")
+        self.assertEqual(convert_time({'time': '2:05'}), "125 seconds")
+
+    def test_answer(self):
+        registry = ToolRegistry()
+        registry.register('convert_time', "converts", convert_time)
+        registry.register('search', "searches", lambda action_input: f"found {action_input['query']}")
+        prompts = []
+        responses = iter([
+            "Thought: two things. Action: {'action': 'convert_time', 'action_input': {'time': '0:01:00'}} "
+            "{'action': 'search', 'action_input': {'query': 'q'}}",
+            "Final Answer: 60 seconds",
+        ])
+
+        def generate(prompt):
+            prompts.append(prompt)
+            return next(responses)
+
+        executor = ToolExecutor(registry)
+        try:
+            self.assertEqual(answer("How long?", executor, generate).strip(), "60 seconds")
+        finally:
+            executor.close()
+        self.assertIn('Observation of convert_time {"time": "0:01:00"}: 60 seconds\n'
+                      'Observation of search {"query": "q"}: found q', prompts[1])
+
+    def test_step_budget(self):
+        executor = ToolExecutor(ToolRegistry(), max_steps=3)
+        turns = []
+        try:
+            self.assertIsNone(answer("?", executor, lambda prompt: turns.append(prompt) or "Thought: hmm"))
+        finally:
+            executor.close()
+        self.assertEqual(len(turns), 3)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import unittest
+from qbm25 import BM25Index, reciprocal_rank_fusion, tokenize
+
+class TestBM25Index(unittest.TestCase):
+    def setUp(self):
+        self.index = BM25Index()
+        self.index.add(['a', 'b', 'c'], [
+            'The disk is full, see error ERR-42',
+            'Cats and dogs are friendly animals',
+            'The cat sat on the mat',
+        ])
+
+    def test_tokenize_keeps_codes_together(self):
+        self.assertEqual(tokenize('Error ERR-42 in v1.2.3'), ['error', 'err-42', 'in', 'v1.2.3'])
+
+    def test_exact_terms_rank_first(self):
+        self.assertEqual(self.index.search('err-42')[0][0], 'a')
+        self.assertEqual([doc_id for doc_id, _ in self.index.search('the cat')], ['c', 'a'])
+
+    def test_replace_and_remove(self):
+        self.index.add(['a'], ['nothing to see'])
+        self.assertEqual(self.index.search('err-42'), [])
+        self.index.remove(['c'])
+        self.assertEqual(len(self.index), 2)
+        self.assertEqual(self.index.search('mat'), [])
+
+    def test_compacts_removed_documents(self):
+        for i in range(10):
+            self.index.add(['b'], [f'cats and dogs, take {i}'])
+        # The replaced documents are dropped, postings and all
+        self.assertLessEqual(len(self.index.ids), 2 * len(self.index))
+        self.assertEqual(self.index.search('dogs')[0][0], 'b')
+        self.assertEqual(self.index.search('err-42')[0][0], 'a')
+        self.index.remove(['a', 'b', 'c'])
+        self.assertEqual((self.index.ids, self.index.postings, self.index.total_length), ([], {}, 0))
+
+class TestReciprocalRankFusion(unittest.TestCase):
+    def test_fuses_and_weights(self):
+        fused = reciprocal_rank_fusion([['x', 'y'], ['y', 'z']], k=1)
+        self.assertEqual([doc_id for doc_id, _ in fused], ['y', 'x', 'z'])
+        fused = reciprocal_rank_fusion([['x', 'y'], ['y', 'z']], weights=[4.0, 1.0], k=1)
+        self.assertEqual(fused[0][0], 'x')
+
+if __name__ == '__main__':
+    unittest.main()
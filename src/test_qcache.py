@@ -0,0 +1,110 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from qcache import AnswerCache, StageCache
+
+class TestStageCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = StageCache(os.path.join(self.tmpdir.name, "stages.db"), ttls={'search': 10, 'page': 100}, max_entries=2)
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_entries_expire_per_stage(self):
+        with mock.patch('qcache.time.time', return_value=1000.0):
+            self.cache.put('search', 'q', ['http://a'])
+            self.cache.put('page', 'http://a', ['text'])
+        with mock.patch('qcache.time.time', return_value=1050.0):
+            self.assertIsNone(self.cache.get('search', 'q'))
+            self.assertEqual(self.cache.get('page', 'http://a'), ['text'])
+        stats = self.cache.stats()
+        self.assertEqual(stats['search']['expired'], 1)
+        self.assertEqual(stats['page']['hit_rate'], 1.0)
+
+    def test_evicts_least_recently_used(self):
+        with mock.patch('qcache.time.time', side_effect=[1.0, 2.0, 3.0, 4.0, 5.0, 6.0]):
+            self.cache.put('page', 'a', 1)
+            self.cache.put('page', 'b', 2)
+            self.cache.get('page', 'a')
+            self.cache.put('page', 'c', 3)
+            self.assertIsNone(self.cache.get('page', 'b'))
+            self.assertEqual(self.cache.get('page', 'a'), 1)
+        self.assertEqual(self.cache.evictions, 1)
+
+def length_embedding_function():
+    # Questions of similar lengths are similar: "a" and "aaaaaaaaaa" at about 0.77
+    from chromadb.api.types import EmbeddingFunction
+
+    class LengthEmbeddingFunction(EmbeddingFunction):
+        def __init__(self):
+            pass
+
+        def __call__(self, input):
+            return [[1.0, len(text) / 10] for text in input]
+
+        @staticmethod
+        def name() -> str:
+            return "qai-test-length"
+
+        def get_config(self):
+            return {}
+
+        @staticmethod
+        def build_from_config(config):
+            return LengthEmbeddingFunction()
+
+    return LengthEmbeddingFunction()
+
+class TestAnswerCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {'QAI_EMBED_CACHE': 'off'})
+        self.environ.start()
+        self.cache = AnswerCache(self.tmpdir.name, threshold=0.95, ttl=100, max_entries=2,
+                                 embed_model="length", embedding_function=length_embedding_function())
+
+    def tearDown(self):
+        self.environ.stop()
+        self.tmpdir.cleanup()
+
+    def test_lookup(self):
+        self.cache.store("a", "m", "answer a", ["http://a"])
+        found = self.cache.lookup("a", "m")
+        self.assertEqual(found['answer'], "answer a")
+        self.assertEqual(found['sources'], ["http://a"])
+        self.assertAlmostEqual(found['similarity'], 1.0, places=5)
+        # Another model, or a question not similar enough
+        self.assertIsNone(self.cache.lookup("a", "other"))
+        self.assertIsNone(self.cache.lookup("aaaaaaaaaa", "m"))
+        # A threshold of 0 takes any question that isn't opposite
+        self.assertEqual(self.cache.lookup("aaaaaaaaaa", "m", threshold=0)['question'], "a")
+        stats = self.cache.stats()
+        self.assertEqual((stats['hits'], stats['misses']), (2, 2))
+
+    def test_expires(self):
+        with mock.patch('qcache.time.time', return_value=1000.0):
+            self.cache.store("a", "m", "answer a", [])
+        with mock.patch('qcache.time.time', return_value=1101.0):
+            self.assertIsNone(self.cache.lookup("a", "m"))
+        self.assertEqual(self.cache.stats()['expired'], 1)
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_evicts_least_recently_used(self):
+        for now, question in [(1.0, "a"), (2.0, "bbbbb")]:
+            with mock.patch('qcache.time.time', return_value=now):
+                self.cache.store(question, "m", f"answer {question}", [])
+        with mock.patch('qcache.time.time', return_value=3.0):
+            self.assertIsNotNone(self.cache.lookup("a", "m"))
+        with mock.patch('qcache.time.time', return_value=4.0):
+            self.cache.store("ccccccccc", "m", "answer c", [])
+        with mock.patch('qcache.time.time', return_value=5.0):
+            # The closest question left to "bbbbb" is another one
+            self.assertEqual(self.cache.lookup("bbbbb", "m", threshold=0)['question'], "ccccccccc")
+            self.assertEqual(self.cache.lookup("a", "m")['question'], "a")
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from PIL import Image
+import qdraw
+from qdraw import converse, draw_stream
+from qrender import ImageRenderer
+from qutils import Painter
+
+class RecordingPainter:
+    def __init__(self):
+        self.submitted = []
+
+    def submit(self, instruction):
+        self.submitted.append(instruction)
+
+class TestDrawStream(unittest.TestCase):
+    def test_draws_while_streaming(self):
+        response = ("START-TEXT:\nA {red} line.\nEND-TEXT:\nAct" "ion:\n"
+                    "{'action': 'draw', 'instructions': [{'set_color': 'red'}, "
+                    "{'draw_line': {'points': [[10, 100], [100, 10]]}}, {'clear_all': null}]}")
+        painter = RecordingPainter()
+        drawn_before_end = []
+
+        def chunks():
+            for i in range(0, len(response), 5):
+                yield {'response': response[i:i + 5], 'done': False}
+            drawn_before_end.extend(painter.submitted)
+            yield {'response': '', 'done': True, 'context': [1, 2]}
+
+        text, context = draw_stream(painter, chunks())
+        expected = [{'set_color': 'red'}, {'draw_line': {'points': [[10, 100], [100, 10]]}}, {'clear_all': None}]
+        self.assertEqual(painter.submitted, expected)
+        self.assertEqual(drawn_before_end, expected)
+        self.assertEqual(text, response)
+        self.assertEqual(context, [1, 2])
+
+    def test_only_draws_the_draw_action(self):
+        response = ("Thought: like {'draw_circle': {'center': [1, 2], 'radius': 3}} before.\nAction:\n"
+                    "{'instructions': [{'set_color': 'red'}, {'x': {'draw_line': {'points': [[0, 0], [1, 1]]}}}], "
+                    "'action': 'draw'} {'action': 'search', 'instructions': [{'set_color': 'blue'}]} "
+                    "{'draw_text': {'position': [1, 1], 'text': 'stray'}}")
+        for size in (1, 2, 5):
+            painter = RecordingPainter()
+            chunks = [{'response': response[i:i + size]} for i in range(0, len(response), size)]
+            draw_stream(painter, chunks)
+            self.assertEqual(painter.submitted, [{'set_color': 'red'}])
+
+class RecordingMemory:
+    def __init__(self):
+        self.turns = []
+
+    def next_context(self):
+        return None
+
+    def history(self):
+        return ""
+
+    def record(self, question, response, context):
+        self.turns.append((question, response))
+
+class TestConverse(unittest.TestCase):
+    def test_headless_without_streaming(self):
+        responses = iter([
+            {'response': "Action: {'action': 'draw', 'instructions': [{'set_color': 'red'}, "
+                         "{'draw_circle': {'center': [50, 50], 'radius': 20}}]}"},
+            {'response': "Action: {'action': 'draw', 'instructions': [{'set_color': 'blue'}, "
+                         "{'draw_line': {'points': [[0, 90], [99, 90]]}}]}"},
+        ])
+        questions = iter(["A red circle", "A blue line"])
+
+        def ask(prompt):
+            try:
+                return next(questions)
+            except StopIteration:
+                raise EOFError
+
+        painter = Painter(renderer=ImageRenderer(100, 100))
+        memory = RecordingMemory()
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch('builtins.input', ask), \
+                mock.patch.object(qdraw.qollama, 'generate', lambda **kwargs: next(responses)):
+            path = os.path.join(directory, "drawing.png")
+            converse(painter, 'model', memory, stream=False, output=path)
+            with Image.open(path) as image:
+                self.assertEqual(image.getpixel((70, 50)), (255, 0, 0))
+                self.assertEqual(image.getpixel((50, 90)), (0, 0, 255))
+        self.assertEqual([question for question, _ in memory.turns], ["A red circle", "A blue line"])
+
+if __name__ == '__main__':
+    unittest.main()
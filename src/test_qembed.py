@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+from qembed import EmbeddingCache
+
+class TestEmbeddingCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = EmbeddingCache(os.path.join(self.tmpdir.name, "embeddings.db"), max_entries=3)
+        self.calls = []
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def embed(self, texts):
+        self.calls.append(list(texts))
+        return [[float(len(text)), 0.5] for text in texts]
+
+    def test_embeds_only_unseen_texts(self):
+        self.assertEqual(self.cache.embed("m", ["a", "bb", "a"], self.embed), [[1.0, 0.5], [2.0, 0.5], [1.0, 0.5]])
+        self.assertEqual(self.cache.embed("m", ["bb", "ccc"], self.embed), [[2.0, 0.5], [3.0, 0.5]])
+        self.assertEqual(self.calls, [["a", "bb"], ["ccc"]])
+        # The same text embedded by another model is a miss
+        self.cache.embed("other", ["a"], self.embed)
+        self.assertEqual(self.calls[-1], ["a"])
+
+    def test_evicts_least_recently_used(self):
+        self.cache.embed("m", ["a", "b", "c"], self.embed)
+        self.cache.embed("m", ["a"], self.embed)
+        self.cache.embed("m", ["d"], self.embed)
+        stats = self.cache.stats()
+        self.assertEqual(stats["entries"], 3)
+        self.assertEqual(stats["evictions"], 1)
+        self.assertEqual(self.cache.get("m", [EmbeddingCache.key(t) for t in "abcd"])[1], None)
+
+    def test_miss_and_hit_agree(self):
+        embed = lambda texts: [[0.1, 1 / 3] for _ in texts]
+        missed = self.cache.embed("m", ["a"], embed)
+        self.assertEqual(self.cache.embed("m", ["a"], embed), missed)
+        self.assertNotEqual(missed, [[0.1, 1 / 3]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import unittest
+import numpy as np
+from qflat import FlatCollection, FlatIndex, matches
+
+class TestFlatIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(1)
+        self.vectors = rng.standard_normal((500, 16)).astype(np.float32)
+        self.queries = rng.standard_normal((3, 16)).astype(np.float32)
+        self.index = FlatIndex(capacity=8)
+        for start in range(0, 500, 64):
+            self.index.add([str(i) for i in range(start, min(start + 64, 500))], self.vectors[start:start + 64])
+
+    def exact(self, query, k, rows=range(500)):
+        unit = self.vectors / np.linalg.norm(self.vectors, axis=1, keepdims=True)
+        similarities = unit @ (query / np.linalg.norm(query))
+        return sorted(rows, key=lambda row: -similarities[row])[:k]
+
+    def test_top_k_matches_full_sort(self):
+        found = self.index.search(self.queries, 10)
+        self.assertEqual(len(found), 3)
+        for query, hits in zip(self.queries, found):
+            self.assertEqual([int(doc_id) for doc_id, _ in hits], self.exact(query, 10))
+            similarities = [similarity for _, similarity in hits]
+            self.assertEqual(similarities, sorted(similarities, reverse=True))
+
+    def test_candidates(self):
+        rows = list(range(0, 500, 7))
+        hits = self.index.search(self.queries[0], 5, candidates=rows)[0]
+        self.assertEqual([int(doc_id) for doc_id, _ in hits], self.exact(self.queries[0], 5, rows))
+
+    def test_remove_and_replace(self):
+        best = self.index.search(self.queries[0], 1)[0][0][0]
+        self.index.remove([best, '499'])
+        self.assertEqual(len(self.index), 498)
+        hits = self.index.search(self.queries[0], 500)[0]
+        self.assertEqual(len(hits), 498)
+        self.assertNotIn(best, [doc_id for doc_id, _ in hits])
+
+        self.index.add(['3'], [self.queries[0]])
+        doc_id, similarity = self.index.search(self.queries[0], 1)[0][0]
+        self.assertEqual(doc_id, '3')
+        self.assertAlmostEqual(similarity, 1.0, places=5)
+        self.assertEqual(len(self.index), 498)
+
+class TestFlatCollection(unittest.TestCase):
+    def setUp(self):
+        self.collection = FlatCollection('test')
+        self.collection.add(ids=['a', 'b', 'c'],
+                            embeddings=[[1, 0], [0, 1], [1, 1]],
+                            documents=['doc a', 'doc b', 'doc c'],
+                            metadatas=[{'page': 1}, {'page': 2}, {'page': 3}])
+
+    def test_query(self):
+        result = self.collection.query(query_embeddings=[[1, 0], [0, 1]], n_results=2)
+        self.assertEqual(result['ids'], [['a', 'c'], ['b', 'c']])
+        self.assertEqual(result['documents'][0], ['doc a', 'doc c'])
+        self.assertAlmostEqual(result['distances'][0][0], 0.0, places=5)
+        result = self.collection.query(query_embeddings=[[1, 0]], n_results=5, where={'page': {'$gte': 2}})
+        self.assertEqual(result['ids'], [['c', 'b']])
+
+    def test_add_keeps_existing_and_delete(self):
+        self.collection.add(ids=['a'], embeddings=[[0, 1]], documents=['new'], metadatas=[{'page': 9}])
+        self.assertEqual(self.collection.get(ids=['a'])['documents'], ['doc a'])
+        self.collection.delete(where={'page': {'$in': [1, 3]}})
+        self.assertEqual(self.collection.count(), 1)
+        self.assertEqual(self.collection.get()['ids'], ['b'])
+
+    def test_matches(self):
+        metadata = {'source': 'x.pdf', 'page': 4}
+        self.assertTrue(matches(metadata, {'source': 'x.pdf'}))
+        self.assertTrue(matches(metadata, {'$or': [{'page': {'$lt': 2}}, {'source': {'$ne': 'y.pdf'}}]}))
+        self.assertFalse(matches(metadata, {'$and': [{'page': 4}, {'source': {'$nin': ['x.pdf']}}]}))
+        self.assertFalse(matches(metadata, {'missing': {'$gt': 1}}))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import math
+import unittest
+import numpy as np
+from qrender import SvgRenderer
+from qutils import Painter
+from qgeom import arc_points, bezier_points, function_points, parse_function, segment_distances, simplify, sinus_points
+
+class TestGeometry(unittest.TestCase):
+    def test_sinus(self):
+        expected = [(x + 20, math.sin(math.radians(x)) * 100 + 200) for x in range(0, 360, 5)]
+        np.testing.assert_allclose(sinus_points([20, 200], [0, 360, 5, 100]), expected)
+        with self.assertRaises(ValueError):
+            sinus_points([0, 0], [0, 10 ** 9, 1, 1])
+
+    def test_function(self):
+        points, = function_points('2 * x^2 - 1', [10, 20], [0, 3, 1])
+        np.testing.assert_allclose(points, [[10, 19], [11, 21], [12, 27]])
+        # Split where it isn't defined
+        pieces = function_points('sqrt(abs(x) - 2) + log(x + 5)', [0, 0], [-10, 10, 1])
+        self.assertEqual([piece[:, 0].tolist() for piece in pieces], [[-4, -3, -2], [2, 3, 4, 5, 6, 7, 8, 9]])
+        for expression in ['__import__("os")', 'x.real', 'sin', '[x]', 'sin(x, out=x)', 'x +']:
+            with self.assertRaises(ValueError):
+                parse_function(expression)
+
+    def test_bezier_and_arc(self):
+        curve = bezier_points([[0, 0], [50, 100], [100, 0]])
+        np.testing.assert_allclose(curve[[0, len(curve) // 2, -1]], [[0, 0], [50, 50], [100, 0]])
+        arc = arc_points([100, 100], 50, [0, 90])
+        np.testing.assert_allclose(arc[[0, -1]], [[150, 100], [100, 50]], atol=1e-9)
+        np.testing.assert_allclose(np.hypot(*(arc - 100).T), 50)
+
+    def test_simplify(self):
+        line = np.column_stack((np.arange(100.0), np.arange(100.0)))
+        np.testing.assert_array_equal(simplify(line), [[0, 0], [99, 99]])
+        corner = np.array([[0, 0], [1, 0.1], [2, 0], [2, 5], [2.2, 10]])
+        np.testing.assert_array_equal(simplify(corner), [[0, 0], [2, 0], [2.2, 10]])
+        curve = sinus_points([0, 300], [0, 720, 0.25, 200])
+        simplified = simplify(curve, 0.5)
+        self.assertLess(len(simplified), len(curve) // 20)
+        # Every point is within the tolerance of the simplified curve
+        distances = np.min([segment_distances(curve, a, b) for a, b in zip(simplified, simplified[1:])], axis=0)
+        self.assertLessEqual(distances.max(), 0.5)
+
+    def test_painter(self):
+        painter = Painter(renderer=SvgRenderer())
+        painter.handle_instruction({'draw_sinus': {'start': [0, 300], 'range': [0, 720, 0.25, 200]}})
+        painter.handle_instruction({'draw_function': {'function': '20 * log(x)', 'start': [0, 100], 'range': [-100, 100, 1]}})
+        painter.handle_instruction({'draw_arc': {'center': [100, 100], 'radius': 50, 'angles': [0, 'x']}})
+        sinus, plot = painter.renderer.elements
+        self.assertLess(sinus.count(','), 200)
+        self.assertEqual(plot.count(','), 99)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+import os
+import tempfile
+import unittest
+from qhttp import HttpCache, default_parser, extract_paragraphs, fetch_text_splits
+
+page = """<html><body><nav><a href="/">Home</a></nav>
+<p>First <b>bold</b> &amp; <a href="/x">linked</a>.</p>
+<p>Unclosed paragraph<div>not in a paragraph</div>
+<ul><li><p>In a list</li></ul></body></html>"""
+
+class Response:
+    def __init__(self, status_code, text="", headers=None):
+        self.status_code = status_code
+        self.text = text
+        self.headers = headers or {}
+
+class Session:
+    def __init__(self):
+        self.requests = []
+
+    def get(self, url, headers=None, **kwargs):
+        self.requests.append(headers)
+        if headers.get('If-None-Match') == '"v1"':
+            return Response(304)
+        return Response(200, page, {'ETag': '"v1"'})
+
+class TestParagraphs(unittest.TestCase):
+    def test_parsers_agree(self):
+        expected = "First bold & linked. Unclosed paragraph In a list"
+        for parser in {'stream', default_parser()}:
+            self.assertEqual(extract_paragraphs(page, parser=parser).replace('\n', ' ').strip(), expected)
+
+class TestHttpCache(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = HttpCache(os.path.join(self.tmpdir.name, "http.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def test_revalidates_with_conditional_get(self):
+        session = Session()
+        first = fetch_text_splits("http://example.com", session=session, cache=self.cache, parser='stream')
+        second = fetch_text_splits("http://example.com", session=session, cache=self.cache, parser='stream')
+        self.assertEqual(first, second)
+        self.assertEqual(session.requests, [{}, {'If-None-Match': '"v1"'}])
+        self.assertEqual(self.cache.stats()['revalidated'], 1)
+        # Other split settings are computed from the cached body
+        self.assertEqual(fetch_text_splits("http://example.com", session=session, cache=self.cache, chunk_size=20, chunk_overlap=0, parser='stream')[0],
+                         "First bold & linked.")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+import csv
+import os
+import tempfile
+import unittest
+from argparse import Namespace
+from unittest import mock
+from fakeollama import fake_embedding
+from qimdb import IndexManifest, build_filter, row_id, row_metadata, update_index
+from qutils import VectorStore
+
+row = {
+    'Poster_Link': 'https://example.com/poster.jpg', 'Series_Title': 'Heat', 'Released_Year': '1995',
+    'Genre': 'Action, Crime, Drama', 'IMDB_Rating': '8.3', 'Director': 'Michael Mann',
+    'Star1': 'Al Pacino', 'Star2': 'Robert De Niro', 'Star3': 'Val Kilmer', 'Star4': 'Jon Voight',
+}
+
+def flags(**kwargs):
+    return Namespace(**dict({'genre': None, 'rating': None, 'director': None, 'release_year': None}, **kwargs))
+
+class TestMetadataFilter(unittest.TestCase):
+    def test_row_metadata_is_typed(self):
+        metadata = row_metadata(row)
+        self.assertEqual(metadata['year'], 1995)
+        self.assertEqual(metadata['rating'], 8.3)
+        self.assertTrue(metadata['genre_crime'] and metadata['genre_drama'])
+        self.assertNotIn('genre_comedy', metadata)
+        self.assertNotIn('year', row_metadata(dict(row, Released_Year='PG')))
+
+    def test_build_filter(self):
+        self.assertIsNone(build_filter(flags()))
+        self.assertEqual(build_filter(flags(genre='Sci-Fi')), {'genre_sci-fi': True})
+        self.assertEqual(build_filter(flags(rating='8', release_year='1990-1999')),
+                         {'$and': [{'rating': {'$gte': 8.0}}, {'year': {'$gte': 1990}}, {'year': {'$lte': 1999}}]})
+
+columns = ['Poster_Link', 'Series_Title', 'Released_Year', 'Certificate', 'Runtime', 'Genre', 'IMDB_Rating',
+           'Overview', 'Meta_score', 'Director', 'Star1', 'Star2', 'Star3', 'Star4', 'No_of_Votes', 'Gross']
+
+def movie(title, year, overview="A story."):
+    return dict(row, Series_Title=title, Released_Year=year, Overview=overview,
+                Certificate='R', Runtime='120 min', Meta_score='80', No_of_Votes='1000', Gross='1')
+
+class FakeEmbeddings:
+    # Fails on the embedding call number fail_at, as an interrupted build would
+    def __init__(self):
+        self.calls = []
+        self.fail_at = None
+
+    def embed_documents(self, texts):
+        self.calls.append(list(texts))
+        if len(self.calls) == self.fail_at:
+            raise KeyboardInterrupt
+        return [fake_embedding(text) for text in texts]
+
+    def embed_query(self, text):
+        return fake_embedding(text)
+
+class TestUpdateIndex(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.environ = mock.patch.dict(os.environ, {'QAI_EMBED_CACHE': 'off'})
+        self.environ.start()
+        self.csv_file = os.path.join(self.tmpdir.name, "movies.csv")
+        self.persist_directory = os.path.join(self.tmpdir.name, "db")
+        self.embeddings = FakeEmbeddings()
+
+    def tearDown(self):
+        self.environ.stop()
+        self.tmpdir.cleanup()
+
+    def write_csv(self, movies):
+        with open(self.csv_file, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(movies)
+
+    def update(self, batch_size=2):
+        # As qimdb.main does, with a fresh VectorStore every run
+        with mock.patch('qollama.ScheduledEmbeddings', return_value=self.embeddings):
+            v = VectorStore(persist_directory=self.persist_directory)
+        v.open()
+        return update_index(v, self.csv_file, self.persist_directory, batch_size=batch_size), v
+
+    def stored_ids(self, v):
+        return sorted(v.db.get(include=[])['ids'])
+
+    def test_add_change_delete(self):
+        movies = [movie("Heat", "1995"), movie("Alien", "1979"), movie("Up", "2009")]
+        self.write_csv(movies)
+        counts, v = self.update()
+        self.assertEqual(counts, {'stored': 3, 'deleted': 0, 'unchanged': 0})
+        self.assertEqual(self.update()[0], {'stored': 0, 'deleted': 0, 'unchanged': 3})
+
+        self.embeddings.calls.clear()
+        self.write_csv([movie("Heat", "1995", "Another story."), movie("Alien", "1979"), movie("Brazil", "1985")])
+        counts, v = self.update()
+        self.assertEqual(counts, {'stored': 2, 'deleted': 1, 'unchanged': 1})
+        self.assertEqual(len(self.embeddings.calls[0]), 2)
+        self.assertEqual(self.stored_ids(v), sorted(row_id(m) for m in [movies[0], movies[1], movie("Brazil", "1985")]))
+        heat = v.db.get(ids=[row_id(movies[0])])['documents'][0]
+        self.assertIn("Another story.", heat)
+
+    def test_resumes_an_interrupted_build(self):
+        movies = [movie(f"Movie {i}", str(1990 + i)) for i in range(5)]
+        self.write_csv(movies)
+        self.embeddings.fail_at = 2
+        with self.assertRaises(KeyboardInterrupt):
+            self.update()
+        # The first batch was stored, and checkpointed in the manifest
+        manifest = IndexManifest(self.persist_directory)
+        self.assertEqual(sorted(manifest.hashes()), sorted(row_id(m) for m in movies[:2]))
+        manifest.close()
+
+        self.embeddings.fail_at = None
+        self.embeddings.calls.clear()
+        counts, v = self.update()
+        self.assertEqual(counts, {'stored': 3, 'deleted': 0, 'unchanged': 2})
+        self.assertEqual(sum(len(texts) for texts in self.embeddings.calls), 3)
+        self.assertEqual(self.stored_ids(v), sorted(row_id(m) for m in movies))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+from qingest import extract_pages, split_pages
+
+def make_pdf(texts):
+    """
+    A PDF with a page per text, written out by hand.
+    """
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None,
+               "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in texts:
+        stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET"
+        objects.append(f"<< /Length {len(stream)} >>\nstream\n{stream}\nendstream")
+        objects.append(f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+                       f"/Resources << /Font << /F1 3 0 R >> >> /Contents {len(objects)} 0 R >>")
+        kids.append(f"{len(objects)} 0 R")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(kids)}] /Count {len(kids)} >>"
+
+    pdf = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(pdf))
+        pdf += f"{number} 0 obj\n{body}\nendobj\n".encode('latin-1')
+    xref = len(pdf)
+    pdf += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode('latin-1')
+    pdf += "".join(f"{offset:010d} 00000 n \n" for offset in offsets).encode('latin-1')
+    pdf += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode('latin-1')
+    return pdf
+
+class TestIngest(unittest.TestCase):
+    def test_pages_in_order(self):
+        texts = [f"Text of page {i}" for i in range(1, 4)]
+        self.assertEqual(extract_pages(make_pdf(texts)), list(enumerate(texts, start=1)))
+
+    def test_pages_in_order_from_workers(self):
+        # Enough pages for two worker processes
+        texts = [f"Text of page {i}" for i in range(1, 21)]
+        self.assertEqual(extract_pages(make_pdf(texts), max_workers=2), list(enumerate(texts, start=1)))
+
+    def test_split_pages_keeps_the_page(self):
+        chunks, metadatas = split_pages([(1, "one"), (2, "two " * 10)], "doc.pdf", chunk_size=20, chunk_overlap=0)
+        self.assertEqual(chunks[0], "one")
+        self.assertEqual(metadatas[0], {'source': 'doc.pdf', 'page': 1})
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual({metadata['page'] for metadata in metadatas[1:]}, {2})
+
+if __name__ == '__main__':
+    unittest.main()
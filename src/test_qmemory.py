@@ -0,0 +1,51 @@
+import unittest
+from qmemory import ConversationMemory
+from qpack import TokenCounter
+
+class WordCounter(TokenCounter):
+    def count(self, text):
+        return len(text.split())
+
+class TestConversationMemory(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+
+    def summarize(self, summary, transcript):
+        self.calls.append((summary, transcript))
+        return f"summary {len(self.calls)}"
+
+    def memory(self, **kwargs):
+        return ConversationMemory(model="m", budget=10, summarize=self.summarize, counter=WordCounter(), **kwargs)
+
+    def test_reuses_context_within_budget(self):
+        memory = self.memory()
+        memory.record("q1", "a1", [1, 2, 3])
+        self.assertEqual(memory.next_context(), [1, 2, 3])
+        self.assertEqual(memory.history(), "")
+        self.assertEqual(self.calls, [])
+
+    def test_summarizes_context_over_budget(self):
+        memory = self.memory()
+        memory.record("q1", "a1", list(range(5)))
+        memory.record("q2", "a2", list(range(11)))
+        self.assertIsNone(memory.next_context())
+        self.assertEqual(memory.history(), "Summary of the conversation so far:\nsummary 1\n")
+        self.assertEqual(self.calls, [("", "User: q1\nAssistant: a1\nUser: q2\nAssistant: a2")])
+        # The next summary builds on the previous one
+        memory.record("q3", "a3", list(range(20)))
+        memory.wait()
+        self.assertEqual(self.calls[-1], ("summary 1", "User: q3\nAssistant: a3"))
+
+    def test_sliding_window(self):
+        memory = self.memory(reuse_context=False)
+        for turn in range(1, 5):
+            memory.record(f"q{turn}", f"a{turn}")
+            memory.wait()
+        # Each turn is 4 words, so only the last two fit in the window
+        self.assertEqual(memory.history(), "Summary of the conversation so far:\nsummary 2\n\n"
+                                           "User: q3\nAssistant: a3\nUser: q4\nAssistant: a4")
+        self.assertEqual([transcript for _, transcript in self.calls],
+                         ["User: q1\nAssistant: a1", "User: q2\nAssistant: a2"])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+import threading
+import time
+import unittest
+from fakeollama import FakeOllama
+from qollama import BULK, INTERACTIVE, OllamaBusyError, OllamaScheduler, PrioritySlots
+
+class TestPrioritySlots(unittest.TestCase):
+    def test_priority_order(self):
+        slots = PrioritySlots(1)
+        slots.acquire()
+        order = []
+
+        def waiter(name, priority):
+            slots.acquire(priority)
+            order.append(name)
+            slots.release()
+
+        threads = []
+        for name, priority in [('bulk', BULK), ('interactive', INTERACTIVE)]:
+            threads.append(threading.Thread(target=waiter, args=(name, priority)))
+            threads[-1].start()
+            while len(slots.waiting) < len(threads):
+                time.sleep(0.001)
+        slots.release()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(order, ['interactive', 'bulk'])
+
+    def test_backpressure(self):
+        slots = PrioritySlots(1, max_waiting=0)
+        slots.acquire()
+        with self.assertRaises(OllamaBusyError):
+            slots.acquire()
+        with self.assertRaises(OllamaBusyError):
+            PrioritySlots(0).acquire(timeout=0.01)
+
+class TestScheduler(unittest.TestCase):
+    def test_per_model_limit(self):
+        with FakeOllama(delay=0.05) as fake:
+            scheduler = OllamaScheduler(host=fake.host, max_in_flight=2, max_total=4)
+            threads = [threading.Thread(target=scheduler.generate, args=('m', 'hi')) for _ in range(6)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(fake.max_concurrent['m'], 2)
+
+    def test_retry(self):
+        with FakeOllama(fail_first=2) as fake:
+            scheduler = OllamaScheduler(host=fake.host, retries=3, backoff=0.001)
+            chunks = list(scheduler.generate('m', 'hi', stream=True))
+            self.assertEqual(''.join(chunk['response'] for chunk in chunks).strip(), fake.response)
+            self.assertEqual(scheduler.stats()['retries'], 2)
+            # The slot is released once the stream is consumed
+            self.assertEqual(scheduler.slots('m').in_flight, 0)
+
+    def test_embed_batching(self):
+        with FakeOllama(delay=0.02) as fake:
+            scheduler = OllamaScheduler(host=fake.host, embed_batch_wait=0.05)
+            results = {}
+
+            def embed(i):
+                results[i] = scheduler.embed('e', [f"text {i}", f"more {i}"])
+
+            threads = [threading.Thread(target=embed, args=(i,)) for i in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(sorted(len(vectors) for vectors in results.values()), [2] * 8)
+            self.assertLess(scheduler.stats()['embed_batches'], 8)
+            # Every text gets its own embedding back
+            single = scheduler.embed('e', ["text 3"])[0]
+            self.assertEqual(results[3][0], single)
+
+if __name__ == '__main__':
+    unittest.main()
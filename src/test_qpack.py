@@ -0,0 +1,30 @@
+import unittest
+from qpack import TokenCounter, pack_chunks, trim_overlap
+
+class CharCounter(TokenCounter):
+    def count(self, text):
+        return len(text)
+
+class TestPackChunks(unittest.TestCase):
+    def test_trim_overlap(self):
+        self.assertEqual(trim_overlap("The quick brown fox jumps", "brown fox jumps over the dog"), "over the dog")
+        self.assertEqual(trim_overlap("brown fox jumps over the dog", "The quick brown fox jumps"), "The quick")
+        self.assertEqual(trim_overlap("no overlap here", "something else"), "something else")
+
+    def test_ranks_dedups_and_packs_into_budget(self):
+        chunks = [
+            {'text': 'far away chunk', 'source': 'a', 'distance': 0.9},
+            {'text': 'best chunk of all', 'source': 'a', 'distance': 0.1},
+            {'text': 'Best  chunk of ALL', 'source': 'b', 'distance': 0.2},
+            {'text': 'chunk of', 'source': 'c', 'distance': 0.3},
+            {'text': 'a rather long chunk that does not fit', 'source': 'c', 'distance': 0.4},
+        ]
+        result = pack_chunks(chunks, budget=32, counter=CharCounter())
+        self.assertEqual([chunk['text'] for chunk in result['chunks']], ['best chunk of all', 'far away chunk'])
+        self.assertEqual(result['packed_tokens'], 31)
+        self.assertEqual(result['duplicates'], 2)
+        self.assertEqual(result['dropped'], 1)
+        self.assertEqual(result['dropped_tokens'], 37)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,48 @@
+import unittest
+import numpy as np
+from qflat import FlatCollection, normalized
+from qquant import ProductQuantizer, QuantizedIndex, measure_recall, recall_at_k
+
+class TestQuantizedIndex(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.default_rng(2)
+        basis = rng.standard_normal((4, 32))
+        self.vectors = (rng.standard_normal((600, 4)) @ basis + 0.1 * rng.standard_normal((600, 32))).astype(np.float32)
+        self.queries = (rng.standard_normal((5, 4)) @ basis).astype(np.float32)
+        self.ids = [str(i) for i in range(600)]
+
+    def test_int8_with_rerank_is_exact(self):
+        result = measure_recall(self.vectors, self.queries, k=10, quantization='int8', rerank=4)
+        self.assertEqual(result['recall'], 1.0)
+        self.assertEqual(result['bytes_per_vector'], 32 + 4)
+
+    def test_product_quantization(self):
+        index = QuantizedIndex('pq', rerank=0)
+        index.add(self.ids, self.vectors)
+        # Kept as they are until there are enough embeddings to train on
+        self.assertIsNone(index.quantizer.centroids)
+
+        quantizer = ProductQuantizer(32, train_size=300)
+        rows = np.arange(600)
+        quantizer.set(rows, normalized(self.vectors), 600)
+        self.assertEqual(quantizer.codes.dtype, np.uint8)
+        self.assertEqual(quantizer.nbytes(600), 600 * 4 + quantizer.centroids.nbytes)
+        queries = normalized(self.queries)
+        np.testing.assert_allclose(quantizer.scores(queries, rows), queries @ quantizer.decode(rows).T, atol=1e-5)
+
+    def test_collection_remove_and_filter(self):
+        collection = FlatCollection('test', QuantizedIndex('int8'))
+        collection.add(ids=self.ids, embeddings=self.vectors, documents=self.ids,
+                       metadatas=[{'even': i % 2 == 0} for i in range(600)])
+        best = collection.query(query_embeddings=self.queries[:1], n_results=1)['ids'][0][0]
+        collection.delete(ids=[best])
+        self.assertNotIn(best, collection.query(query_embeddings=self.queries[:1], n_results=10)['ids'][0])
+        even = collection.query(query_embeddings=self.queries[:1], n_results=10, where={'even': True})['ids'][0]
+        self.assertTrue(all(int(doc_id) % 2 == 0 for doc_id in even))
+        self.assertEqual(collection.get(include=['embeddings'])['embeddings'].shape, (599, 32))
+
+    def test_recall_at_k(self):
+        self.assertEqual(recall_at_k([['a', 'b'], ['c', 'd']], [['b', 'x'], ['c', 'd']]), 0.75)
+
+if __name__ == '__main__':
+    unittest.main()
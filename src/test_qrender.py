@@ -0,0 +1,70 @@
+import tempfile
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from qrender import ImageRenderer, SvgRenderer, color_rgb, render_sessions
+from qutils import Painter
+
+instructions = [
+    {'draw_triangle': {'points': [[100, 30], [30, 70], [130, 100]]}},
+    {'set_color': 'red'},
+    {'draw_circle': {'center': [150, 75], 'radius': 25}},
+    {'draw_text': {'position': [50, 40], 'text': 'a < b'}},
+    {'draw_sinus': {'start': [20, 200], 'range': [0, 360, 5, 100]}},
+    {'draw_line': {'points': 'oops'}},
+]
+
+class TestRenderers(unittest.TestCase):
+    def test_svg(self):
+        painter = Painter(renderer=SvgRenderer(400, 300))
+        for instruction in instructions:
+            painter.handle_instruction(instruction)
+        svg = painter.renderer.render()
+        self.assertTrue(svg.startswith('<svg xmlns="http://www.w3.org/2000/svg" width="400" height="300"'))
+        self.assertIn('<polygon points="100,30 30,70 130,100" fill="none" stroke="#000000"', svg)
+        self.assertIn('<ellipse cx="150" cy="75" rx="25" ry="25" fill="none" stroke="#ff0000"', svg)
+        self.assertIn('>a &lt; b</tspan>', svg)
+        self.assertEqual(svg.count('<polyline'), 1)
+
+    def test_png(self):
+        painter = Painter(renderer=ImageRenderer(400, 300))
+        for instruction in instructions:
+            painter.handle_instruction(instruction)
+        image = painter.renderer.image
+        self.assertEqual(image.size, (400, 300))
+        self.assertEqual(image.getpixel((175, 75)), (255, 0, 0))
+        self.assertEqual(image.getpixel((5, 5)), (255, 255, 255))
+        painter.handle_instruction({'clear_all': None})
+        self.assertEqual(image.getcolors(), [(400 * 300, (255, 255, 255))])
+
+    def test_colors(self):
+        self.assertEqual(color_rgb('Light Blue'), (173, 216, 230))
+        self.assertEqual(color_rgb('gray50'), (128, 128, 128))
+        self.assertIsNone(color_rgb('no such color'))
+
+    def test_render_sessions(self):
+        sessions = {f"s{i}": instructions for i in range(4)}
+        with tempfile.TemporaryDirectory() as directory, ThreadPoolExecutor(2) as pool:
+            paths = render_sessions(sessions, directory, executor=pool, width=200, height=150)
+            self.assertEqual(sorted(paths), ['s0', 's1', 's2', 's3'])
+            with Image.open(paths['s2']) as image:
+                self.assertEqual(image.size, (200, 150))
+
+    def test_concurrent_submit(self):
+        painter = Painter(renderer=SvgRenderer())
+
+        def draw(color):
+            for _ in range(200):
+                painter.submit({'set_color': color})
+                painter.submit({'draw_line': {'points': [[0, 0], [10, 10]]}})
+
+        threads = [threading.Thread(target=draw, args=(color,)) for color in ('red', 'blue', 'green')]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(painter.renderer.elements), 600)
+
+if __name__ == '__main__':
+    unittest.main()
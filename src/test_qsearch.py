@@ -0,0 +1,123 @@
+import os
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from unittest import mock
+import qtrace
+import qsearch
+
+class SlowPageHandler(BaseHTTPRequestHandler):
+    # /<seconds>: a page served after that many seconds
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.active += 1
+            server.most_active = max(server.most_active, server.active)
+        time.sleep(float(self.path.strip('/')))
+        with server.lock:
+            server.active -= 1
+        body = f"<html><body><p>Page {self.path}</p></body></html>".encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+class TestStreamResponse(unittest.TestCase):
+    def setUp(self):
+        self.recorder = qtrace.SpanRecorder()
+        qtrace.tracer.add_exporter(self.recorder)
+
+    def tearDown(self):
+        qtrace.tracer.remove_exporter(self.recorder)
+
+    def test_joins_tokens_and_keeps_final_chunk(self):
+        chunks = [
+            {'response': 'Hello', 'done': False},
+            {'response': ', ', 'done': False},
+            {'response': 'world', 'done': True, 'context': [1, 2, 3], 'eval_count': 3, 'eval_duration': 1_500_000_000},
+        ]
+        tokens, final_chunk = [], {}
+        with qtrace.span('test') as span:
+            text = qsearch.stream_response(iter(chunks), tokens.append, final_chunk=final_chunk)
+        self.assertEqual(text, 'Hello, world')
+        self.assertEqual(tokens, ['Hello', ', ', 'world'])
+        self.assertEqual(final_chunk['context'], [1, 2, 3])
+        self.assertTrue(final_chunk['done'])
+        self.assertAlmostEqual(span.attributes['tokens_per_second'], 2.0)
+        self.assertGreaterEqual(span.attributes['time_to_first_token'], 0.0)
+
+    def test_empty_response(self):
+        final_chunk = {}
+        self.assertEqual(qsearch.stream_response(iter([]), lambda token: None, final_chunk=final_chunk), '')
+        self.assertEqual(final_chunk, {})
+
+class TestFetchAndSplitUrls(unittest.TestCase):
+    def setUp(self):
+        self.environ = mock.patch.dict(os.environ, {'QAI_HTTP_CACHE': 'off'})
+        self.environ.start()
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SlowPageHandler)
+        self.server.lock = threading.Lock()
+        self.server.active = self.server.most_active = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.environ.stop()
+
+    def url(self, seconds):
+        return f"http://127.0.0.1:{self.server.server_address[1]}/{seconds}"
+
+    def test_fetches_concurrently(self):
+        urls = [self.url(0.3) for _ in range(3)]
+        start = time.monotonic()
+        pages = list(qsearch.fetch_and_split_urls(urls, max_workers=3, deadline=5.0))
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0][1], ["Page /0.3"])
+        self.assertEqual(self.server.most_active, 3)
+        self.assertLess(time.monotonic() - start, 0.8)
+
+    def test_deadline(self):
+        start = time.monotonic()
+        with mock.patch('requests.Session.close', autospec=True) as close:
+            pages = list(qsearch.fetch_and_split_urls([self.url(0), self.url(1)], max_workers=2, deadline=0.3))
+            self.assertEqual([url for url, _ in pages], [self.url(0)])
+            self.assertLess(time.monotonic() - start, 0.8)
+            # The session is closed once the abandoned fetch is over
+            self.assertFalse(close.called)
+            while not close.called and time.monotonic() - start < 5:
+                time.sleep(0.05)
+            self.assertEqual(close.call_count, 1)
+
+    def test_time_of_the_caller_does_not_count(self):
+        pages = []
+        for url, _ in qsearch.fetch_and_split_urls([self.url(0), self.url(0.8)], max_workers=2, deadline=0.6):
+            pages.append(url)
+            # Storing the page takes longer than the deadline
+            time.sleep(0.7)
+        self.assertEqual(pages, [self.url(0), self.url(0.8)])
+
+class TestPreloadModel(unittest.TestCase):
+    def setUp(self):
+        qsearch.preloaded_models.clear()
+
+    def test_once_per_model(self):
+        with mock.patch('qollama.generate') as generate:
+            qsearch.preload_model('m1').join()
+            self.assertIsNone(qsearch.preload_model('m1'))
+            qsearch.preload_model('m2').join()
+        self.assertEqual([call.kwargs['model'] for call in generate.call_args_list], ['m1', 'm2'])
+
+    def test_retried_after_failure(self):
+        with mock.patch('qollama.generate', side_effect=ConnectionError("down")) as generate:
+            qsearch.preload_model('m1').join()
+            qsearch.preload_model('m1').join()
+        self.assertEqual(generate.call_count, 2)
+
+if __name__ == '__main__':
+    unittest.main()
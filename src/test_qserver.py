@@ -0,0 +1,106 @@
+import json
+import threading
+import unittest
+import urllib.error
+import urllib.request
+from argparse import Namespace
+from http.server import ThreadingHTTPServer
+from unittest import mock
+import qtrace
+from qollama import OllamaBusyError
+from qserver import QRequestHandler, QServer
+
+class FakeQServer:
+    def run(self, command, args):
+        if args.question == 'busy':
+            raise OllamaBusyError("too many requests waiting")
+        if command != 'qsearch':
+            raise ValueError(f"Unknown command: {command}")
+        return f"answer to {args.question}"
+
+class TestHandlers(unittest.TestCase):
+    def setUp(self):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), QRequestHandler)
+        self.httpd.qserver = FakeQServer()
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def post(self, path, body):
+        request = urllib.request.Request(self.url + path, data=json.dumps(body).encode('utf-8'), method='POST')
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def test_post(self):
+        self.assertEqual(self.post('/qsearch', {'question': 'why'}), (200, {'output': 'answer to why'}))
+        status, reply = self.post('/qsearch', {'question': 'busy'})
+        self.assertEqual(status, 503)
+        self.assertIn('OllamaBusyError', reply['error'])
+        status, reply = self.post('/other', {'question': 'why'})
+        self.assertEqual(status, 500)
+        self.assertIn('Unknown command', reply['error'])
+
+    def test_get(self):
+        # Metrics of their own, as the process wide ones would trace the other tests
+        with mock.patch('qtrace.get_metrics', return_value=qtrace.Metrics()), \
+             urllib.request.urlopen(self.url + '/metrics') as response:
+            self.assertEqual(response.status, 200)
+            self.assertIn('qai_span_duration_seconds', response.read().decode('utf-8'))
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(self.url + '/other')
+        self.assertEqual(raised.exception.code, 404)
+
+class FakeVectorDB:
+    created = []
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.dropped = False
+        FakeVectorDB.created.append(self)
+
+    def drop(self):
+        self.dropped = True
+
+class FakeQSearch:
+    def answer_question(self, args, qvdb, preload=True):
+        if args.question == 'fail':
+            raise RuntimeError("failed")
+        return qvdb
+
+class TestRunQSearch(unittest.TestCase):
+    def setUp(self):
+        # Without the embedding model, Chroma and Ollama of a real one
+        self.server = QServer.__new__(QServer)
+        self.server.qsearch = FakeQSearch()
+        self.server.VectorDB = FakeVectorDB
+        self.server.embed_executor = None
+        self.server.qvdbs = {}
+        self.server.qvdbs_lock = threading.Lock()
+        FakeVectorDB.created = []
+
+    def args(self, **kwargs):
+        return Namespace(**dict({'question': 'why', 'persist': False, 'quantization': None, 'stream': True}, **kwargs))
+
+    def test_every_question_gets_a_collection_dropped_after(self):
+        first = self.server.run('qsearch', self.args())
+        second = self.server.run('qsearch', self.args())
+        self.assertIsNot(first, second)
+        self.assertNotEqual(first.kwargs['collection_name'], second.kwargs['collection_name'])
+        self.assertTrue(first.dropped and second.dropped)
+        with self.assertRaises(RuntimeError):
+            self.server.run('qsearch', self.args(question='fail'))
+        self.assertTrue(FakeVectorDB.created[-1].dropped)
+
+    def test_persisted_collection_is_kept(self):
+        first = self.server.run('qsearch', self.args(persist='db'))
+        self.assertIs(self.server.run('qsearch', self.args(persist='db')), first)
+        self.assertFalse(first.dropped)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+import threading
+import time
+import unittest
+from qtools import ToolExecutor, ToolRegistry, tool_calls
+
+class TestToolExecutor(unittest.TestCase):
+    def setUp(self):
+        self.calls = []
+        self.registry = ToolRegistry()
+        self.registry.register('echo', "echoes", lambda action_input: self.calls.append(action_input) or action_input['text'])
+        self.executor = ToolExecutor(self.registry, max_steps=2, time_budget=5)
+
+    def tearDown(self):
+        self.executor.close()
+
+    def test_concurrent_calls(self):
+        barrier = threading.Barrier(3, timeout=5)
+        self.registry.register('wait', "waits for the others", lambda action_input: str(barrier.wait()))
+        results = self.executor.run([('wait', {'n': 1}), ('wait', {'n': 2}), ('wait', {'n': 3})])
+        # Each call only returns once all three are running
+        self.assertEqual(sorted(results), ['0', '1', '2'])
+
+    def test_memoized(self):
+        self.assertEqual(self.executor.run([('echo', {'text': 'Hello  World'}), ('echo', {'text': 'hello world '})]),
+                         ['Hello  World', 'Hello  World'])
+        self.assertEqual(self.executor.run([('echo', {'text': 'HELLO world'})]), ['Hello  World'])
+        self.assertEqual(len(self.calls), 1)
+        self.assertEqual(self.executor.stats['memoized'], 2)
+
+    def test_errors(self):
+        self.registry.register('fail', "fails", lambda action_input: 1 / 0)
+        unknown, failed = self.executor.run([('nope', {}), ('fail', {})])
+        self.assertIn("no tool called nope", unknown)
+        self.assertIn("ZeroDivisionError", failed)
+        # Failures are not memoized
+        self.executor.run([('fail', {})])
+        self.assertEqual(self.executor.stats['failed'], 2)
+
+    def test_budget(self):
+        self.assertTrue(self.executor.step())
+        self.assertTrue(self.executor.step())
+        self.assertFalse(self.executor.step())
+        self.executor.start()
+        self.assertTrue(self.executor.step())
+
+        release = threading.Event()
+        self.registry.register('slow', "is slow", lambda action_input: release.wait(5) and 'done')
+        self.executor.time_budget = 0.1
+        self.executor.start()
+        start_time = time.monotonic()
+        self.assertEqual(self.executor.run([('slow', {})]), ["The tool did not finish within the time budget"])
+        self.assertLess(time.monotonic() - start_time, 2)
+        self.assertFalse(self.executor.step())
+        release.set()
+
+    def test_tool_calls(self):
+        self.assertEqual(tool_calls([{'action': 'search', 'action_input': {'query': 'q'}}, {'query': 'x'}]),
+                         [('search', {'query': 'q'})])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+import threading
+import unittest
+import qtrace
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.recorder = qtrace.SpanRecorder()
+        qtrace.tracer.add_exporter(self.recorder)
+
+    def tearDown(self):
+        qtrace.tracer.remove_exporter(self.recorder)
+
+    def test_nested_spans(self):
+        with qtrace.span('request', command='qsearch') as root:
+            with qtrace.span('fetch', url='http://example.com') as fetch:
+                fetch.set(bytes=100)
+                qtrace.current().add('chunks', 3)
+            def embed():
+                with qtrace.span('embed'):
+                    pass
+            worker = threading.Thread(target=qtrace.bind(embed))
+            worker.start()
+            worker.join()
+        spans = {span.name: span for span in self.recorder.spans}
+        self.assertEqual(set(spans), {'request', 'fetch', 'embed'})
+        self.assertIsNone(spans['request'].parent_id)
+        self.assertEqual(spans['fetch'].parent_id, root.span_id)
+        self.assertEqual(spans['embed'].parent_id, root.span_id)
+        self.assertEqual({span.trace_id for span in spans.values()}, {root.trace_id})
+        self.assertEqual(spans['fetch'].attributes, {'url': 'http://example.com', 'bytes': 100, 'chunks': 3})
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with qtrace.span('generate'):
+                raise ValueError("boom")
+        self.assertEqual(self.recorder.spans[0].error, "ValueError: boom")
+
+    def test_disabled(self):
+        qtrace.tracer.remove_exporter(self.recorder)
+        self.assertIsInstance(qtrace.span('fetch'), qtrace.NoopSpan)
+        func = lambda: None
+        self.assertIs(qtrace.bind(func), func)
+
+class TestExport(unittest.TestCase):
+    def test_json_lines_and_metrics(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'trace.jsonl')
+            exporter = qtrace.JsonLinesExporter(path)
+            metrics = qtrace.Metrics(buckets=(0.1, 1.0))
+            qtrace.tracer.add_exporter(exporter)
+            qtrace.tracer.add_exporter(metrics)
+            try:
+                for _ in range(2):
+                    with qtrace.span('split', chunks=4):
+                        pass
+            finally:
+                qtrace.tracer.remove_exporter(exporter)
+                qtrace.tracer.remove_exporter(metrics)
+                exporter.close()
+            with open(path) as f:
+                lines = [json.loads(line) for line in f]
+        self.assertEqual([line['name'] for line in lines], ['split', 'split'])
+        self.assertEqual(lines[0]['attributes'], {'chunks': 4})
+
+        text = metrics.render()
+        self.assertIn('qai_span_duration_seconds_bucket{span="split",le="0.1"} 2', text)
+        self.assertIn('qai_span_duration_seconds_bucket{span="split",le="+Inf"} 2', text)
+        self.assertIn('qai_span_duration_seconds_count{span="split"} 2', text)
+        self.assertIn('qai_span_attribute_total{span="split",attribute="chunks"} 8', text)
+        self.assertLessEqual(metrics.quantile('split', 0.95), 0.1)
+
+    def test_metrics_of_attributes(self):
+        metrics = qtrace.Metrics(buckets=(0.1, 1.0))
+        qtrace.tracer.add_exporter(metrics)
+        try:
+            for status in (200, 200, 404):
+                with qtrace.span('fetch', url='http://example.com', status=status, bytes=10):
+                    pass
+            with qtrace.span('generate', model='llama3', time_to_first_token=0.5, tokens_in=7, tokens_per_second=30.0):
+                pass
+        finally:
+            qtrace.tracer.remove_exporter(metrics)
+        text = metrics.render()
+        self.assertIn('qai_span_attribute_total{span="fetch",attribute="bytes"} 30', text)
+        self.assertIn('qai_span_attribute_total{span="generate",attribute="tokens_in"} 7', text)
+        self.assertIn('qai_span_attribute_values_total{span="fetch",attribute="status",value="200"} 2', text)
+        self.assertIn('qai_span_attribute_values_total{span="fetch",attribute="status",value="404"} 1', text)
+        self.assertIn('qai_span_attribute_seconds_bucket{span="generate",attribute="time_to_first_token",le="0.1"} 0', text)
+        self.assertIn('qai_span_attribute_seconds_bucket{span="generate",attribute="time_to_first_token",le="1.0"} 1', text)
+        self.assertNotIn('attribute="status"} ', text)
+        self.assertNotIn('tokens_per_second', text)
+        self.assertEqual(qtrace.label('say "hi"\\\n'), 'say \\"hi\\"\\\\\\n')
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,5 +1,8 @@
+import os
+import subprocess
+import sys
 import unittest
-from qutils import extract_json_objects
+from qutils import extract_json_objects, extract_json_stream, instruction_handler, JsonStreamExtractor
 
 class TestJsonExtractor(unittest.TestCase):
     def test_extract_json_objects(self):
@@ -23,5 +26,66 @@ class TestJsonExtractor(unittest.TestCase):
         # Check that the extracted data is correct
         self.assertEqual(data, [{'action': 'search', 'action_input': {'query': 'Nobel Prize in Literature 2023 winner'}}])
 
+    def test_pseudo_json_without_conversion(self):
+        text = "Here's the plan: {'text': \"it's fine\", 'n': [1, 2.5, -3,], 'ok': True, 'x': None,} and {\"a\": 1}"
+        self.assertEqual(list(extract_json_objects(text)),
+                         [{'text': "it's fine", 'n': [1, 2.5, -3], 'ok': True, 'x': None}, {'a': 1}])
+
+    def test_braces_in_prose(self):
+        text = "Sets look like {1, 2}. {\"a\": {\"b\": 1} oops } then {'c': 'd\\'e'} and an open { brace"
+        self.assertEqual(list(extract_json_objects(text)), [{'b': 1}, {'c': "d'e"}])
+
+    def test_stream(self):
+        text = "Action: {'action': 'draw', 'instructions': [{'set_color': 'red'}, {'draw_line': [1, 2, 3, 4]}]} done {'x': 1}"
+        expected = list(extract_json_objects(text))
+        for size in (1, 3, 7):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            self.assertEqual(list(extract_json_stream(chunks)), expected)
+        # An object is returned as soon as it closes
+        extractor = JsonStreamExtractor()
+        self.assertEqual(extractor.feed("{'a': 1"), [])
+        self.assertEqual(extractor.feed("} {'b'"), [{'a': 1}])
+        self.assertEqual(extractor.close(), [])
+
+    def test_non_finite_numbers(self):
+        text = 'Got {"a": NaN} and {\'b\': [Infinity, -Infinity], "c": 1}'
+        expected = list(extract_json_objects(text))
+        self.assertEqual(repr(expected), "[{'a': nan}, {'b': [inf, -inf], 'c': 1}]")
+        for size in (1, 2, 5):
+            chunks = [text[i:i + size] for i in range(0, len(text), size)]
+            # NaN is not equal to itself, hence the repr
+            self.assertEqual(repr(list(extract_json_stream(chunks))), repr(expected))
+
+class TestInstructionHandlers(unittest.TestCase):
+    def test_dispatch(self):
+        calls = []
+
+        class RecordingPainter:
+            def __getattr__(self, name):
+                return lambda *args: calls.append((name,) + args)
+
+        painter = RecordingPainter()
+        for instruction in [{'draw_circle': {'center': [150, 75], 'radius': 25}},
+                            {'draw_triangle': {'points': [[100, 30], [30, 70], [130, 100]]}},
+                            {'draw_sinus': {'start': [20, 200], 'range': [0, 180, 90, 100]}},
+                            {'set_color': 'blue'}]:
+            handler, argument = instruction_handler(instruction)
+            handler(painter, argument)
+        self.assertEqual([(name,) + tuple(arg.tolist() if hasattr(arg, 'tolist') else arg for arg in args)
+                          for name, *args in calls],
+                         [('draw_circle', 150, 75, 25),
+                          ('draw_triangle', [[100, 30], [30, 70], [130, 100]]),
+                          ('draw_curve', [[20, 200.0], [110, 300.0]]),
+                          ('set_color', 'blue')])
+        self.assertIsNone(instruction_handler({'action': 'draw'}))
+
+class TestLazyImports(unittest.TestCase):
+    def test_import_qutils_is_light(self):
+        # Importing qutils must neither load the heavy dependencies nor open the log file
+        code = "import sys, logging, qutils; print(sorted(m for m in ('tkinter', 'numpy', 'bs4', 'googlesearch', 'langchain', 'langchain_community', 'chromadb') if m in sys.modules), logging.getLogger().handlers)"
+        src_directory = os.path.dirname(os.path.abspath(__file__))
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, cwd=src_directory).stdout
+        self.assertEqual(output.strip(), "[] []")
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -0,0 +1,184 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+from bench_rag import hash_embedding_function
+from qembed import EmbeddingCache
+from qvdb import VectorDB
+
+def paragraphs(count, prefix="paragraph"):
+    return [f"{prefix} {i} about topic {i % 7}" for i in range(count)]
+
+class TestVectorDB(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = EmbeddingCache(os.path.join(self.tmpdir.name, "embeddings.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def open(self, **kwargs):
+        return VectorDB(db_directory=os.path.join(self.tmpdir.name, "db"),
+                        is_persistent=True,
+                        embed_model="hash-32",
+                        embedding_function=hash_embedding_function(32),
+                        embed_cache=self.cache,
+                        **kwargs)
+
+    def test_persisted_collection_is_searched_through_quantized_index(self):
+        documents = paragraphs(60)
+        exact = self.open()
+        exact.bulk_add(documents, [{"n": i} for i in range(60)], [str(i) for i in range(60)])
+
+        # Reopened quantized, the index is built from the stored embeddings
+        qvdb = self.open(quantization='int8', rerank=4)
+        queries = [documents[5], documents[42]]
+        expected = exact.query(queries, num_results=3)
+        found = qvdb.query(queries, num_results=3)
+        self.assertEqual(len(qvdb.quantized_index()), 60)
+        self.assertEqual(found['ids'], expected['ids'])
+        self.assertEqual(found['ids'][0][0], "5")
+        self.assertEqual(found['documents'][1][0], documents[42])
+        self.assertEqual(found['metadatas'][1][0]["n"], 42)
+        self.assertAlmostEqual(found['distances'][0][0], 0.0, places=5)
+
+        # Documents added later are found through the index too
+        qvdb.add(["a new paragraph"], [{"n": 60}], ["new"])
+        self.assertEqual(len(qvdb.quantized_index()), 61)
+        self.assertEqual(qvdb.query("a new paragraph", num_results=1)['ids'], [["new"]])
+
+        # And documents deleted are left out of it
+        qvdb.delete(["new", "5"])
+        self.assertEqual(len(qvdb.quantized_index()), 59)
+        self.assertNotIn("5", qvdb.query(documents[5], num_results=3)['ids'][0])
+
+    def test_queries_are_cached_apart(self):
+        qvdb = self.open()
+        qvdb.add(["a document"], [{"n": 1}], ["1"])
+        qvdb.query("a question")
+        key = [EmbeddingCache.key("a question")]
+        self.assertIsNotNone(self.cache.get("sentence-transformers:hash-32:query", key)[0])
+        self.assertIsNone(self.cache.get("sentence-transformers:hash-32", key)[0])
+
+    def test_without_rerank(self):
+        documents = paragraphs(20)
+        qvdb = self.open(quantization='int8', rerank=0)
+        qvdb.bulk_add(documents, [{"n": i} for i in range(20)], [str(i) for i in range(20)])
+        found = qvdb.query(documents[7], num_results=2)
+        self.assertEqual(found['ids'][0][0], "7")
+        self.assertEqual(len(found['documents'][0]), 2)
+
+class InMemoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = EmbeddingCache(os.path.join(self.tmpdir.name, "embeddings.db"))
+
+    def tearDown(self):
+        self.cache.close()
+        self.tmpdir.cleanup()
+
+    def open(self, **kwargs):
+        return VectorDB(is_persistent=False,
+                        embed_model="hash-16",
+                        embedding_function=hash_embedding_function(16),
+                        embed_cache=self.cache,
+                        **kwargs)
+
+class TestBatchWriter(InMemoryTestCase):
+    def test_skips_stored_content(self):
+        qvdb = self.open()
+        # A duplicate within the batch
+        self.assertEqual(qvdb.add_batch(["a", "b", "a"], [{"n": 1}, {"n": 2}, {"n": 3}], ["1", "2", "3"]), 2)
+        # Content stored by an earlier batch, under another id
+        self.assertEqual(qvdb.add_batch(["b", "c"], [{"n": 4}, {"n": 5}], ["4", "5"]), 1)
+        self.assertEqual(sorted(qvdb.collection.get()['ids']), ["1", "2", "5"])
+        self.assertEqual(qvdb.add_batch([], [], []), 0)
+
+    def test_skips_content_stored_by_add(self):
+        qvdb = self.open()
+        qvdb.add(["a"], [{"n": 1}], ["1"])
+        self.assertEqual(qvdb.add_batch(["a", "b"], [{"n": 2}, {"n": 3}], ["2", "3"]), 1)
+        self.assertEqual(sorted(qvdb.collection.get()['ids']), ["1", "3"])
+
+    def test_counts_stored_and_skipped(self):
+        qvdb = self.open()
+        qvdb.add_batch(["stored before"], [{"n": 0}], ["0"])
+        with qvdb.batch_writer(batch_size=2) as writer:
+            writer.add(["a", "b", "a"], [{"n": 1}, {"n": 2}, {"n": 3}], ["1", "2", "3"])
+            # The batch of "a" and "b" is stored, the second "a" waits for more
+            self.assertEqual((writer.stored, writer.skipped), (2, 0))
+            writer.add(["stored before", "c"], [{"n": 4}, {"n": 5}], ["4", "5"])
+        self.assertEqual((writer.stored, writer.skipped), (3, 2))
+        self.assertEqual(qvdb.collection.count(), 4)
+        self.assertEqual(qvdb.bulk_add(["c", "d"], [{"n": 6}, {"n": 7}], ["6", "7"]), 1)
+
+    def test_batch_size_is_clamped_to_chroma(self):
+        qvdb = self.open(backend='chroma', collection_name="test-clamp")
+        try:
+            with mock.patch.object(qvdb.client, 'get_max_batch_size', return_value=3):
+                self.assertEqual(qvdb.batch_writer(batch_size=10).batch_size, 3)
+                self.assertEqual(qvdb.batch_writer(batch_size=2).batch_size, 2)
+            self.assertEqual(self.open().batch_writer(batch_size=10).batch_size, 10)
+        finally:
+            qvdb.drop()
+
+class TestBackend(InMemoryTestCase):
+    def test_moves_to_chroma_only_beyond_a_set_threshold(self):
+        documents = paragraphs(30)
+        qvdb = self.open()
+        qvdb.bulk_add(documents, [{"n": i} for i in range(30)], [str(i) for i in range(30)])
+        self.assertTrue(qvdb.uses_flat())
+
+        qvdb = self.open(ann_threshold=20, collection_name="test-move")
+        try:
+            qvdb.bulk_add(documents[:20], [{"n": i} for i in range(20)], [str(i) for i in range(20)])
+            self.assertTrue(qvdb.uses_flat())
+            qvdb.bulk_add(documents[20:], [{"n": i} for i in range(20, 30)], [str(i) for i in range(20, 30)])
+            self.assertFalse(qvdb.uses_flat())
+            self.assertEqual(qvdb.collection.count(), 30)
+            self.assertEqual(qvdb.query(documents[25], num_results=1)['ids'], [["25"]])
+        finally:
+            qvdb.drop()
+
+class TestHybridQuery(InMemoryTestCase):
+    def test_fuses_lexical_matches(self):
+        documents = paragraphs(100)
+        documents[37] = "the disk is full, see error ERR-42"
+        qvdb = self.open()
+        qvdb.bulk_add(documents, [{"n": i} for i in range(100)], [str(i) for i in range(100)])
+        # The hash embeddings know nothing of meaning: dense search alone misses it
+        self.assertNotIn("37", qvdb.query("ERR-42", num_results=20)['ids'][0])
+
+        found = qvdb.query("ERR-42", num_results=3, hybrid=True, lexical_weight=2.0)
+        self.assertEqual(found['ids'][0][0], "37")
+        self.assertEqual(found['documents'][0][0], documents[37])
+        self.assertEqual(found['metadatas'][0][0]["n"], 37)
+        self.assertEqual(len(found['ids'][0]), 3)
+        self.assertEqual(found['distances'][0][0], 0.0)
+        self.assertEqual(found['distances'][0], sorted(found['distances'][0]))
+
+        # Documents added later are found by the lexical index too
+        qvdb.add(["ERR-43 is another error"], [{"n": 100}], ["100"])
+        self.assertEqual(qvdb.query("ERR-43", num_results=1, hybrid=True, dense_weight=0.5)['ids'], [["100"]])
+
+    def test_deleted_documents_are_left_out(self):
+        documents = paragraphs(50)
+        documents[3] = "the disk is full, see error ERR-42"
+        documents[4] = "error ERR-42 again"
+        qvdb = self.open()
+        qvdb.bulk_add(documents, [{"n": i} for i in range(50)], [str(i) for i in range(50)])
+        self.assertEqual(set(qvdb.query("ERR-42", num_results=2, hybrid=True, lexical_weight=2.0)['ids'][0]), {"3", "4"})
+
+        qvdb.delete(["3"])
+        self.assertNotIn("3", qvdb.lexical_index().numbers)
+        # Deleted behind the back of the lexical index, it is dropped from it on the next query
+        qvdb.collection.delete(ids=["4"])
+        found = qvdb.query("ERR-42", num_results=3, hybrid=True, lexical_weight=2.0)
+        self.assertEqual(len(found['ids'][0]), 3)
+        self.assertFalse({"3", "4"} & set(found['ids'][0]))
+        self.assertEqual(len(found['documents'][0]), 3)
+        self.assertEqual(len(qvdb.lexical_index()), 48)
+
+if __name__ == '__main__':
+    unittest.main()